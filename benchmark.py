@@ -0,0 +1,240 @@
+'''
+    Times creating, loading, saving and rendering a project made from a
+    generated tile map and writes the results as JSON so that runs against
+    different versions can be compared.
+
+    python benchmark.py [--width 256] [--height 192] [--unique 0.05] [-o results.json]
+'''
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import shutil
+import tempfile
+import time
+
+# Rendering is timed without a window.
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import Image
+import pygame
+import extract_tiles
+import id_map
+import project
+import renderer
+
+SCREEN_SIZE = (1024, 768)
+
+VIEW_MODES = [('map', renderer.MAP_VIEW), ('id', renderer.ID_VIEW), ('char', renderer.CHAR_VIEW)]
+
+def random_tile(seed, index, tile_width, tile_height):
+    '''
+        Returns an RGB tile of pseudo random pixels which depend only on the
+        seed and index.
+    '''
+    num_bytes = tile_width * tile_height * 3
+    data = b''
+    block = 0
+    while len(data) < num_bytes:
+        data += hashlib.sha512('{0}-{1}-{2}'.format(seed, index, block).encode('ascii')).digest()
+        block += 1
+
+    if hasattr(Image, 'frombytes'):
+        return Image.frombytes('RGB', (tile_width, tile_height), data[:num_bytes])
+
+    return Image.fromstring('RGB', (tile_width, tile_height), data[:num_bytes])
+
+def generate_tile_map(path, width_tiles, height_tiles, tile_width, tile_height, unique_ratio, noise, seed):
+    '''
+        Writes an image of width_tiles by height_tiles tiles drawn from
+        unique_ratio * the number of cells distinct tiles, each of which is
+        used at least once where there's room.
+
+        noise is the fraction of cells which have one pixel changed slightly,
+        making them near duplicates of the tile they were drawn from.
+    '''
+    rnd = random.Random(seed)
+    num_cells = width_tiles * height_tiles
+    num_unique = max(1, int(round(num_cells * unique_ratio)))
+    palette = [random_tile(seed, i, tile_width, tile_height) for i in range(num_unique)]
+
+    choices = list(range(min(num_unique, num_cells))) + [rnd.randrange(num_unique) for i in range(num_cells - num_unique)]
+    rnd.shuffle(choices)
+
+    im = Image.new('RGB', (width_tiles * tile_width, height_tiles * tile_height))
+    for i, choice in enumerate(choices):
+        tile = palette[choice]
+        if noise and rnd.random() < noise:
+            tile = tile.copy()
+            x, y = rnd.randrange(tile_width), rnd.randrange(tile_height)
+            tile.putpixel((x, y), tuple((channel + rnd.randint(1, 8)) % 256 for channel in tile.getpixel((x, y))))
+
+        im.paste(tile, ((i % width_tiles) * tile_width, (i // width_tiles) * tile_height))
+
+    im.save(path)
+
+def best_time(function, setup=None, repeat=1):
+    '''
+        Returns the quickest of repeat calls to function, setup is called
+        before each one and isn't timed.
+    '''
+    best = None
+    for i in range(repeat):
+        if setup:
+            setup()
+
+        start = time.time()
+        function()
+        elapsed = time.time() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+def map_output_tiles(loaded_project, mapped_ratio, seed):
+    '''
+        Gives a mapped_ratio fraction of the ids one of a few output tiles so
+        that saving and the character view have something to do.
+    '''
+    rnd = random.Random(seed)
+    output_tiles = [project.OutputTile('tile{0}'.format(i), chr(ord('a') + i), rnd.randrange(256), rnd.randrange(256), rnd.randrange(256)) for i in range(8)]
+    for output_tile in output_tiles:
+        loaded_project.output_tiles[output_tile.identifier] = output_tile
+
+    for id in sorted(loaded_project.id_image_mapping.keys()):
+        if rnd.random() < mapped_ratio:
+            loaded_project.set_output_tile(id, rnd.choice(output_tiles))
+
+def benchmark_render(loaded_project, frames):
+    '''
+        Times the first frame of each view mode, which draws every tile, and
+        the average of frames frames scrolling across the map, then the same
+        for each zoomed out level of the map view.
+    '''
+    pygame.init()
+    surface = pygame.display.set_mode(SCREEN_SIZE)
+    font = pygame.font.SysFont('consolas', 12)
+
+    results = {}
+    for name, view_mode in VIEW_MODES:
+        ui_renderer = renderer.Renderer(surface, font, loaded_project)
+
+        start = time.time()
+        ui_renderer.render(view_mode)
+        first_frame = time.time() - start
+
+        start = time.time()
+        for frame in range(frames):
+            # Scroll right then back so the view stays over the map.
+            ui_renderer.shift_display(1 if (frame // 20) % 2 == 0 else -1, 0)
+            ui_renderer.render(view_mode)
+            ui_renderer.render_output_tile_area()
+            ui_renderer.render_status_bar()
+
+        results[name] = {'first_frame': first_frame, 'scroll_frame': (time.time() - start) / frames if frames else None}
+
+    # Each zoom level of the map view, the first frame includes building
+    # that level of the pyramid.
+    ui_renderer = renderer.Renderer(surface, font, loaded_project)
+    zoom_results = []
+    for zoom in range(1, len(ui_renderer.zoom_scales)):
+        ui_renderer.change_zoom(1)
+
+        start = time.time()
+        ui_renderer.render(renderer.MAP_VIEW)
+        first_frame = time.time() - start
+
+        start = time.time()
+        for frame in range(frames):
+            step_x, step_y = ui_renderer.scroll_step()
+            ui_renderer.shift_display(step_x if (frame // 20) % 2 == 0 else -step_x, 0)
+            ui_renderer.render(renderer.MAP_VIEW)
+
+        zoom_results.append({'scale': ui_renderer.zoom_scales[zoom], 'first_frame': first_frame, 'scroll_frame': (time.time() - start) / frames if frames else None})
+
+    results['zoom'] = zoom_results
+
+    pygame.quit()
+
+    return results
+
+def run(args):
+    work_dir = tempfile.mkdtemp(prefix='tilemap_benchmark')
+    try:
+        image_file = os.path.join(work_dir, 'map.png')
+        project_dir = os.path.join(work_dir, 'project')
+
+        start = time.time()
+        generate_tile_map(image_file, args.width, args.height, args.tilewidth, args.tileheight, args.unique, args.noise, args.seed)
+        generate_time = time.time() - start
+
+        def remove_project():
+            if os.path.isdir(project_dir):
+                shutil.rmtree(project_dir)
+
+        creators = []
+        def create():
+            creator = extract_tiles.ProjectCreator(image_file, project_dir, args.tilewidth, args.tileheight, engine=args.engine, tolerance=args.tolerance, jobs=args.jobs, streaming=args.stream, storage=args.storage, id_map_format=args.idmap, verbose=False, transforms=args.transforms)
+            creator.create()
+            creators.append(creator)
+
+        results = {'generate': generate_time}
+        results['create'] = best_time(create, setup=remove_project, repeat=args.repeat)
+        results['create_phases'] = creators[-1].metrics.phases
+        results['load'] = best_time(lambda: project.load(project_dir), repeat=args.repeat)
+
+        loaded_project = project.load(project_dir)
+        map_output_tiles(loaded_project, args.mapped, args.seed)
+        results['save'] = best_time(lambda: project.save(project_dir, loaded_project), repeat=args.repeat)
+
+        loaded_project = project.load(project_dir)
+        results['render'] = benchmark_render(loaded_project, args.frames)
+
+        stats = loaded_project.get_stats()
+    finally:
+        shutil.rmtree(work_dir)
+
+    return {
+        'parameters': vars(args),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'numpy': extract_tiles.numpy is not None,
+            'pygame': pygame.version.ver,
+        },
+        'project': {'tiles': stats['tiles'], 'ids': stats['ids'], 'mapped_ids': stats['mapped_ids']},
+        'results': results,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the tile map converter on a generated tile map")
+    parser.add_argument("--width", type=int, default=256, help="map width in tiles")
+    parser.add_argument("--height", type=int, default=192, help="map height in tiles")
+    parser.add_argument("-x", "--tilewidth", type=int, default=16)
+    parser.add_argument("-y", "--tileheight", type=int, default=16)
+    parser.add_argument("--unique", type=float, default=0.05, help="distinct tiles as a fraction of the cells")
+    parser.add_argument("--noise", type=float, default=0.0, help="fraction of cells with a pixel changed slightly")
+    parser.add_argument("--mapped", type=float, default=0.5, help="fraction of ids given an output tile before saving")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--frames", type=int, default=100)
+    parser.add_argument("-e", "--engine", choices=[extract_tiles.NUMPY_ENGINE, extract_tiles.PIL_ENGINE], default=extract_tiles.DEFAULT_ENGINE)
+    parser.add_argument("-t", "--tolerance", type=float)
+    parser.add_argument("-j", "--jobs", type=int, default=1)
+    parser.add_argument("-s", "--stream", action="store_true")
+    parser.add_argument("--storage", choices=[extract_tiles.ATLAS_STORAGE, extract_tiles.FILES_STORAGE], default=extract_tiles.ATLAS_STORAGE)
+    parser.add_argument("--idmap", choices=[id_map.BINARY_FORMAT, id_map.TEXT_FORMAT], default=id_map.BINARY_FORMAT)
+    parser.add_argument("--transforms", action="store_true")
+    parser.add_argument("-o", "--output")
+
+    args = parser.parse_args()
+    output = json.dumps(run(args), indent=2, sort_keys=True)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
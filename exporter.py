@@ -0,0 +1,83 @@
+'''
+    Writes the ascii map of a project without the editor. Only the project's
+    text files and id map are read so neither pygame nor the tile images are
+    needed.
+'''
+import itertools
+import id_map
+import journal
+
+# Export formats
+TEXT_FORMAT = 'text'
+ANSI_FORMAT = 'ansi'
+HTML_FORMAT = 'html'
+FORMATS = [TEXT_FORMAT, ANSI_FORMAT, HTML_FORMAT]
+
+UNKNOWN_CHAR = '?'
+
+HTML_ESCAPES = {'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;'}
+HTML_HEADER = '<html>\n<body style="background-color:#000000;color:#ffffff">\n<pre>\n'
+HTML_FOOTER = '</pre>\n</body>\n</html>\n'
+
+def _load_output_tiles(project_dir):
+    '''
+        Returns a dictionary of tile id to (char, (r, g, b)).
+    '''
+    output_tile_list, mapping = journal.load_output_state(project_dir)
+    output_tiles = dict((identifier, (char, (r, g, b))) for identifier, char, r, g, b in output_tile_list)
+
+    return dict((id, output_tiles[identifier]) for id, identifier in mapping.iteritems())
+
+def _text_row(row, glyphs):
+    return ''.join([glyphs.get(id, UNKNOWN_CHAR) for id in row]) + '\n'
+
+def _colored_row(row, glyphs, begin_color, end_color, end_row):
+    '''
+        Writes a row in which a new colour is only started when it differs
+        from the previous tile's colour. Runs of the same id are handled
+        together. glyphs maps each id to (char, colour) where the colour is
+        None for the default.
+    '''
+    parts = []
+    current_color = None
+    for id, run in itertools.groupby(row):
+        char, color = glyphs.get(id, (UNKNOWN_CHAR, None))
+        if color != current_color:
+            if current_color is not None:
+                parts.append(end_color)
+            if color is not None:
+                parts.append(begin_color.format(*color))
+            current_color = color
+
+        parts.append(char * sum(1 for _ in run))
+
+    if current_color is not None:
+        parts.append(end_color)
+    parts.append(end_row)
+
+    return ''.join(parts)
+
+def export(project_dir, output_file, format=TEXT_FORMAT):
+    '''
+        Streams the map to output_file one row at a time, converting each id
+        through a lookup table built once from the output tiles.
+    '''
+    output_tiles = _load_output_tiles(project_dir)
+
+    if format == TEXT_FORMAT:
+        glyphs = dict((id, char) for id, (char, color) in output_tiles.iteritems())
+        write_row = lambda row: _text_row(row, glyphs)
+    elif format == ANSI_FORMAT:
+        write_row = lambda row: _colored_row(row, output_tiles, '\x1b[38;2;{0};{1};{2}m', '\x1b[39m', '\x1b[0m\n')
+    elif format == HTML_FORMAT:
+        glyphs = dict((id, (''.join(HTML_ESCAPES.get(c, c) for c in char), color)) for id, (char, color) in output_tiles.iteritems())
+        write_row = lambda row: _colored_row(row, glyphs, '<span style="color:#{0:02x}{1:02x}{2:02x}">', '</span>', '\n')
+        output_file.write(HTML_HEADER)
+    else:
+        raise ValueError('Unknown export format {0}'.format(format))
+
+    for row in id_map.iter_rows(project_dir):
+        output_file.write(write_row(row))
+
+    if format == HTML_FORMAT:
+        output_file.write(HTML_FOOTER)
@@ -1,11 +1,43 @@
+import array
+import hashlib
+import itertools
 import math
+import multiprocessing
 import os
 import shutil
+import time
 import Image
 import ImageChops
+import ImageStat
+import extraction_cache
+import id_map
+import journal
+import progress
+import tile_atlas
+import tile_transforms
+
+try:
+    import numpy
+    import tile_similarity
+except ImportError:
+    numpy = None
+    tile_similarity = None
 
 COMPARE_CONSTANT = 10
 
+# Extraction engines
+PIL_ENGINE = 'pil'
+NUMPY_ENGINE = 'numpy'
+DEFAULT_ENGINE = NUMPY_ENGINE if numpy else PIL_ENGINE
+
+# Tile storage
+ATLAS_STORAGE = 'atlas'
+FILES_STORAGE = 'files'
+
+# Bytes per pixel of the raw modes whose stride PIL leaves for the decoder to
+# work out.
+RAW_MODE_BYTES = {'1;8': 1, 'L': 1, 'P': 1, 'RGB': 3, 'BGR': 3, 'RGBA': 4, 'BGRA': 4, 'RGBX': 4, 'BGRX': 4}
+
 def compare_tiles_cheap(tile_1, tile_2):
     '''
         Pixel by pixel match algorithm. Exits as soon as a pixel is found which
@@ -16,37 +48,431 @@ def compare_tiles_cheap(tile_1, tile_2):
     tile_2_data = tile_2.getdata()
     return all(tile_1_data[i] == tile_2_data[i] for i in range(len(tile_1_data)))
 
-def compare_tiles_expensive(tile_1, tile_2):
+def compare_tiles_expensive(tile_1, tile_2, tolerance=COMPARE_CONSTANT):
     '''
         Least sum squares algorithm on the histogram of the difference between
         images.
 
-        Setting the COMPARE_CONSTANT at the top of the file to a larger 
-        value will allow more difference between tiles which are considered the
-        same.
+        Setting the COMPARE_CONSTANT at the top of the file (or passing a
+        tolerance) to a larger value will allow more difference between tiles
+        which are considered the same.
 
         This is more expensive to run than is ideal.
     '''
     h = ImageChops.difference(tile_1, tile_2).histogram()
-    sq = (value*(idx**2) for idx, value in enumerate(h))
+
+    # The histogram holds 256 entries for each band one after another.
+    sq = (value*((idx % 256)**2) for idx, value in enumerate(h))
     sum_of_squares = sum(sq)
-    rms = math.sqrt(sum_of_squares / float(tile.size[0] * c_tile.size[1]))
+    rms = math.sqrt(sum_of_squares / float(tile_1.size[0] * tile_1.size[1]))
+
+    return rms <= tolerance
+
+def tile_bytes(tile):
+    '''
+        The raw pixel data of a tile. Two tiles with the same mode and size are
+        identical if and only if their raw data is identical.
+    '''
+    if hasattr(tile, 'tobytes'):
+        return tile.tobytes()
+
+    return tile.tostring()
+
+def image_from_bytes(mode, size, data):
+    '''
+        The reverse of tile_bytes.
+    '''
+    if hasattr(Image, 'frombytes'):
+        return Image.frombytes(mode, size, data)
+
+    return Image.fromstring(mode, size, data)
+
+class ExactTileIndex():
+    '''
+        Finds tiles which are pixel for pixel identical to one already seen.
+
+        Tiles are bucketed by a digest of their raw data so that a lookup is a
+        single dictionary access rather than a comparison against every known
+        tile. The raw data is kept alongside the id and compared on lookup so
+        that a digest collision can never merge two different tiles.
+    '''
+
+    def __init__(self):
+        self.buckets = {}
+        self.comparisons = 0
+
+    def find(self, tile):
+        return self.find_data(tile_bytes(tile))
+
+    def add(self, tile, id):
+        self.add_data(tile_bytes(tile), id)
+
+    def find_data(self, data):
+        for known_data, id in self.buckets.get(hashlib.sha1(data).digest(), []):
+            self.comparisons += 1
+            if known_data == data:
+                return id
+
+        return None
+
+    def add_data(self, data, id):
+        self.buckets.setdefault(hashlib.sha1(data).digest(), []).append((data, id))
 
-    return rms < COMPARE_CONSTANT
+    def matches(self, tile, id):
+        '''
+            Whether tile is the same as the tile added with id.
+        '''
+        return self.find(tile) == id
+
+class LinearTileIndex():
+    '''
+        Compares a tile against every known tile using an arbitrary pairwise
+        compare function. Used when the compare function doesn't define an
+        exact match.
+    '''
+
+    def __init__(self, compare_function):
+        self.compare_function = compare_function
+        self.tiles = []
+        self.tiles_by_id = {}
+        self.comparisons = 0
+
+    def find(self, tile):
+        for c_tile, id in self.tiles:
+            self.comparisons += 1
+            if self.compare_function(tile, c_tile):
+                return id
+
+        return None
+
+    def add(self, tile, id):
+        self.tiles.append((tile, id))
+        self.tiles_by_id[id] = tile
+
+    def matches(self, tile, id):
+        return self.compare_function(tile, self.tiles_by_id[id])
+
+class TolerantTileIndex():
+    '''
+        Finds a tile which compare_tiles_expensive considers the same as one
+        already seen without comparing against every known tile.
+
+        The difference between the band means of two tiles can't be larger
+        than the RMS difference between them, so tiles are bucketed on a grid
+        over their band means with cells the size of the tolerance. Only the
+        tiles in the neighbouring cells can be within tolerance of a new tile.
+    '''
+
+    def __init__(self, tolerance):
+        self.tolerance = tolerance
+        self.cell_size = max(tolerance, 1)
+        self.buckets = {}
+        self.tiles_by_id = {}
+        self.comparisons = 0
+
+    def bucket(self, tile):
+        return tuple(int(mean // self.cell_size) for mean in ImageStat.Stat(tile).mean)
+
+    def find(self, tile):
+        bucket = self.bucket(tile)
+        candidates = []
+        for offset in itertools.product((-1, 0, 1), repeat=len(bucket)):
+            candidates.extend(self.buckets.get(tuple(b + o for b, o in zip(bucket, offset)), []))
+
+        # Prefer the earliest tile so that the result doesn't depend on the
+        # order of the buckets.
+        for c_tile, id in sorted(candidates, key=lambda candidate: candidate[1]):
+            self.comparisons += 1
+            if compare_tiles_expensive(tile, c_tile, self.tolerance):
+                return id
+
+        return None
+
+    def add(self, tile, id):
+        self.buckets.setdefault(self.bucket(tile), []).append((tile, id))
+        self.tiles_by_id[id] = tile
+
+    def matches(self, tile, id):
+        return compare_tiles_expensive(tile, self.tiles_by_id[id], self.tolerance)
+
+class SimilarityTileIndex():
+    '''
+        Finds the closest known tile using a tile_similarity.SimilarityEngine
+        and accepts it if it is within the tolerance.
+
+        Keeps track of the closest tile that was rejected and the furthest
+        tile that was accepted so that the tolerance can be tuned.
+    '''
+
+    def __init__(self, metric, tolerance, channel_tolerances=None):
+        self.engine = tile_similarity.SimilarityEngine(metric, channel_tolerances)
+        self.tolerance = tolerance
+        self.ids = []
+        self.positions = {}
+        self.closest_rejected = None
+        self.furthest_accepted = None
+        self.last_tile = self.last_vector = None
+        self.comparisons = 0
+
+    def vector(self, tile):
+        if tile is not self.last_tile:
+            self.last_tile, self.last_vector = tile, self.engine.tile_vector(tile)
+
+        return self.last_vector
+
+    def find(self, tile):
+        # Every known tile is compared against at once.
+        self.comparisons += len(self.ids)
+        index, distance = self.engine.best_match(self.vector(tile))
+        if index is None:
+            return None
+        elif distance <= self.tolerance:
+            self.furthest_accepted = distance if self.furthest_accepted is None else max(distance, self.furthest_accepted)
+            return self.ids[index]
+        else:
+            self.closest_rejected = distance if self.closest_rejected is None else min(distance, self.closest_rejected)
+            return None
+
+    def add(self, tile, id):
+        self.positions[id] = self.engine.add(self.vector(tile))
+        self.ids.append(id)
+
+    def matches(self, tile, id):
+        return self.engine.distances(self.vector(tile), [self.positions[id]])[0] <= self.tolerance
+
+    def summary(self):
+        return 'Furthest accepted match: {0}, closest rejected match: {1} (tolerance {2})'.format(self.furthest_accepted, self.closest_rejected, self.tolerance)
+
+def create_tile_index(compare_function=compare_tiles_cheap, tolerance=None, metric=None, channel_tolerances=None):
+    '''
+        The cheap compare function is an exact match so it can be replaced
+        by a hash lookup which gives the same answer.
+    '''
+    if metric is not None:
+        if metric == tile_similarity.CHANNEL_METRIC:
+            return SimilarityTileIndex(metric, 1, channel_tolerances)
+
+        return SimilarityTileIndex(metric, COMPARE_CONSTANT if tolerance is None else tolerance)
+    elif tolerance is not None:
+        return TolerantTileIndex(tolerance)
+    elif compare_function == compare_tiles_cheap:
+        return ExactTileIndex()
+
+    return LinearTileIndex(compare_function)
+
+def _raw_args(args):
+    '''
+        The (rawmode, stride, orientation) of a raw tile, PIL allows just the
+        rawmode to be given.
+    '''
+    if isinstance(args, tuple) and len(args) == 3:
+        return args
+    elif isinstance(args, str):
+        return args, 0, 1
+
+    return None
+
+def _band_stride(im):
+    '''
+        The number of bytes per row if the image is stored uncompressed in a
+        single block which PIL can be pointed at a few rows at a time,
+        otherwise None.
+    '''
+    if len(im.tile) != 1:
+        return None
+
+    decoder, extents, offset, args = im.tile[0]
+    if decoder != 'raw' or tuple(extents) != (0, 0) + im.size or _raw_args(args) is None:
+        return None
+
+    rawmode, stride, orientation = _raw_args(args)
+    if stride:
+        return stride
+    elif rawmode in RAW_MODE_BYTES:
+        return im.size[0] * RAW_MODE_BYTES[rawmode]
+
+    return None
+
+def read_bands(image_file, band_height, top=0, bottom=None, report=None):
+    '''
+        Yields (y, band) for each horizontal band of the image from top to
+        bottom (by default the whole image). report, if given, is told when
+        the image has to be decoded in full.
+
+        Uncompressed images (BMP, PPM, TGA...) are decoded one band at a time
+        by pointing the decoder at just the rows in that band so that only a
+        single band is ever in memory. Other formats can't be decoded part way
+        through so they are decoded in full and then cut into bands.
+    '''
+    im = Image.open(image_file)
+    width, height = im.size
+    stride = _band_stride(im)
+    if bottom is None:
+        bottom = height
+
+    if stride is None:
+        if report:
+            report('{0} can\'t be decoded a band at a time, decoding the whole image'.format(image_file))
+        for y in range(top, bottom, band_height):
+            yield y, im.crop((0, y, width, min(bottom, y + band_height)))
+        return
+
+    decoder, extents, offset, args = im.tile[0]
+    rawmode, _, orientation = _raw_args(args)
+    for y in range(top, bottom, band_height):
+        rows = min(band_height, bottom - y)
+
+        # Bottom up images store the last row first.
+        first_row = y if orientation >= 0 else height - y - rows
+
+        band = Image.open(image_file)
+        if hasattr(band, '_size'):
+            band._size = (width, rows)
+        else:
+            band.size = (width, rows)
+        band.tile = [('raw', (0, 0, width, rows), offset + first_row * stride, (rawmode, stride, orientation))]
+        band.load()
+
+        yield y, band
+
+def _extract_strip(args):
+    '''
+        Run in a worker process by ProjectCreator.extract_tiles_parallel.
+
+        Extracts the tiles from a vertical strip of the image and returns them
+        as (raw data, count, x, y) along with the strip's own id map and
+        transform map. Images can't be sent between processes so the strip
+        arrives, and the tiles are returned, as raw data.
+    '''
+    data, mode, size, palette, target_directory, tile_width, tile_height, engine, transforms = args
+    creator = ProjectCreator(None, target_directory, tile_width, tile_height, engine=engine, verbose=False, transforms=transforms)
+
+    strip = image_from_bytes(mode, size, data)
+    if palette:
+        strip.putpalette(palette)
+
+    if engine == NUMPY_ENGINE:
+        tiles, id_image = creator.extract_tiles_numpy(strip)
+    else:
+        tiles, id_image = creator.extract_tiles(strip)
+
+    return [(tile_bytes(tile['image']), tile['count'], tile['x'], tile['y']) for tile in tiles], id_image, creator.transform_map
 
 class ProjectCreator():
 
-    def __init__(self, image_file, target_directory, tile_width, tile_height, compare_function=compare_tiles_cheap):
+    def __init__(self, image_file, target_directory, tile_width, tile_height, compare_function=compare_tiles_cheap, engine=DEFAULT_ENGINE, tolerance=None, metric=None, channel_tolerances=None, jobs=1, streaming=False, storage=ATLAS_STORAGE, id_map_format=id_map.BINARY_FORMAT, verbose=True, progress_callback=None, metrics_file=None, offset_x=None, offset_y=None, cache=None, transforms=False):
         self.image_file = image_file
         self.target_directory = target_directory
         self.tile_width = tile_width
         self.tile_height = tile_height
         self.tile_directory = os.path.join(target_directory, 'tiles')
         self.compare_function = compare_function
+        self.engine = engine
+        self.tolerance = tolerance
+        self.metric = metric
+        self.channel_tolerances = channel_tolerances
+        self.jobs = jobs
+        self.streaming = streaming
+        self.storage = storage
+        self.id_map_format = id_map_format
+        self.verbose = verbose
+        self.metrics_file = metrics_file
+        self.offset_x = offset_x
+        self.offset_y = offset_y
+        self.cache = cache
+        self.cache_key = None
+        self.box = None
+        self.transforms = transforms
 
-    def create(self):
-        tiles = {}
+        # The transform of each cell when tiles are stored once for every
+        # flip and rotation of them (see tile_transforms).
+        self.transform_map = None
+
+        # Progress is printed unless something else is told about it.
+        if progress_callback is None and verbose:
+            progress_callback = progress.print_progress
+
+        self.progress_callback = progress_callback
+        self.metrics = progress.CreationMetrics(progress_callback)
+
+    def report(self, message):
+        if self.verbose:
+            print(message)
+
+    def is_exact(self):
+        return self.tolerance is None and self.metric is None and self.compare_function == compare_tiles_cheap
+
+    def uses_transforms(self):
+        '''
+            Tiles which only match once they're turned round can't be told
+            apart from near matches, so flips and rotations are only merged
+            when tiles must match exactly.
+        '''
+        return self.transforms and self.is_exact()
+
+    def create_tile_index(self):
+        return create_tile_index(self.compare_function, self.tolerance, self.metric, self.channel_tolerances)
 
+    def cache_parameters(self):
+        '''
+            Everything other than the image which changes the project files.
+            The engine and the number of jobs give the same result so they
+            aren't included.
+        '''
+        parameters = {
+            'tile_width': self.tile_width,
+            'tile_height': self.tile_height,
+            'offset_x': self.offset_x or 0,
+            'offset_y': self.offset_y or 0,
+            'compare': None if self.compare_function == compare_tiles_cheap else '{0}.{1}'.format(self.compare_function.__module__, self.compare_function.__name__),
+            'tolerance': self.tolerance,
+            'metric': self.metric,
+            'channel_tolerances': self.channel_tolerances,
+            'streaming': self.streaming,
+            'storage': self.storage,
+            'id_map_format': self.id_map_format,
+        }
+        if self.uses_transforms():
+            parameters['transforms'] = True
+
+        return parameters
+
+    def restore_from_cache(self):
+        '''
+            Copies the project from the cache if the same image has been
+            extracted with the same parameters before. Returns whether it was.
+        '''
+        with self.metrics.phase('hash'):
+            self.cache_key = extraction_cache.cache_key(self.image_file, self.cache_parameters())
+
+        with self.metrics.phase('restore'):
+            if not self.cache.restore(self.cache_key, self.target_directory):
+                return False
+
+        with open(os.path.join(self.target_directory, 'counts.csv')) as counts_file:
+            unique_tiles = sum(1 for line in counts_file)
+
+        self.report('Reused the tiles extracted from an identical image in {0}'.format(self.cache.cache_dir))
+        self.metrics.progress(self.metrics.total_tiles, unique_tiles)
+        return True
+
+    def grid_box(self, width, height):
+        '''
+            The (left, top, right, bottom) of the part of the image which is
+            split into tiles. The whole image is used unless an offset is
+            given, in which case the grid starts at the offset and any partial
+            tiles around the edges are left out.
+        '''
+        if self.offset_x is None and self.offset_y is None:
+            return 0, 0, width, height
+
+        left, top = self.offset_x or 0, self.offset_y or 0
+        right = left + max(0, width - left) // self.tile_width * self.tile_width
+        bottom = top + max(0, height - top) // self.tile_height * self.tile_height
+
+        return left, top, right, bottom
+
+    def create(self):
         if os.path.isdir(self.target_directory):
             if raw_input('Project directory already exists. Would you like to empty it? (Y/N)').lower() == 'y':
                 shutil.rmtree(self.target_directory)
@@ -55,50 +481,450 @@ class ProjectCreator():
             if raw_input('tiles directory already exists. Would you like to empty it? (Y/N)').lower() == 'y':
                 shutil.rmtree(self.tile_directory)
 
-        os.makedirs(self.tile_directory)
+        if not os.path.isdir(self.tile_directory):
+            os.makedirs(self.tile_directory)
+
+        # A transform map left from an earlier project would turn the tiles,
+        # it is written again if this project has one.
+        if tile_transforms.has_transform_map(self.target_directory):
+            os.remove(os.path.join(self.target_directory, tile_transforms.TRANSFORM_MAP_FILE))
+
+        # Only one id map format is written and a binary id map is loaded in
+        # preference to a text one, so one left from an earlier project must
+        # go.
+        other_id_map = os.path.join(self.target_directory, id_map.ID_MAP_TEXT_FILE if self.id_map_format == id_map.BINARY_FORMAT else id_map.ID_MAP_BINARY_FILE)
+        if os.path.isfile(other_id_map):
+            os.remove(other_id_map)
 
+        # Likewise an atlas is loaded in preference to the tile images.
+        if self.storage != ATLAS_STORAGE:
+            for atlas_file in (tile_atlas.ATLAS_INDEX_FILE, tile_atlas.ATLAS_IMAGE_FILE):
+                if os.path.isfile(os.path.join(self.target_directory, atlas_file)):
+                    os.remove(os.path.join(self.target_directory, atlas_file))
+
+        # A journal left from editing an earlier project would be replayed on
+        # top of this project's empty output tiles.
+        for journal_file in (journal.JOURNAL_FILE, journal.COMPACTING_JOURNAL_FILE):
+            if os.path.isfile(os.path.join(self.target_directory, journal_file)):
+                os.remove(os.path.join(self.target_directory, journal_file))
+
+        self.metrics = progress.CreationMetrics(self.progress_callback)
         im = Image.open(self.image_file)
-        width, height = im.size
+        self.box = self.grid_box(*im.size)
+        left, top, right, bottom = self.box
+        width, height = right - left, bottom - top
 
         if width % self.tile_width != 0:
             print('The image width ({0}) must be a multiple of the tile width ({1})'.format(width, self.tile_width))
         elif height % self.tile_height != 0:
             print('The image height ({0}) must be a multiple of the tile height ({1})'.format(height, self.tile_height))
+        elif width == 0 or height == 0:
+            print('The image is smaller than a single tile')
         else:
-            print("The image being imported has width = {0} and height = {1}. You are using tile width {2} and tile height = {3}".format(width, height, self.tile_width, self.tile_height))
-            id_image = [[-1 for x in range(width // self.tile_width)] for y in range(height // self.tile_height)]
-
-            for x in range(0, width, self.tile_width):
-                print('Processing column {0}: there are currently {1} unique tiles'.format(x, len(tiles)))
-                for y in range(0, height, self.tile_height):
-                    tile_x, tile_y = x // self.tile_width, y // self.tile_height
-                    tile = im.crop((x, y, x + self.tile_width, y + self.tile_height))
-
-                    is_similar = False
-                    for c_tile in tiles:
-                        
-                        if self.compare_function(tile, c_tile):
-                            is_similar = True
-                            tiles[c_tile]['count'] += 1
-                            id_image[tile_y][tile_x] = tiles[c_tile]['id']
-                            break
-
-                    if not is_similar:
-                        id_image[tile_y][tile_x] = len(tiles)
-                        tiles[tile] = {'count':1, 'id':len(tiles)}
+            self.report("The image being imported has width = {0} and height = {1}. You are using tile width {2} and tile height = {3}".format(im.size[0], im.size[1], self.tile_width, self.tile_height))
+            if self.box != (0, 0) + im.size:
+                self.report('Using the {0}x{1} tiles from ({2}, {3}) to ({4}, {5})'.format(width // self.tile_width, height // self.tile_height, left, top, right, bottom))
+            if self.jobs > 1 and (self.streaming or not self.is_exact()):
+                self.report('Parallel extraction only supports exact matching without streaming, using a single process')
+            if self.transforms and not self.is_exact():
+                self.report('Flipped and rotated tiles are only merged when tiles must match exactly, storing every orientation')
 
-            with open(os.path.join(self.target_directory, 'counts.csv'), 'w') as ofile:
+            self.metrics.start((width // self.tile_width) * (height // self.tile_height))
+            if not self.cache or not self.restore_from_cache():
+                files = self.extract_and_write(im)
+                if self.cache:
+                    with self.metrics.phase('cache'):
+                        self.cache.store(self.cache_key, self.target_directory, files)
+
+            self.metrics.finish()
+
+            if self.metrics_file:
+                self.metrics.write(self.metrics_file)
+
+    def extract_and_write(self, im):
+        '''
+            Extracts the tiles with whichever engine applies and writes the
+            project files, returning their names (see project_files).
+        '''
+        if not self.streaming:
+            with self.metrics.phase('decode'):
+                im.load()
+                if self.box != (0, 0) + im.size:
+                    im = im.crop(self.box)
+
+        if self.streaming:
+            tiles = self.extract_tiles_streaming(im)
+            id_image = None
+        elif self.jobs > 1 and self.is_exact():
+            tiles, id_image = self.extract_tiles_parallel(im)
+        elif self.engine == NUMPY_ENGINE and self.is_exact():
+            tiles, id_image = self.extract_tiles_numpy(im)
+        else:
+            tiles, id_image = self.extract_tiles(im)
+
+        self.write_project(tiles, id_image)
+        return self.project_files(len(tiles))
+
+    def project_files(self, num_tiles):
+        '''
+            The files, relative to the project directory, which creating a
+            project of num_tiles unique tiles writes.
+        '''
+        files = ['counts.csv', 'tiles.project', 'output_tiles.txt', 'output_tiles_id_mapping.txt']
+        files.append(id_map.ID_MAP_BINARY_FILE if self.id_map_format == id_map.BINARY_FORMAT else id_map.ID_MAP_TEXT_FILE)
+
+        if self.storage == ATLAS_STORAGE:
+            files.extend([tile_atlas.ATLAS_IMAGE_FILE, tile_atlas.ATLAS_INDEX_FILE])
+        else:
+            files.extend(os.path.join('tiles', '{0}.png'.format(id)) for id in range(num_tiles))
+
+        if self.uses_transforms():
+            files.append(tile_transforms.TRANSFORM_MAP_FILE)
+
+        return files
+
+    def extract_tiles(self, im):
+        '''
+            Splits the image into tiles, giving each distinct tile an id in the
+            order that it is first seen (column by column).
+
+            Returns a list of the unique tiles, ordered by id, as dictionaries
+            of image/count/id/x/y (where x, y is the top left of the first
+            sighting) and the grid of tile ids.
+        '''
+        width, height = im.size
+        tiles = []
+        tile_index = self.create_tile_index()
+        cols, rows = width // self.tile_width, height // self.tile_height
+        id_image = id_map.new_id_map(cols, rows, cols * rows)
+        if self.uses_transforms():
+            self.transform_map = tile_transforms.new_transform_map(cols, rows)
+
+        processed = 0
+        crop_time = compare_time = 0
+
+        for x in range(0, width, self.tile_width):
+            for y in range(0, height, self.tile_height):
+                tile_x, tile_y = x // self.tile_width, y // self.tile_height
+                start = time.time()
+                tile = im.crop((x, y, x + self.tile_width, y + self.tile_height))
+                cropped = time.time()
+
+                if self.transform_map is not None:
+                    tile, self.transform_map[tile_y][tile_x] = tile_transforms.canonical_image(tile, tile_bytes)
+
+                id = tile_index.find(tile)
+                if id is None:
+                    id = len(tiles)
+                    tile_index.add(tile, id)
+                    tiles.append({'image':tile, 'count':0, 'id':id, 'x':x, 'y':y})
+
+                tiles[id]['count'] += 1
+                id_image[tile_y][tile_x] = id
+                compare_time += time.time() - cropped
+                crop_time += cropped - start
+
+            processed += height // self.tile_height
+            self.metrics.progress(processed, len(tiles), tile_index.comparisons)
+
+        self.metrics.add_time('crop', crop_time)
+        self.metrics.add_time('compare', compare_time)
+
+        if isinstance(tile_index, SimilarityTileIndex):
+            self.report(tile_index.summary())
+
+        return tiles, id_map.compact_id_map(id_image, len(tiles))
+
+    def extract_tiles_numpy(self, im):
+        '''
+            Equivalent to extract_tiles using an exact match but works on the
+            whole image at once.
+
+            The image is viewed as a (rows, cols, tile_height, tile_width,
+            channels) array of tiles and the unique tiles, the id of every cell
+            and the counts all come out of a single numpy.unique call. Only
+            the unique tiles are cropped out of the image.
+        '''
+        width, height = im.size
+        cols, rows = width // self.tile_width, height // self.tile_height
+
+        with self.metrics.phase('compare'):
+            tiles, id_image = self._unique_tiles_numpy(im, cols, rows)
+
+        with self.metrics.phase('crop'):
+            for tile in tiles:
+                tile['image'] = self.crop_tile(im, tile['x'], tile['y'])
+
+        # Tiles are sorted rather than compared so there's no count of
+        # comparisons.
+        self.metrics.progress(rows * cols, len(tiles))
+
+        return tiles, id_image
+
+    def _unique_tiles_numpy(self, im, cols, rows):
+        pixels = numpy.asarray(im)
+        if pixels.ndim == 2:
+            pixels = pixels[:, :, numpy.newaxis]
+
+        blocks = pixels.reshape(rows, self.tile_height, cols, self.tile_width, pixels.shape[2]).swapaxes(1, 2)
+
+        # Ids are handed out column by column so flatten the cells in that
+        # order. Each cell's pixels are then viewed as a single opaque value
+        # so that whole tiles can be sorted and compared.
+        cells = numpy.ascontiguousarray(blocks.swapaxes(0, 1)).reshape(rows * cols, -1)
+        if self.uses_transforms():
+            cells, applied = tile_transforms.canonical_pixels(cells.reshape((rows * cols,) + blocks.shape[2:]))
+            self.transform_map = tile_transforms.inverse_transforms(applied).reshape(cols, rows).T
+
+        keys = cells.view(numpy.dtype((numpy.void, cells.shape[1] * cells.itemsize))).ravel()
+        _, first_index, inverse, counts = numpy.unique(keys, return_index=True, return_inverse=True, return_counts=True)
+
+        # numpy.unique orders tiles by value, renumber them by first sighting.
+        order = numpy.argsort(first_index)
+        ids = numpy.empty_like(order)
+        ids[order] = numpy.arange(len(order))
+        id_image = id_map.compact_id_map(ids[inverse.ravel()].reshape(cols, rows).T, len(order))
+
+        tiles = []
+        for id, unique in enumerate(order):
+            tile_x, tile_y = first_index[unique] // rows, first_index[unique] % rows
+            tiles.append({'image':None, 'count':int(counts[unique]), 'id':id, 'x':tile_x * self.tile_width, 'y':tile_y * self.tile_height})
+
+        return tiles, id_image
+
+    def crop_tile(self, im, x, y):
+        '''
+            The tile with its top left at x, y, turned into the orientation it
+            is stored in if flips and rotations are merged.
+        '''
+        tile = im.crop((x, y, x + self.tile_width, y + self.tile_height))
+        if self.transform_map is not None:
+            transform = int(self.transform_map[y // self.tile_height][x // self.tile_width])
+            tile = tile_transforms.transform_image(tile, tile_transforms.inverse(transform))
+
+        return tile
+
+    def extract_tiles_parallel(self, im):
+        '''
+            Equivalent to extract_tiles using an exact match but splits the
+            image into vertical strips which are processed in separate
+            processes.
+
+            Ids are handed out column by column, so merging the strips from
+            left to right and each strip's tiles in id order gives every tile
+            the same id that a single process would have given it regardless
+            of the number of jobs.
+        '''
+        width, height = im.size
+        cols = width // self.tile_width
+        strip_cols = -(-cols // self.jobs)
+        lefts = range(0, width, strip_cols * self.tile_width)
+        palette = im.getpalette() if im.mode == 'P' else None
+
+        # The image has already been decoded so each worker is sent just the
+        # raw data of its strip rather than decoding the whole image again.
+        def strips():
+            for left in lefts:
+                strip = im.crop((left, 0, min(width, left + strip_cols * self.tile_width), height))
+                yield tile_bytes(strip), strip.mode, strip.size, palette, self.target_directory, self.tile_width, self.tile_height, self.engine, self.uses_transforms()
+
+        self.report('Processing {0} strips using {1} processes'.format(len(lefts), self.jobs))
+        with self.metrics.phase('extract'):
+            pool = multiprocessing.Pool(self.jobs)
+            try:
+                results = list(pool.imap(_extract_strip, strips()))
+            finally:
+                pool.close()
+                pool.join()
+
+        # Only the comparisons made merging the strips are counted.
+        with self.metrics.phase('merge'):
+            tiles, id_image, tile_index = self._merge_strips(im, lefts, results)
+
+        self.metrics.progress(cols * (height // self.tile_height), len(tiles), tile_index.comparisons)
+
+        return tiles, id_image
+
+    def _merge_strips(self, im, lefts, results):
+        width, height = im.size
+        tiles = []
+        tile_index = ExactTileIndex()
+        id_image = [array.array('I') for y in range(height // self.tile_height)]
+        strip_id_maps = []
+
+        # The strips' transforms don't depend on the ids so they're simply
+        # joined up.
+        if self.uses_transforms():
+            if numpy:
+                self.transform_map = numpy.hstack([strip_transform_map for strip_tiles, strip_id_image, strip_transform_map in results])
+            else:
+                self.transform_map = [array.array('B') for y in range(height // self.tile_height)]
+                for strip_tiles, strip_id_image, strip_transform_map in results:
+                    for row, strip_row in zip(self.transform_map, strip_transform_map):
+                        row.extend(strip_row)
+
+        for left, (strip_tiles, strip_id_image, strip_transform_map) in zip(lefts, results):
+            strip_ids = []
+            for data, count, x, y in strip_tiles:
+                id = tile_index.find_data(data)
+                if id is None:
+                    id = len(tiles)
+                    tile_index.add_data(data, id)
+                    tiles.append({'image':self.crop_tile(im, left + x, y), 'count':0, 'id':id, 'x':left + x, 'y':y})
+
+                tiles[id]['count'] += count
+                strip_ids.append(id)
+
+            if numpy:
+                strip_id_maps.append(numpy.array(strip_ids, dtype=numpy.uint32)[strip_id_image])
+            else:
+                for row, strip_row in zip(id_image, strip_id_image):
+                    row.extend(strip_ids[id] for id in strip_row)
+
+        if strip_id_maps:
+            id_image = numpy.hstack(strip_id_maps)
+
+        return tiles, id_map.compact_id_map(id_image, len(tiles)), tile_index
+
+    def extract_tiles_streaming(self, im):
+        '''
+            Equivalent to extract_tiles but reads the image one band of tiles
+            at a time (see read_bands) and writes each row of the id map as
+            soon as it is complete, so memory is bounded by one band plus the
+            unique tiles.
+
+            Ids are handed out in the order tiles are first seen row by row
+            rather than column by column.
+        '''
+        left, top, right, bottom = self.box if self.box else (0, 0) + im.size
+        width, height = right - left, bottom - top
+        tiles = []
+        tile_index = self.create_tile_index()
+        processed = 0
+        decode_time = crop_time = compare_time = write_time = 0
+        transform_writer = None
+        if self.uses_transforms():
+            transform_writer = tile_transforms.TransformMapWriter(self.target_directory, width // self.tile_width, height // self.tile_height)
+
+        with id_map.open_writer(self.target_directory, self.id_map_format, width // self.tile_width, height // self.tile_height, self.tile_width, self.tile_height) as writer:
+            bands = read_bands(self.image_file, self.tile_height, top, bottom, self.report)
+            while True:
+                start = time.time()
+                try:
+                    y, band = next(bands)
+                except StopIteration:
+                    break
+                decode_time += time.time() - start
+
+                row, transform_row = [], []
+                for x in range(0, width, self.tile_width):
+                    start = time.time()
+                    tile = band.crop((left + x, 0, left + x + self.tile_width, self.tile_height))
+                    cropped = time.time()
+
+                    if transform_writer:
+                        tile, transform = tile_transforms.canonical_image(tile, tile_bytes)
+                        transform_row.append(transform)
+
+                    id = tile_index.find(tile)
+                    if id is None:
+                        # Copy the tile so that it doesn't keep the band alive.
+                        tile = tile.copy()
+                        id = len(tiles)
+                        tile_index.add(tile, id)
+                        tiles.append({'image':tile, 'count':0, 'id':id, 'x':x, 'y':y - top})
+
+                    tiles[id]['count'] += 1
+                    row.append(id)
+                    compare_time += time.time() - cropped
+                    crop_time += cropped - start
+
+                start = time.time()
+                writer.write_row(row)
+                if transform_writer:
+                    transform_writer.write_row(transform_row)
+                write_time += time.time() - start
+
+                processed += len(row)
+                self.metrics.progress(processed, len(tiles), tile_index.comparisons)
+
+        if transform_writer:
+            transform_writer.close()
+
+        self.metrics.add_time('decode', decode_time)
+        self.metrics.add_time('crop', crop_time)
+        self.metrics.add_time('compare', compare_time)
+        self.metrics.add_time('write_id_map', write_time)
+
+        if isinstance(tile_index, SimilarityTileIndex):
+            self.report(tile_index.summary())
+
+        return tiles
+
+    def write_atlas(self, tiles):
+        '''
+            Packs every tile into a single image with an index of where each
+            tile is rather than writing one image per tile.
+        '''
+        size, offsets = tile_atlas.atlas_layout(len(tiles), self.tile_width, self.tile_height)
+        mode = tiles[0]['image'].mode if tiles else 'RGB'
+
+        atlas = Image.new(mode, size)
+        if mode == 'P':
+            atlas.putpalette(tiles[0]['image'].getpalette())
+
+        for tile, offset in zip(tiles, offsets):
+            atlas.paste(tile['image'], offset)
+
+        # The tiles are cropped from the image so they carry its transparent
+        # colour, if it has one, but a new image doesn't.
+        options = {}
+        if tiles and 'transparency' in tiles[0]['image'].info:
+            options['transparency'] = tiles[0]['image'].info['transparency']
+
+        atlas.save(os.path.join(self.target_directory, tile_atlas.ATLAS_IMAGE_FILE), **options)
+        tile_atlas.write_index(self.target_directory, [(tile['id'], x, y) for tile, (x, y) in zip(tiles, offsets)])
+
+    def write_project(self, tiles, id_image):
+        '''
+            Writes the tiles and project files. The id map is only written if
+            it is given, it has already been written when streaming.
+        '''
+        with self.metrics.phase('encode'):
+            if self.storage == ATLAS_STORAGE:
+                self.write_atlas(tiles)
+            else:
                 for tile in tiles:
-                    tile.save(os.path.join(self.tile_directory, '{0}.png'.format(tiles[tile]['id'])))
-                    ofile.write('{0}, {1}\n'.format(tiles[tile]['id'], tiles[tile]['count']))
+                    tile['image'].save(os.path.join(self.tile_directory, '{0}.png'.format(tile['id'])))
 
-            with open(os.path.join(self.target_directory, 'id_map.txt'), 'w') as ofile:
-                for y in range(0, height // self.tile_height):
-                    ofile.write(','.join([str(a) for a in id_image[y]]) + '\n')
+        if id_image is not None:
+            with self.metrics.phase('write_id_map'):
+                id_map.write_id_map(self.target_directory, self.id_map_format, id_image, self.tile_width, self.tile_height)
+                if self.transform_map is not None:
+                    tile_transforms.write_transform_map(self.target_directory, self.transform_map)
+
+        with self.metrics.phase('write'):
+            with open(os.path.join(self.target_directory, 'counts.csv'), 'w') as ofile:
+                for tile in tiles:
+                    ofile.write('{0}, {1}\n'.format(tile['id'], tile['count']))
 
             with open(os.path.join(self.target_directory, 'tiles.project'), 'w') as ofile:
                 ofile.write('tile_width=' + str(self.tile_width) + '\n')
                 ofile.write('tile_height=' + str(self.tile_height) + '\n')
+                if self.offset_x is not None or self.offset_y is not None:
+                    ofile.write('offset_x=' + str(self.offset_x or 0) + '\n')
+                    ofile.write('offset_y=' + str(self.offset_y or 0) + '\n')
+
+                # How tiles were compared, so that updating the project matches
+                # them the same way.
+                if self.tolerance is not None:
+                    ofile.write('tolerance=' + repr(self.tolerance) + '\n')
+                if self.metric is not None:
+                    ofile.write('metric=' + self.metric + '\n')
+                if self.channel_tolerances:
+                    ofile.write('channel_tolerances=' + ','.join(repr(t) for t in self.channel_tolerances) + '\n')
+                if self.compare_function != compare_tiles_cheap:
+                    ofile.write('compare=' + self.cache_parameters()['compare'] + '\n')
 
             open(os.path.join(self.target_directory, 'output_tiles.txt'), 'w').close()
-            open(os.path.join(self.target_directory, 'output_tiles_id_mapping.txt'), 'w').close()
\ No newline at end of file
+            open(os.path.join(self.target_directory, 'output_tiles_id_mapping.txt'), 'w').close()
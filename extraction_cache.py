@@ -0,0 +1,142 @@
+'''
+    A cache of extracted projects keyed by the contents of the source image
+    and the parameters which affect the result, so that creating a project
+    from an image which hasn't changed only costs hashing the image.
+
+    Each entry is a directory named after its key holding the files that
+    creating the project wrote, and only those, so that anything else left in
+    the project directory is never cached. Entries are touched when they're used and
+    the least recently used are removed once the cache is larger than its
+    maximum size.
+'''
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.tilemap_cache')
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+
+# Changed whenever the project files written for the same parameters change
+# so that old entries are no longer used.
+CACHE_VERSION = 2
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+def file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as image_file:
+        for block in iter(lambda: image_file.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+def cache_key(image_file, parameters):
+    '''
+        The key for an image and a dictionary of the parameters used to
+        extract it.
+    '''
+    description = '{0}|{1}|{2}'.format(CACHE_VERSION, file_digest(image_file), sorted(parameters.items()))
+    return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+def _entry_files(path):
+    '''
+        The path of every file under path relative to it.
+    '''
+    return [os.path.relpath(os.path.join(root, name), path) for root, dirs, files in os.walk(path) for name in files]
+
+def _copy_files(source, target, files):
+    '''
+        Copies each of files, paths relative to source, to the same place
+        under target, creating directories as needed.
+    '''
+    for name in files:
+        target_file = os.path.join(target, name)
+        if not os.path.isdir(os.path.dirname(target_file)):
+            os.makedirs(os.path.dirname(target_file))
+
+        shutil.copyfile(os.path.join(source, name), target_file)
+
+def _directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, dirs, files in os.walk(path) for name in files)
+
+class ExtractionCache():
+    '''
+        Stores and restores extracted projects. Several processes can share a
+        cache: entries are written to a temporary directory and renamed into
+        place, and an entry which disappears while it is being restored is
+        treated as a miss.
+    '''
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_size=DEFAULT_MAX_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def restore(self, key, target_directory):
+        '''
+            Copies the entry for key into target_directory. Returns False if
+            there is no entry.
+        '''
+        path = self.entry_path(key)
+        if not os.path.isdir(path):
+            return False
+
+        try:
+            _copy_files(path, target_directory, _entry_files(path))
+            now = time.time()
+            os.utime(path, (now, now))
+        except (IOError, OSError):
+            return False
+
+        return True
+
+    def store(self, key, project_directory, files):
+        '''
+            Adds files, paths relative to project_directory, as the entry for
+            key and then removes old entries if the cache is too large.
+        '''
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        temporary = tempfile.mkdtemp(prefix='.' + key, dir=self.cache_dir)
+        try:
+            _copy_files(project_directory, temporary, files)
+            os.rename(temporary, self.entry_path(key))
+        except OSError:
+            # Another process stored the same entry first.
+            shutil.rmtree(temporary, ignore_errors=True)
+
+        self.evict()
+
+    def entries(self):
+        '''
+            Returns (last used, size, path) for each entry, least recently
+            used first.
+        '''
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+
+            try:
+                entries.append((os.path.getmtime(path), _directory_size(path), path))
+            except OSError:
+                continue
+
+        return sorted(entries)
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for last_used, size, path in entries)
+
+        for last_used, size, path in entries:
+            if total <= self.max_size:
+                break
+
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
@@ -0,0 +1,233 @@
+'''
+    Works out the tile size and offset of an image made of tiles.
+
+    Each axis is searched separately. When a map reuses tiles, a pixel is
+    often identical to the pixel one tile further along, so sizes are scored
+    by how often pixels repeat at that distance, along with how much stronger
+    the edges between tiles are than the edges inside them. For each size the
+    offset is the one at which rows of tiles repeat most.
+
+    Multiples of the real tile size score as well as the size itself, so the
+    best few sizes on each axis are combined and the grid which describes the
+    image in the fewest bits, storing each unique tile once plus an index per
+    cell, is chosen.
+'''
+import math
+import Image
+import numpy
+
+DEFAULT_MIN_SIZE = 4
+DEFAULT_MAX_SIZE = 64
+
+# Sizes are scored by how far each signal is above its median. For each
+# signal the CANDIDATES smallest sizes scoring at least CANDIDATE_SCORE of the
+# best score and the CANDIDATES best are tried.
+CANDIDATE_SCORE = 0.5
+CANDIDATES = 2
+
+# A signal is only used if its best score is this many times the median
+# distance of the scores from their median.
+SIGNAL_CONTRAST = 6
+
+# Large images are scored on a square from their centre of this many pixels,
+# repeats are only counted on this many rows or columns and the grids are
+# compared on a square of this many pixels.
+SAMPLE_SIZE = 2048
+SAMPLE_LINES = 128
+GRID_SAMPLE_SIZE = 2048
+
+def pack_pixels(pixels):
+    '''
+        Packs a (height, width, channels) array of up to 4 channels into a
+        (height, width) array with one value per pixel.
+    '''
+    packed = numpy.zeros(pixels.shape[:2], dtype=numpy.uint32)
+    for channel in range(pixels.shape[2]):
+        packed |= pixels[:, :, channel].astype(numpy.uint32) << (8 * channel)
+
+    return packed
+
+def count_unique_rows(rows):
+    '''
+        The number of distinct rows in a 2d array of packed pixels. Rows are
+        compared by a 64 bit hash, which is much quicker to sort than the rows
+        themselves, so different rows could be counted as one but the chance
+        of it is negligible.
+    '''
+    if rows.shape[0] == 0:
+        return 0
+
+    # The default integer is 32 bits on some platforms so the 62 bit random
+    # weights are made from two 31 bit halves.
+    halves = numpy.random.RandomState(rows.shape[1]).randint(0, 2 ** 31, size=(2, rows.shape[1])).astype(numpy.uint64)
+    weights = ((halves[0] << numpy.uint64(31)) | halves[1]) * numpy.uint64(2) + numpy.uint64(1)
+    hashes = (rows.astype(numpy.uint64) * weights).sum(axis=1, dtype=numpy.uint64)
+
+    return len(numpy.unique(hashes))
+
+def _lines(packed, axis):
+    '''
+        Evenly spaced rows (axis 1) or columns (axis 0) of packed, arranged
+        so that the axis being searched is the last one.
+    '''
+    if axis == 0:
+        packed = packed.T
+
+    step = max(1, packed.shape[0] // SAMPLE_LINES)
+    return packed[::step]
+
+def edge_profile(pixels, axis):
+    '''
+        The total difference between each column (axis 1) or row (axis 0) of
+        pixels and the next one.
+    '''
+    differences = numpy.abs(numpy.diff(pixels.astype(numpy.int16), axis=axis))
+    other_axes = tuple(a for a in range(pixels.ndim) if a != axis)
+
+    return differences.sum(axis=other_axes, dtype=numpy.float64)
+
+def repeat_rate(lines, size):
+    '''
+        The fraction of pixels which are the same as the pixel size further
+        along.
+    '''
+    return (lines[:, size:] == lines[:, :-size]).mean()
+
+def edge_strength(profile, size):
+    '''
+        Returns (strength, offset) for the offset at which the edges of a grid
+        of size are strongest, relative to the average edge.
+
+        profile[i] is the edge between pixels i and i + 1, so a grid of size
+        starting at offset has edges at every i with (i + 1) % size == offset.
+    '''
+    phases = numpy.arange(1, len(profile) + 1) % size
+    means = numpy.bincount(phases, weights=profile, minlength=size) / numpy.maximum(numpy.bincount(phases, minlength=size), 1)
+    offset = int(means.argmax())
+    mean = profile.mean()
+
+    return (means[offset] / mean if mean else 0), offset
+
+def unique_segments(lines, size, offset):
+    '''
+        The number of distinct size long runs of pixels starting at offset
+        and every size pixels after it, or None if no run fits after offset.
+    '''
+    count = (lines.shape[1] - offset) // size
+    if count == 0:
+        return None
+
+    return count_unique_rows(lines[:, offset:offset + count * size].reshape(-1, size))
+
+def best_offset(lines, profile, size):
+    '''
+        The offset at which the fewest distinct runs of pixels are seen, so
+        the one at which whole rows of tiles repeat. When nothing repeats the
+        offset with the strongest edges is used. Offsets too close to the
+        end of the image for a whole run to fit are skipped.
+    '''
+    strength, edge_offset = edge_strength(profile, size)
+    counts = [unique_segments(lines, size, offset) for offset in range(size)]
+    fewest = min(count for count in counts if count is not None)
+
+    if counts[edge_offset] == fewest:
+        return edge_offset
+
+    return counts.index(fewest)
+
+def axis_candidates(pixels, packed, axis, min_size, max_size):
+    '''
+        Returns up to CANDIDATES (size, offset) for an axis, smallest first.
+    '''
+    lines = _lines(packed, axis)
+    profile = edge_profile(pixels, axis)
+    sizes = range(min_size, min(max_size, lines.shape[1] - 1) + 1)
+    if not sizes:
+        return []
+
+    repeats = [repeat_rate(lines, size) for size in sizes]
+    edges = [edge_strength(profile, size)[0] for size in sizes]
+
+    # Either signal can pick a size out. The real size is usually the
+    # smallest with a score close to the best but chance, or a pattern inside
+    # the tiles, can put other sizes ahead, so both the smallest and the best
+    # scoring sizes are kept. Areas of one colour repeat at every size so
+    # scores are measured from the median, and a signal which is much the
+    # same for every size, such as the edges between tiles of noise, is
+    # ignored.
+    signals = []
+    for values in (repeats, edges):
+        values = numpy.array(values)
+        scores = values - numpy.median(values)
+        if scores.max() > SIGNAL_CONTRAST * numpy.median(numpy.abs(scores)):
+            signals.append(scores)
+
+    candidates = set()
+    for scores in signals or [numpy.array(repeats), numpy.array(edges)]:
+        best = scores.max()
+        close = [size for size, score in zip(sizes, scores) if score >= best * CANDIDATE_SCORE]
+        ranked = [size for score, size in sorted(zip(scores, sizes), key=lambda item: -item[0])]
+        candidates.update(close[:CANDIDATES] + ranked[:CANDIDATES])
+
+    return [(size, best_offset(lines, profile, size)) for size in sorted(candidates)]
+
+def description_bits(packed, tile_width, tile_height, offset_x, offset_y):
+    '''
+        The bits per pixel needed to store the unique tiles plus an index for
+        each cell of the grid, or None if the grid doesn't fit in the image.
+    '''
+    height, width = packed.shape
+    cols, rows = (width - offset_x) // tile_width, (height - offset_y) // tile_height
+    if cols <= 0 or rows <= 0:
+        return None
+
+    region = packed[offset_y:offset_y + rows * tile_height, offset_x:offset_x + cols * tile_width]
+    cells = region.reshape(rows, tile_height, cols, tile_width).swapaxes(1, 2).reshape(rows * cols, -1)
+    unique = count_unique_rows(cells)
+
+    bits = unique * tile_width * tile_height * 32 + rows * cols * max(1, math.log(unique, 2))
+    return bits / float(rows * cols * tile_width * tile_height)
+
+def detect_grid(pixels, tile_width=None, tile_height=None, min_size=DEFAULT_MIN_SIZE, max_size=DEFAULT_MAX_SIZE):
+    '''
+        Returns the (tile_width, tile_height, offset_x, offset_y) of a
+        (height, width, channels) array of pixels, or None if no grid fits. A
+        known tile width or height restricts the search to that size.
+    '''
+    packed = pack_pixels(pixels)
+    columns = axis_candidates(pixels, packed, 1, tile_width or min_size, tile_width or max_size)
+    rows = axis_candidates(pixels, packed, 0, tile_height or min_size, tile_height or max_size)
+
+    # Comparing the grids is the slow part so it's done on a smaller sample,
+    # starting on a multiple of every size so that the offsets still apply.
+    best = None
+    grid_sample = packed[:GRID_SAMPLE_SIZE, :GRID_SAMPLE_SIZE]
+    for width, offset_x in columns:
+        for height, offset_y in rows:
+            bits = description_bits(grid_sample, width, height, offset_x, offset_y)
+            if bits is not None and (best is None or bits < best[0]):
+                best = (bits, width, height, offset_x, offset_y)
+
+    if best is None:
+        return None
+
+    return best[1:]
+
+def detect_image_grid(image_file, tile_width=None, tile_height=None, min_size=DEFAULT_MIN_SIZE, max_size=DEFAULT_MAX_SIZE):
+    '''
+        detect_grid for an image file. Large images are scored on a sample
+        from their centre and the offsets moved back into the whole image.
+    '''
+    im = Image.open(image_file)
+    width, height = im.size
+
+    left, top = max(0, (width - SAMPLE_SIZE) // 2), max(0, (height - SAMPLE_SIZE) // 2)
+    sample = im.crop((left, top, min(width, left + SAMPLE_SIZE), min(height, top + SAMPLE_SIZE)))
+    pixels = numpy.asarray(sample.convert('RGBA' if 'A' in im.mode or 'transparency' in im.info else 'RGB'))
+
+    grid = detect_grid(pixels, tile_width, tile_height, min_size, max_size)
+    if grid is None:
+        return None
+
+    tile_width, tile_height, offset_x, offset_y = grid
+    return tile_width, tile_height, (offset_x + left) % tile_width, (offset_y + top) % tile_height
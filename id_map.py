@@ -0,0 +1,248 @@
+import array
+import collections
+import os
+import struct
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+ID_MAP_TEXT_FILE = 'id_map.txt'
+ID_MAP_BINARY_FILE = 'id_map.bin'
+
+# Id map formats
+TEXT_FORMAT = 'text'
+BINARY_FORMAT = 'binary'
+
+# The binary id map is this header followed by the ids as little endian
+# unsigned integers of item_size bytes, row by row.
+BINARY_MAGIC = b'TMID'
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct('<4sHHIIHH')
+BINARY_ITEM_SIZE = 4
+
+# In memory, id maps are 2d numpy arrays when numpy is available and lists of
+# array.array rows when it isn't, using 2 bytes per cell when every id fits
+# and 4 otherwise.
+SHORT_ID_LIMIT = 2 ** 16
+
+def _numpy_type(num_ids):
+    return numpy.uint16 if num_ids is not None and num_ids <= SHORT_ID_LIMIT else numpy.uint32
+
+def _array_type(num_ids):
+    return 'H' if num_ids is not None and num_ids <= SHORT_ID_LIMIT else 'I'
+
+def new_id_map(width, height, num_ids=None):
+    '''
+        An id map of zeros which can hold ids below num_ids, or any id if
+        num_ids isn't known.
+    '''
+    if numpy:
+        return numpy.zeros((height, width), dtype=_numpy_type(num_ids))
+
+    return [array.array(_array_type(num_ids), [0]) * width for y in range(height)]
+
+def compact_id_map(id_map, num_ids):
+    '''
+        Converts an id map (any sequence of rows of ids) to the smallest
+        type which holds ids below num_ids.
+    '''
+    if numpy:
+        if isinstance(id_map, numpy.ndarray):
+            return numpy.ascontiguousarray(id_map, dtype=_numpy_type(num_ids))
+
+        width = len(id_map[0]) if len(id_map) > 0 else 0
+        return numpy.array(id_map, dtype=_numpy_type(num_ids)).reshape(len(id_map), width)
+
+    typecode = _array_type(num_ids)
+    return [row if isinstance(row, array.array) and row.typecode == typecode else array.array(typecode, row) for row in id_map]
+
+def count_ids(id_map):
+    '''
+        A Counter of the number of cells with each id.
+    '''
+    if numpy and isinstance(id_map, numpy.ndarray):
+        counts = numpy.bincount(id_map.ravel())
+        ids = numpy.flatnonzero(counts)
+        return collections.Counter(dict(zip(ids.tolist(), counts[ids].tolist())))
+
+    counts = collections.Counter()
+    for row in id_map:
+        counts.update(row)
+
+    return counts
+
+class TextIdMapWriter():
+    '''
+        Writes the id map as comma separated ids, one row per line.
+    '''
+
+    def __init__(self, path):
+        self.file = open(path, 'w')
+
+    def write_row(self, row):
+        self.file.write(','.join([str(a) for a in row]) + '\n')
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class BinaryIdMapWriter():
+    '''
+        Writes the id map in the binary format which can be memory mapped
+        when it is loaded.
+    '''
+
+    def __init__(self, path, width, height, tile_width, tile_height):
+        self.file = open(path, 'wb')
+        self.file.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, BINARY_ITEM_SIZE, width, height, tile_width, tile_height))
+
+    def write_row(self, row):
+        row = array.array('I', row)
+        if sys.byteorder != 'little':
+            row.byteswap()
+
+        row.tofile(self.file)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def open_writer(project_dir, format, width, height, tile_width, tile_height):
+    if format == BINARY_FORMAT:
+        return BinaryIdMapWriter(os.path.join(project_dir, ID_MAP_BINARY_FILE), width, height, tile_width, tile_height)
+
+    return TextIdMapWriter(os.path.join(project_dir, ID_MAP_TEXT_FILE))
+
+def write_id_map(project_dir, format, id_map, tile_width, tile_height):
+    width = len(id_map[0]) if len(id_map) > 0 else 0
+    if format == BINARY_FORMAT and numpy and isinstance(id_map, numpy.ndarray):
+        with open(os.path.join(project_dir, ID_MAP_BINARY_FILE), 'wb') as id_map_file:
+            id_map_file.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, BINARY_ITEM_SIZE, width, len(id_map), tile_width, tile_height))
+            numpy.ascontiguousarray(id_map, dtype='<u4').tofile(id_map_file)
+        return
+
+    with open_writer(project_dir, format, width, len(id_map), tile_width, tile_height) as writer:
+        for row in id_map:
+            writer.write_row(row)
+
+def write_cells(project_dir, cells):
+    '''
+        Changes the ids of some cells, cells is a list of (x, y, id). Only
+        the changed ids are written to a binary id map, a text id map has to
+        be rewritten.
+    '''
+    if has_binary_id_map(project_dir):
+        path = os.path.join(project_dir, ID_MAP_BINARY_FILE)
+        width = read_header(path)[0]
+        with open(path, 'rb+') as id_map_file:
+            for x, y, id in sorted(cells, key=lambda cell: (cell[1], cell[0])):
+                id_map_file.seek(BINARY_HEADER.size + (y * width + x) * BINARY_ITEM_SIZE)
+                id_map_file.write(struct.pack('<I', id))
+        return
+
+    rows = [array.array('I', row) for row in iter_rows(project_dir)]
+    for x, y, id in cells:
+        rows[y][x] = id
+
+    write_id_map(project_dir, TEXT_FORMAT, rows, 0, 0)
+
+def read_header(path):
+    '''
+        Returns the (width, height, tile_width, tile_height) of a binary id
+        map or None if the file isn't a binary id map that can be read.
+    '''
+    with open(path, 'rb') as id_map_file:
+        header = id_map_file.read(BINARY_HEADER.size)
+
+    if len(header) != BINARY_HEADER.size:
+        return None
+
+    magic, version, item_size, width, height, tile_width, tile_height = BINARY_HEADER.unpack(header)
+    if magic != BINARY_MAGIC or version != BINARY_VERSION or item_size != BINARY_ITEM_SIZE:
+        return None
+
+    return width, height, tile_width, tile_height
+
+def has_binary_id_map(project_dir):
+    path = os.path.join(project_dir, ID_MAP_BINARY_FILE)
+    return os.path.isfile(path) and read_header(path) is not None
+
+def _load_binary(path):
+    width, height, tile_width, tile_height = read_header(path)
+
+    if numpy:
+        if width * height == 0:
+            return numpy.zeros((height, width), dtype='<u4')
+
+        # A plain array view of the mapping avoids the overhead numpy.memmap
+        # adds to indexing single cells.
+        return numpy.memmap(path, dtype='<u4', mode='r', offset=BINARY_HEADER.size, shape=(height, width)).view(numpy.ndarray)
+
+    id_map = []
+    with open(path, 'rb') as id_map_file:
+        id_map_file.seek(BINARY_HEADER.size)
+        for y in range(height):
+            row = array.array('I')
+            row.fromfile(id_map_file, width)
+            if sys.byteorder != 'little':
+                row.byteswap()
+            id_map.append(row)
+
+    return id_map
+
+def _load_text(path):
+    '''
+        Text id maps are read a row at a time into 4 byte ids and narrowed
+        once the largest id is known.
+    '''
+    rows = []
+    with open(path) as id_map_file:
+        for line in id_map_file:
+            rows.append(array.array('I', [int(x) for x in line.strip().split(",")]))
+
+    num_ids = max(max(row) for row in rows) + 1 if rows and len(rows[0]) > 0 else 0
+    return compact_id_map(rows, num_ids)
+
+def iter_rows(project_dir):
+    '''
+        Yields the rows of the id map one at a time without loading the whole
+        map, from the binary id map if the project has one.
+    '''
+    if has_binary_id_map(project_dir):
+        path = os.path.join(project_dir, ID_MAP_BINARY_FILE)
+        width, height, tile_width, tile_height = read_header(path)
+        with open(path, 'rb') as id_map_file:
+            id_map_file.seek(BINARY_HEADER.size)
+            for y in range(height):
+                row = array.array('I')
+                row.fromfile(id_map_file, width)
+                if sys.byteorder != 'little':
+                    row.byteswap()
+                yield row
+    else:
+        with open(os.path.join(project_dir, ID_MAP_TEXT_FILE)) as id_map_file:
+            for line in id_map_file:
+                yield [int(x) for x in line.strip().split(",")]
+
+def load_id_map(project_dir):
+    '''
+        Loads the binary id map if the project has one, memory mapping it
+        when numpy is available, otherwise falls back to the text id map.
+    '''
+    if has_binary_id_map(project_dir):
+        return _load_binary(os.path.join(project_dir, ID_MAP_BINARY_FILE))
+
+    return _load_text(os.path.join(project_dir, ID_MAP_TEXT_FILE))
@@ -0,0 +1,184 @@
+'''
+    Records changes to a project's output tiles as they are made so that
+    nothing is lost if the editor stops without saving, and so that saving
+    only has to write what changed.
+
+    Each line of the journal is one change:
+        t,<identifier>,<char>,<r>,<g>,<b>   an output tile was added or changed
+        m,<id>,<identifier>                 a tile id was given an output tile
+
+    The char is written as its character code since it may be a comma.
+
+    Every entry sets a value rather than changing it, so replaying an entry
+    which is already in the project files does no harm.
+'''
+import collections
+import os
+import shutil
+import threading
+import time
+import project_files
+
+JOURNAL_FILE = 'journal.txt'
+
+# The journal is moved here while it is compacted into the project files.
+COMPACTING_JOURNAL_FILE = 'journal.old.txt'
+
+# Compact after this many entries or this many seconds since the last
+# compaction, whichever comes first.
+DEFAULT_COMPACT_ENTRIES = 10000
+DEFAULT_COMPACT_SECONDS = 60
+
+OUTPUT_TILE_ENTRY = 't'
+MAPPING_ENTRY = 'm'
+
+def read_entries(path):
+    '''
+        Yields the entries in a journal as lists of fields. A line which was
+        only partly written when the editor stopped is skipped, any other line
+        which isn't an entry raises a ValueError since skipping it would lose
+        a change.
+    '''
+    if not os.path.isfile(path):
+        return
+
+    with open(path) as journal_file:
+        for line_number, line in enumerate(journal_file, 1):
+            if not line.endswith('\n'):
+                continue
+
+            parts = line[:-1].split(',')
+            if (parts[0] == OUTPUT_TILE_ENTRY and len(parts) == 6) or (parts[0] == MAPPING_ENTRY and len(parts) == 3):
+                yield parts
+            else:
+                raise ValueError('Malformed entry on line {0} of {1}'.format(line_number, path))
+
+def replay(path, output_tiles, mapping):
+    '''
+        Applies the entries in the journal at path to output_tiles, a
+        dictionary of identifier to (char, r, g, b), and mapping, a dictionary
+        of tile id to identifier.
+    '''
+    for parts in read_entries(path):
+        if parts[0] == OUTPUT_TILE_ENTRY:
+            output_tiles[parts[1]] = (unichr(int(parts[2])), int(parts[3]), int(parts[4]), int(parts[5]))
+        else:
+            mapping[int(parts[1])] = parts[2]
+
+def load_output_state(project_dir):
+    '''
+        Returns the output tiles as a list of (identifier, char, r, g, b) and
+        the dictionary of tile id to identifier, from the project files with
+        any journal which hasn't been compacted into them replayed on top.
+    '''
+    output_tiles = collections.OrderedDict((identifier, (char, r, g, b)) for identifier, char, r, g, b in project_files.read_output_tiles(project_dir))
+    mapping = project_files.read_output_tile_id_mapping(project_dir)
+
+    # A compacting journal is only left behind if compaction didn't finish,
+    # its entries all come before those in the journal.
+    replay(os.path.join(project_dir, COMPACTING_JOURNAL_FILE), output_tiles, mapping)
+    replay(os.path.join(project_dir, JOURNAL_FILE), output_tiles, mapping)
+
+    return [(identifier,) + appearance for identifier, appearance in output_tiles.iteritems()], mapping
+
+def _remove_partial_line(path):
+    '''
+        Cuts off the last line of the journal if it was only partly written
+        so that the next entry isn't joined to it.
+    '''
+    if not os.path.isfile(path):
+        return
+
+    with open(path, 'rb+') as journal_file:
+        data = journal_file.read()
+        if data and not data.endswith(b'\n'):
+            journal_file.truncate(data.rfind(b'\n') + 1)
+
+class Journal():
+    '''
+        Appends changes to the project's journal as they're made.
+
+        Compacting moves the journal aside, starts a new one and then writes
+        the project files from a snapshot of the project in a background
+        thread. The old journal is only deleted once the project files have
+        been replaced, so if the editor stops part way through loading the
+        project replays it again.
+    '''
+
+    def __init__(self, project_dir, compact_entries=DEFAULT_COMPACT_ENTRIES, compact_seconds=DEFAULT_COMPACT_SECONDS):
+        self.project_dir = project_dir
+        self.path = os.path.join(project_dir, JOURNAL_FILE)
+        self.compacting_path = os.path.join(project_dir, COMPACTING_JOURNAL_FILE)
+        self.compact_entries = compact_entries
+        self.compact_seconds = compact_seconds
+        self.entries = 0
+        self.last_compacted = time.time()
+        self.compaction = None
+
+        _remove_partial_line(self.path)
+        self.file = open(self.path, 'a')
+
+    def record_output_tile(self, identifier, char, r, g, b):
+        self._append('{0},{1},{2},{3},{4},{5}\n'.format(OUTPUT_TILE_ENTRY, identifier, ord(char), r, g, b))
+
+    def record_mapping(self, id, identifier):
+        self._append('{0},{1},{2}\n'.format(MAPPING_ENTRY, id, identifier))
+
+    def _append(self, line):
+        self.file.write(line)
+        self.file.flush()
+        self.entries += 1
+
+    def is_compacting(self):
+        return self.compaction is not None and self.compaction.is_alive()
+
+    def needs_compaction(self):
+        if self.entries == 0 or self.is_compacting():
+            return False
+
+        return self.entries >= self.compact_entries or time.time() - self.last_compacted >= self.compact_seconds
+
+    def compact(self, output_tiles, mapping, background=True):
+        '''
+            Writes the project files from output_tiles, a list of
+            (identifier, char, r, g, b), and mapping, a dictionary of tile id
+            to identifier. These must include every change recorded so far
+            and mustn't be changed afterwards.
+        '''
+        self.wait()
+
+        self.file.close()
+        if os.path.isfile(self.compacting_path):
+            # The last compaction didn't finish so keep its entries, they're
+            # older than the ones in the journal.
+            with open(self.compacting_path, 'a') as compacting_file:
+                with open(self.path) as journal_file:
+                    shutil.copyfileobj(journal_file, compacting_file)
+            os.remove(self.path)
+        else:
+            os.rename(self.path, self.compacting_path)
+
+        self.file = open(self.path, 'a')
+        self.entries = 0
+        self.last_compacted = time.time()
+
+        if background:
+            self.compaction = threading.Thread(target=self._write_project_files, args=(output_tiles, mapping))
+            self.compaction.daemon = True
+            self.compaction.start()
+        else:
+            self._write_project_files(output_tiles, mapping)
+
+    def _write_project_files(self, output_tiles, mapping):
+        project_files.write_output_tiles(self.project_dir, output_tiles)
+        project_files.write_output_tile_id_mapping(self.project_dir, mapping)
+        os.remove(self.compacting_path)
+
+    def wait(self):
+        if self.compaction is not None:
+            self.compaction.join()
+            self.compaction = None
+
+    def close(self):
+        self.wait()
+        self.file.close()
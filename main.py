@@ -1,30 +1,94 @@
 import sys
 import argparse
+import Image
+import exporter
+import extraction_cache
 import extract_tiles
-import tile_to_ascii_map_ui
+import id_map
+import journal
+import project_files
+import project_updater
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Convert an image into ascii by tiles")
-    parser.add_argument("type", choices=["create", "edit"])
+    parser.add_argument("type", choices=["create", "update", "edit", "export", "suggest"])
     parser.add_argument("project_directory")
     parser.add_argument("-f", "--imagefile")
     parser.add_argument("-x", "--tilewidth", type=int)
     parser.add_argument("-y", "--tileheight", type=int)
+    parser.add_argument("-a", "--autodetect", action="store_true")
+    parser.add_argument("--offsetx", type=int)
+    parser.add_argument("--offsety", type=int)
+    parser.add_argument("-e", "--engine", choices=[extract_tiles.NUMPY_ENGINE, extract_tiles.PIL_ENGINE], default=extract_tiles.DEFAULT_ENGINE)
+    parser.add_argument("-t", "--tolerance", type=float)
+    parser.add_argument("-m", "--metric", choices=["rms", "max", "channel", "alpha"])
+    parser.add_argument("--channeltolerances")
+    parser.add_argument("-j", "--jobs", type=int, default=1)
+    parser.add_argument("-s", "--stream", action="store_true")
+    parser.add_argument("--storage", choices=[extract_tiles.ATLAS_STORAGE, extract_tiles.FILES_STORAGE], default=extract_tiles.ATLAS_STORAGE)
+    parser.add_argument("--tilecache", type=int, default=4096)
+    parser.add_argument("--tilecachemb", type=int)
+    parser.add_argument("--format", choices=exporter.FORMATS, default=exporter.TEXT_FORMAT)
+    parser.add_argument("-o", "--output")
+    parser.add_argument("--metricsfile")
+    parser.add_argument("--cachedir", default=extraction_cache.DEFAULT_CACHE_DIR)
+    parser.add_argument("--cachesize", type=int, default=extraction_cache.DEFAULT_MAX_SIZE // (1024 * 1024), help="the most space the cache may use in MB")
+    parser.add_argument("--nocache", action="store_true")
+    parser.add_argument("--idmap", choices=[id_map.BINARY_FORMAT, id_map.TEXT_FORMAT], default=id_map.BINARY_FORMAT)
+    parser.add_argument("--transforms", action="store_true")
     
     args = parser.parse_args()
     if args.type == "create":
         if not args.imagefile:
             print("You must specify an image file to create a new project")
             sys.exit(1)
-        elif not args.tilewidth:
-            print("You must specify a tile width to create a new project")
+        elif args.autodetect and not extract_tiles.numpy:
+            print("Detecting the tile grid requires numpy to be installed")
             sys.exit(1)
-        elif not args.tileheight:
-            print("You must specify a tile height to create a new project")
+        elif not args.tilewidth and not args.autodetect:
+            print("You must specify a tile width (or --autodetect) to create a new project")
+            sys.exit(1)
+        elif not args.tileheight and not args.autodetect:
+            print("You must specify a tile height (or --autodetect) to create a new project")
+            sys.exit(1)
+        elif args.engine == extract_tiles.NUMPY_ENGINE and not extract_tiles.numpy:
+            print("The numpy engine requires numpy to be installed")
+            sys.exit(1)
+        elif args.metric and not extract_tiles.numpy:
+            print("Comparing tiles with a metric requires numpy to be installed")
+            sys.exit(1)
+        elif args.metric == "channel" and not args.channeltolerances:
+            print("You must specify --channeltolerances (e.g. 4,4,8) to use the channel metric")
             sys.exit(1)
         else:
-            creator = extract_tiles.ProjectCreator(args.imagefile, args.project_directory, args.tilewidth, args.tileheight)
+            if args.autodetect:
+                import grid_detect
+
+                grid = grid_detect.detect_image_grid(args.imagefile, args.tilewidth, args.tileheight)
+                if grid is None:
+                    print("No tile grid fits the image")
+                    sys.exit(1)
+
+                args.tilewidth, args.tileheight, args.offsetx, args.offsety = grid
+                print("Detected tiles of width {0} and height {1} starting at ({2}, {3})".format(*grid))
+
+            channel_tolerances = [float(t) for t in args.channeltolerances.split(",")] if args.channeltolerances else None
+            if args.metric == "channel":
+                channels = extract_tiles.tile_similarity.channel_count(Image.open(args.imagefile).mode)
+                if len(channel_tolerances) < channels:
+                    print("The image has {0} channels so --channeltolerances needs {0} values (e.g. 4,4,8,0 for RGBA)".format(channels))
+                    sys.exit(1)
+
+            cache = None if args.nocache else extraction_cache.ExtractionCache(args.cachedir, args.cachesize * 1024 * 1024)
+            creator = extract_tiles.ProjectCreator(args.imagefile, args.project_directory, args.tilewidth, args.tileheight, engine=args.engine, tolerance=args.tolerance, metric=args.metric, channel_tolerances=channel_tolerances, jobs=args.jobs, streaming=args.stream, storage=args.storage, id_map_format=args.idmap, metrics_file=args.metricsfile, offset_x=args.offsetx, offset_y=args.offsety, cache=cache, transforms=args.transforms)
             creator.create()
+    elif args.type == "update":
+        if not args.imagefile:
+            print("You must specify the new image file to update a project")
+            sys.exit(1)
+
+        if project_updater.ProjectUpdater(args.imagefile, args.project_directory).update() is None:
+            sys.exit(1)
     elif args.type == "edit":
         print("Selecting Tiles:")
         print("Left click => Select/Deselect tile")
@@ -38,13 +102,35 @@ if __name__ == "__main__":
         print("m => Map view")
         print("c => Character view")
         print("i => Id view")
+        print("+/- => Zoom in/out")
         print("")
         print("Functions")
         print("r => Grey out known tiles")
         print("u => Find unknown tile")
+        print("s => Select the unknown tiles which look like the selected output tiles")
         print("")
-        
 
+        # Only the editor needs pygame so it isn't imported for the other
+        # modes.
+        import tile_to_ascii_map_ui
+
+        ui = tile_to_ascii_map_ui.TileToAsciiMapUI(args.project_directory, args.tilecache, args.tilecachemb * 1024 * 1024 if args.tilecachemb else None)
+        ui.run()
+    elif args.type == "export":
+        if args.output:
+            with open(args.output, "w") as output_file:
+                exporter.export(args.project_directory, output_file, args.format)
+        else:
+            exporter.export(args.project_directory, sys.stdout, args.format)
+    elif args.type == "suggest":
+        try:
+            import suggest
+        except ImportError:
+            print("Suggesting output tiles requires numpy to be installed")
+            sys.exit(1)
 
-        ui = tile_to_ascii_map_ui.TileToAsciiMapUI(args.project_directory)
-        ui.run()
\ No newline at end of file
+        tile_width, tile_height, image_width_tiles, image_height_tiles = project_files.read_project_file(args.project_directory)
+        output_tiles, mapping = journal.load_output_state(args.project_directory)
+        suggestions = suggest.TileSuggester(args.project_directory, tile_width, tile_height).suggest(mapping)
+        suggest.write_suggestions(args.project_directory, suggestions)
+        print("Suggested output tiles for {0} ids in {1}".format(len(suggestions), suggest.SUGGESTIONS_FILE))
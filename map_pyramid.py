@@ -0,0 +1,278 @@
+'''
+    Draws the map zoomed out from a pyramid of smaller copies of it, so that
+    every zoom level draws at the same speed however large the map is.
+
+    Tiles are halved in size at each zoom level until they are a single
+    pixel, after which each pixel covers 2, 4, 8... tiles. Levels with tiles
+    at least THUMBNAIL_SIZE pixels across are drawn from scaled down tile
+    images, smaller ones from the average colour of each tile.
+
+    The level with a pixel per tile is a single image of the whole map, built
+    once, and the levels below it are halved copies of it. Levels with larger
+    tiles would be too big to keep whole so they are split into chunks which
+    are drawn the first time they're seen and kept until there are more than
+    max_chunks of them. The scaled down tile images are likewise kept until
+    there are more than max_thumbnails of them.
+'''
+import collections
+import math
+import pygame
+import tile_cache
+
+try:
+    import numpy
+    import pygame.surfarray
+except ImportError:
+    numpy = None
+
+# The size in pixels of the chunks the larger levels are split into.
+CHUNK_SIZE = 256
+
+DEFAULT_MAX_CHUNKS = 256
+DEFAULT_MAX_THUMBNAILS = 4096
+
+# Tiles drawn smaller than this are drawn as their average colour.
+THUMBNAIL_SIZE = 4
+
+def zoom_scales(tile_width, tile_height, map_width, map_height, screen_width, screen_height):
+    '''
+        The (width, height) in pixels that a tile is drawn at at each zoom
+        level, from full size down to the first level at which the whole map
+        fits on the screen.
+    '''
+    scales = [(tile_width, tile_height)]
+    level = 1
+
+    while map_width * scales[-1][0] > screen_width or map_height * scales[-1][1] > screen_height:
+        width, height = scales[-1]
+        if width > 1 or height > 1:
+            scales.append((max(1, tile_width >> level), max(1, tile_height >> level)))
+        else:
+            scales.append((width / 2.0, height / 2.0))
+        level += 1
+
+    return scales
+
+def _surface_from_bytes(data, size):
+    if hasattr(pygame.image, 'frombytes'):
+        return pygame.image.frombytes(data, size, 'RGB')
+
+    return pygame.image.fromstring(data, size, 'RGB')
+
+def _scale_down(surface):
+    '''
+        Halves the size of a surface, averaging each 2x2 block of pixels.
+    '''
+    size = (max(1, surface.get_width() // 2), max(1, surface.get_height() // 2))
+    try:
+        return pygame.transform.smoothscale(surface, size)
+    except ValueError:
+        # smoothscale only handles 24 and 32 bit surfaces.
+        return pygame.transform.scale(surface, size)
+
+class MapPyramid():
+    '''
+        colour_of_id returns the (r, g, b) a tile is drawn as when it is
+        smaller than THUMBNAIL_SIZE and tile_image_of_id, if given, the image
+        which is scaled down when it isn't. Without tile images every level
+        is drawn from the colours.
+    '''
+
+    def __init__(self, project, colour_of_id, tile_image_of_id=None, max_chunks=DEFAULT_MAX_CHUNKS, max_thumbnails=DEFAULT_MAX_THUMBNAILS):
+        self.project = project
+        self.colour_of_id = colour_of_id
+        self.tile_image_of_id = tile_image_of_id
+        self.max_chunks = max_chunks
+        self.max_thumbnails = max_thumbnails
+        self.map_width = len(project.id_map[0]) if len(project.id_map) > 0 else 0
+        self.map_height = len(project.id_map)
+        self.colour_image = None
+        self.reduced_images = {}
+        self.chunks = collections.OrderedDict()
+        self.thumbnails = collections.OrderedDict()
+
+    def get_colour_image(self):
+        '''
+            The map with each tile drawn as a single pixel of its colour.
+        '''
+        if self.colour_image is None:
+            colours = dict((id, tuple(self.colour_of_id(id))[:3]) for id in self.project.id_counts)
+
+            if numpy and isinstance(self.project.id_map, numpy.ndarray):
+                lookup = numpy.zeros((max(colours) + 1 if colours else 1, 3), dtype=numpy.uint8)
+                for id, colour in colours.iteritems():
+                    lookup[id] = colour
+
+                self.colour_image = pygame.surfarray.make_surface(lookup[self.project.id_map].swapaxes(0, 1))
+            else:
+                colour_bytes = dict((id, bytearray(colour)) for id, colour in colours.iteritems())
+                self.colour_image = pygame.Surface((max(1, self.map_width), max(1, self.map_height)))
+                for y, row in enumerate(self.project.id_map):
+                    row_bytes = bytes(bytearray().join(colour_bytes[id] for id in row))
+                    self.colour_image.blit(_surface_from_bytes(row_bytes, (self.map_width, 1)), (0, y))
+
+        return self.colour_image
+
+    def get_reduced_image(self, tiles_per_pixel):
+        '''
+            The map with each pixel covering tiles_per_pixel tiles in each
+            direction, made by halving the level above.
+        '''
+        if tiles_per_pixel <= 1:
+            return self.get_colour_image()
+
+        if not tiles_per_pixel in self.reduced_images:
+            self.reduced_images[tiles_per_pixel] = _scale_down(self.get_reduced_image(tiles_per_pixel // 2))
+
+        return self.reduced_images[tiles_per_pixel]
+
+    def chunk_tiles(self, scale):
+        '''
+            The number of tiles across and down a chunk at a scale.
+        '''
+        return max(1, CHUNK_SIZE // scale[0]), max(1, CHUNK_SIZE // scale[1])
+
+    def get_thumbnail(self, id, transform, scale):
+        key = (id, transform, scale)
+        thumbnail = self.thumbnails.get(key)
+        if thumbnail is not None:
+            self.thumbnails[key] = self.thumbnails.pop(key)
+            return thumbnail
+
+        image = tile_cache.transform_surface(self.tile_image_of_id(id), transform)
+        try:
+            thumbnail = pygame.transform.smoothscale(image, scale)
+        except ValueError:
+            thumbnail = pygame.transform.scale(image, scale)
+
+        self.thumbnails[key] = thumbnail
+        while len(self.thumbnails) > self.max_thumbnails:
+            self.thumbnails.popitem(last=False)
+
+        return thumbnail
+
+    def get_chunk(self, scale, chunk_x, chunk_y):
+        key = (scale, chunk_x, chunk_y)
+        chunk = self.chunks.get(key)
+        if chunk is not None:
+            self.chunks[key] = self.chunks.pop(key)
+            return chunk
+
+        chunk_width, chunk_height = self.chunk_tiles(scale)
+        left, top = chunk_x * chunk_width, chunk_y * chunk_height
+        width, height = min(chunk_width, self.map_width - left), min(chunk_height, self.map_height - top)
+
+        if self.tile_image_of_id and scale[0] >= THUMBNAIL_SIZE and scale[1] >= THUMBNAIL_SIZE:
+            chunk = pygame.Surface((width * scale[0], height * scale[1]))
+            for y in range(top, top + height):
+                for x in range(left, left + width):
+                    chunk.blit(self.get_thumbnail(self.project.get_id_at(x, y), self.project.get_transform_at(x, y), scale), ((x - left) * scale[0], (y - top) * scale[1]))
+        else:
+            chunk = pygame.transform.scale(self.get_colour_image().subsurface((left, top, width, height)), (width * scale[0], height * scale[1]))
+
+        self.chunks[key] = chunk
+        while len(self.chunks) > self.max_chunks:
+            self.chunks.popitem(last=False)
+
+        return chunk
+
+    def render(self, surface, scale, leftmost_tile, topmost_tile):
+        '''
+            Draws the map onto surface with each tile scale pixels in size and
+            leftmost_tile, topmost_tile in the top left corner.
+        '''
+        surface.fill((0, 0, 0))
+        if self.map_width == 0 or self.map_height == 0:
+            return
+
+        if scale[0] <= 1 and scale[1] <= 1:
+            tiles_per_pixel = int(round(1 / scale[0]))
+            surface.blit(self.get_reduced_image(tiles_per_pixel), (-(leftmost_tile // tiles_per_pixel), -(topmost_tile // tiles_per_pixel)))
+            return
+
+        chunk_width, chunk_height = self.chunk_tiles(scale)
+        visible_width = int(math.ceil(surface.get_width() / float(scale[0])))
+        visible_height = int(math.ceil(surface.get_height() / float(scale[1])))
+
+        first_x, first_y = max(0, leftmost_tile // chunk_width), max(0, topmost_tile // chunk_height)
+        last_x = min((self.map_width - 1) // chunk_width, (leftmost_tile + visible_width) // chunk_width)
+        last_y = min((self.map_height - 1) // chunk_height, (topmost_tile + visible_height) // chunk_height)
+
+        for chunk_y in range(first_y, last_y + 1):
+            for chunk_x in range(first_x, last_x + 1):
+                surface.blit(self.get_chunk(scale, chunk_x, chunk_y), ((chunk_x * chunk_width - leftmost_tile) * scale[0], (chunk_y * chunk_height - topmost_tile) * scale[1]))
+
+    def invalidate_ids(self, ids):
+        '''
+            Redraws the tiles with these ids, e.g. after their colour has
+            changed. Only the pixels and chunks they appear in are redrawn,
+            and only the pixels of the smaller levels which cover them.
+        '''
+        ids = list(ids)
+        if not ids:
+            return
+
+        if numpy and isinstance(self.project.id_map, numpy.ndarray):
+            positions_of_ids = dict((id, self.project.get_position_arrays_of(id)) for id in ids)
+            xs = numpy.concatenate([id_xs for id_xs, id_ys in positions_of_ids.values()])
+            ys = numpy.concatenate([id_ys for id_xs, id_ys in positions_of_ids.values()])
+            if len(xs) == 0:
+                return
+
+            if self.colour_image is not None:
+                pixels = pygame.surfarray.pixels3d(self.colour_image)
+                for id, (id_xs, id_ys) in positions_of_ids.iteritems():
+                    pixels[id_xs, id_ys] = tuple(self.colour_of_id(id))[:3]
+                del pixels
+
+            box = (int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1)
+            def chunk_positions(chunk_width, chunk_height):
+                columns = -(-self.map_width // chunk_width)
+                return [(key % columns, key // columns) for key in numpy.unique((ys // chunk_height) * columns + xs // chunk_width).tolist()]
+        else:
+            positions_of_ids = dict((id, self.project.get_positions_of(id)) for id in ids)
+            positions = [position for id_positions in positions_of_ids.values() for position in id_positions]
+            if not positions:
+                return
+
+            if self.colour_image is not None:
+                for id, id_positions in positions_of_ids.iteritems():
+                    colour = tuple(self.colour_of_id(id))[:3]
+                    for position in id_positions:
+                        self.colour_image.set_at(position, colour)
+
+            box = (min(x for x, y in positions), min(y for x, y in positions), max(x for x, y in positions) + 1, max(y for x, y in positions) + 1)
+            def chunk_positions(chunk_width, chunk_height):
+                return set((x // chunk_width, y // chunk_height) for x, y in positions)
+
+        self.update_reduced_images(box)
+
+        for scale in set(key[0] for key in self.chunks):
+            for chunk_x, chunk_y in chunk_positions(*self.chunk_tiles(scale)):
+                self.chunks.pop((scale, chunk_x, chunk_y), None)
+
+    def update_reduced_images(self, box):
+        '''
+            Halves again just the part of each smaller level which covers the
+            tiles from (left, top) up to but not including (right, bottom),
+            the box given. Halving a region is only
+            the same as halving the whole level when the level above is an
+            even size, otherwise that level and the ones below it are dropped
+            and halved again in full when they are next needed.
+        '''
+        left, top, right, bottom = box
+        tiles_per_pixel = 2
+        parent = self.colour_image
+
+        while tiles_per_pixel in self.reduced_images:
+            if parent is None or parent.get_width() % 2 or parent.get_height() % 2:
+                for key in [key for key in self.reduced_images if key >= tiles_per_pixel]:
+                    del self.reduced_images[key]
+                return
+
+            image = self.reduced_images[tiles_per_pixel]
+            left, top, right, bottom = left // 2, top // 2, (right + 1) // 2, (bottom + 1) // 2
+            image.blit(_scale_down(parent.subsurface((left * 2, top * 2, (right - left) * 2, (bottom - top) * 2))), (left, top))
+
+            parent = image
+            tiles_per_pixel *= 2
@@ -1,7 +1,6 @@
 import pygame
 from pygame.locals import *
 import re
-from project import OutputTile
 
 VALID_IDENTIFIER_REGEX = re.compile('^[a-zA-Z_]{1,20}$')
 VALID_CHAR_REGEX = re.compile('^.$')
@@ -45,6 +44,7 @@ class OutputTileForm():
         self.identifier = ""
         self.char = ""
         self.color = ""
+        self.saved_output_tile = None
         
         # These surfaces are used to render the form.
         self.surface = pygame.Surface((OUTPUT_TILE_FORM_WIDTH, OUTPUT_TILE_FORM_HEIGHT))
@@ -104,8 +104,12 @@ class OutputTileForm():
         return False
 
     def save_output_tile(self):
+        '''
+            Saving an identifier which already exists changes that output tile
+            so that the tiles already mapped to it pick up the change.
+        '''
         r,g,b = self.text[COLOR_TEXT_BOX].split(",")
-        self.project.output_tiles[self.text[IDENTIFIER_TEXT_BOX]] = OutputTile(self.text[IDENTIFIER_TEXT_BOX], self.text[CHAR_TEXT_BOX], int(r), int(g), int(b))
+        self.saved_output_tile = self.project.add_output_tile(self.text[IDENTIFIER_TEXT_BOX], self.text[CHAR_TEXT_BOX], int(r), int(g), int(b))
 
     def surface_rect(self):
         return ((self.screen.get_width() - self.surface.get_width()) // 2, (self.screen.get_height() - self.surface.get_height()) // 2, OUTPUT_TILE_FORM_WIDTH, OUTPUT_TILE_FORM_HEIGHT)
@@ -0,0 +1,130 @@
+'''
+    Progress and timings of creating a project.
+'''
+import collections
+import contextlib
+import json
+import time
+
+class CreationMetrics():
+    '''
+        Collects the time spent in each phase of creating a project, the rate
+        tiles are processed at, the growth in unique tiles and the number of
+        tile comparisons made.
+
+        If a callback is given it is called with a dictionary describing each
+        event: 'phase_start' and 'phase_end' around each timed phase,
+        'progress' as tiles are processed and 'done' at the end. Every event
+        includes the current summary (see summary).
+    '''
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.start_time = time.time()
+        self.extract_start_time = None
+        self.phases = collections.OrderedDict()
+        self.total_tiles = 0
+        self.tiles_processed = 0
+        self.unique_tiles = 0
+        self.comparisons = None
+        self.unique_growth = []
+
+    def add_time(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        '''
+            Times the body of a with statement as the phase name. A phase can
+            be timed more than once, the times are added together.
+        '''
+        self.emit('phase_start', phase=name)
+        start = time.time()
+        try:
+            yield
+        finally:
+            seconds = time.time() - start
+            self.add_time(name, seconds)
+
+        self.emit('phase_end', phase=name, seconds=seconds)
+
+    def start(self, total_tiles):
+        self.total_tiles = total_tiles
+        self.extract_start_time = time.time()
+
+    def progress(self, tiles_processed, unique_tiles, comparisons=None):
+        self.tiles_processed = tiles_processed
+        self.unique_tiles = unique_tiles
+        self.comparisons = comparisons
+        self.unique_growth.append((tiles_processed, unique_tiles))
+        self.emit('progress')
+
+    def finish(self):
+        self.emit('done')
+
+    def tiles_per_second(self):
+        if self.extract_start_time is None:
+            return None
+
+        elapsed = time.time() - self.extract_start_time
+        return self.tiles_processed / elapsed if elapsed > 0 else None
+
+    def eta(self):
+        '''
+            The estimated number of seconds until every tile is processed.
+        '''
+        rate = self.tiles_per_second()
+        if not rate:
+            return None
+
+        return (self.total_tiles - self.tiles_processed) / rate
+
+    def summary(self):
+        return {
+            'elapsed': time.time() - self.start_time,
+            'total_tiles': self.total_tiles,
+            'tiles_processed': self.tiles_processed,
+            'unique_tiles': self.unique_tiles,
+            'comparisons': self.comparisons,
+            'tiles_per_second': self.tiles_per_second(),
+            'eta': self.eta(),
+        }
+
+    def emit(self, event, **values):
+        if self.callback:
+            values.update(self.summary())
+            values['event'] = event
+            self.callback(values)
+
+    def write(self, path):
+        '''
+            Writes the summary, the time spent in each phase and the unique
+            tile growth as JSON.
+        '''
+        metrics = self.summary()
+        metrics['phases'] = self.phases
+        metrics['unique_growth'] = self.unique_growth
+
+        with open(path, 'w') as metrics_file:
+            json.dump(metrics, metrics_file, indent=2)
+
+def print_progress(event):
+    '''
+        A callback for CreationMetrics which prints progress to the console.
+    '''
+    if event['event'] == 'progress':
+        message = 'Processed {0} of {1} tiles: there are currently {2} unique tiles'.format(event['tiles_processed'], event['total_tiles'], event['unique_tiles'])
+        if event['tiles_per_second']:
+            message += ', {0:.0f} tiles/s'.format(event['tiles_per_second'])
+        if event['eta'] is not None and event['tiles_processed'] < event['total_tiles']:
+            message += ', about {0:.0f}s left'.format(event['eta'])
+
+        print(message)
+    elif event['event'] == 'phase_end':
+        print('{0} took {1:.2f}s'.format(event['phase'], event['seconds']))
+    elif event['event'] == 'done':
+        message = 'Created the project in {0:.2f}s: {1} tiles, {2} unique'.format(event['elapsed'], event['tiles_processed'], event['unique_tiles'])
+        if event['comparisons'] is not None:
+            message += ', {0} tile comparisons'.format(event['comparisons'])
+
+        print(message)
@@ -1,30 +1,167 @@
+import array
 import collections
 import glob
+import heapq
 import pygame
 import os
+import id_map
+import journal
+import project_files
+import tile_cache
+import tile_transforms
 
-class Project():
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-    def __init__(self, tile_width, tile_height, image_width_tiles, image_height_tiles, id_image_mapping, id_map, output_tiles, id_to_output_tile_mapping):
+class Project():
+    '''
+        id_grid is the id map as id_map.load_id_map returns it, a 2d numpy
+        array or a list of array.array rows. transform_map, if the tiles are
+        stored once for each flip and rotation of them, is the transform of
+        each cell as tile_transforms.load_transform_map returns it.
+    '''
+
+    def __init__(self, tile_width, tile_height, image_width_tiles, image_height_tiles, id_image_mapping, id_grid, output_tiles, id_to_output_tile_mapping, transform_map=None):
         self.tile_width = tile_width
         self.tile_height = tile_height
         self.image_width_tiles = image_width_tiles
         self.image_height_tiles = image_height_tiles
         self.id_image_mapping = id_image_mapping
-        self.id_map = id_map
+        self.id_map = id_grid
         self.output_tiles = output_tiles
         self.id_to_output_tile_mapping = id_to_output_tile_mapping
-        self.id_counts = collections.Counter([item for sublist in self.id_map for item in sublist])
+        self.id_counts = id_map.count_ids(self.id_map)
+        self.transform_map = transform_map
+        self.transformed_images = tile_cache.TransformedTileCache(id_image_mapping, id_image_mapping.max_surfaces, id_image_mapping.max_bytes) if transform_map is not None else None
+
+        # Statistics which are kept up to date as output tiles are set rather
+        # than being recalculated each time they are needed.
+        self.num_tiles = sum(self.id_counts.values())
+        self.num_unknown_ids = len([id for id in self.id_image_mapping.keys() if not id in self.id_to_output_tile_mapping])
+        self.num_unknown_tiles = self.num_tiles - sum(self.id_counts[id] for id in self.id_to_output_tile_mapping)
+        self.output_tile_coverage = collections.Counter()
+        for id, tile in self.id_to_output_tile_mapping.iteritems():
+            self.output_tile_coverage[tile] += self.id_counts[id]
+
+        # Indexes which replace scans of the whole map or mapping.
+        self.output_tile_ids = collections.defaultdict(set)
+        for id, tile in self.id_to_output_tile_mapping.iteritems():
+            self.output_tile_ids[tile].add(id)
+
+        # Unknown ids ordered by the number of tiles with that id. Ids which
+        # become known are only removed when they reach the top.
+        self.unknown_id_heap = [(-count, id) for id, count in self.id_counts.iteritems() if not id in self.id_to_output_tile_mapping]
+        heapq.heapify(self.unknown_id_heap)
+
+        # The positions of each id are only indexed the first time they're
+        # needed.
+        self.id_positions = None
+
+        # The average colour of each tile, worked out for all of them the
+        # first time one is needed.
+        self.average_colours = None
+
+        # Changes are recorded in the journal as they're made if there is one.
+        self.journal = None
 
     def get_id_at(self, x, y):
         if len(self.id_map) > 0 and y >=0 and y < len(self.id_map) and x >= 0 and x < len(self.id_map[0]):
-            return self.id_map[y][x]
+            return int(self.id_map[y][x])
         else:
             return None
 
+    def get_ids_in_region(self, left, top, right, bottom):
+        '''
+            The set of ids in the tiles from (left, top) up to but not
+            including (right, bottom), clipped to the map.
+        '''
+        left, top, right, bottom = max(left, 0), max(top, 0), max(right, 0), max(bottom, 0)
+        if numpy and isinstance(self.id_map, numpy.ndarray):
+            return set(numpy.unique(self.id_map[top:bottom, left:right]).tolist())
+
+        ids = set()
+        for row in self.id_map[top:bottom]:
+            ids.update(row[left:right])
+
+        return ids
+
+    def get_id_mask(self, ids, left, top, right, bottom):
+        '''
+            A grid, indexed [y - top][x - left], of whether the tile at each
+            position in the region has one of the ids. Positions outside the
+            map are False.
+        '''
+        width = len(self.id_map[0]) if len(self.id_map) > 0 else 0
+        height = len(self.id_map)
+        clipped_left, clipped_top = max(left, 0), max(top, 0)
+        clipped_right, clipped_bottom = min(max(right, 0), width), min(max(bottom, 0), height)
+
+        if numpy and isinstance(self.id_map, numpy.ndarray):
+            mask = numpy.zeros((max(bottom - top, 0), max(right - left, 0)), dtype=bool)
+            if ids and clipped_right > clipped_left and clipped_bottom > clipped_top:
+                region = self.id_map[clipped_top:clipped_bottom, clipped_left:clipped_right]
+                mask[clipped_top - top:clipped_bottom - top, clipped_left - left:clipped_right - left] = numpy.isin(region, numpy.fromiter(ids, dtype=numpy.int64, count=len(ids)))
+
+            return mask
+
+        ids = set(ids)
+        return [[clipped_left <= x < clipped_right and clipped_top <= y < clipped_bottom and self.id_map[y][x] in ids for x in range(left, right)] for y in range(top, bottom)]
+
+    def get_positions_in_region(self, ids, left, top, right, bottom):
+        '''
+            The (x, y) positions in the region of the tiles with any of the
+            ids.
+        '''
+        mask = self.get_id_mask(ids, left, top, right, bottom)
+        if numpy and isinstance(mask, numpy.ndarray):
+            return [(int(x) + left, int(y) + top) for y, x in numpy.argwhere(mask)]
+
+        return [(x + left, y + top) for y, row in enumerate(mask) for x, masked in enumerate(row) if masked]
+
     def get_image_by_id(self, id):
         return self.id_image_mapping[id]
 
+    def get_average_colour(self, id):
+        '''
+            The (r, g, b) average of the tile's pixels.
+        '''
+        if self.average_colours is None:
+            self.average_colours = self.id_image_mapping.average_colours()
+
+        return self.average_colours[id]
+
+    def get_transform_at(self, x, y):
+        '''
+            The transform (see tile_transforms) which turns the stored image of
+            the tile at x, y into the tile as it appears on the map.
+        '''
+        if self.transform_map is None or self.get_id_at(x, y) is None:
+            return tile_transforms.IDENTITY
+
+        return int(self.transform_map[y][x])
+
+    def get_image_at(self, x, y):
+        '''
+            The image of the tile at x, y the way round it appears on the map.
+        '''
+        id = self.get_id_at(x, y)
+        if id is None:
+            return None
+
+        transform = self.get_transform_at(x, y)
+        if transform == tile_transforms.IDENTITY:
+            return self.get_image_by_id(id)
+
+        return self.transformed_images.get(id, transform)
+
+    def prefetch_images(self, ids):
+        '''
+            Load the images for the ids ahead of them being needed.
+        '''
+        self.id_image_mapping.prefetch(ids)
+
     def get_tile_by_id(self, id):
         if id in self.id_to_output_tile_mapping:
             return self.id_to_output_tile_mapping[id]
@@ -32,137 +169,216 @@ class Project():
             return None
 
     def set_output_tile(self, id, output_tile):
-            self.id_to_output_tile_mapping[id] = output_tile
+        previous_tile = self.get_tile_by_id(id)
 
-    def get_ids_from_output_tile(self, output_tile):
-        ids = []
+        if previous_tile:
+            self.output_tile_coverage[previous_tile] -= self.id_counts[id]
+        else:
+            if id in self.id_image_mapping:
+                self.num_unknown_ids -= 1
+            self.num_unknown_tiles -= self.id_counts[id]
 
-        for id, tile in self.id_to_output_tile_mapping.iteritems():
-            if output_tile == tile:
-                ids.append(id)
+        self.output_tile_coverage[output_tile] += self.id_counts[id]
+        if previous_tile:
+            self.output_tile_ids[previous_tile].discard(id)
+        self.output_tile_ids[output_tile].add(id)
+        self.id_to_output_tile_mapping[id] = output_tile
 
-        return ids
+        if self.journal:
+            self.journal.record_mapping(id, output_tile.identifier)
+
+    def add_output_tile(self, identifier, char, r, g, b):
+        '''
+            Adds an output tile, or changes the appearance of the existing
+            output tile with that identifier so that the tiles already mapped
+            to it pick up the change.
+        '''
+        if identifier in self.output_tiles:
+            self.output_tiles[identifier].set_appearance(char, r, g, b)
+        else:
+            self.output_tiles[identifier] = OutputTile(identifier, char, r, g, b)
+
+        if self.journal:
+            self.journal.record_output_tile(identifier, char, r, g, b)
+
+        return self.output_tiles[identifier]
+
+    def output_state(self):
+        '''
+            A copy of the output tiles as a list of (identifier, char, r, g, b)
+            and of the mapping as a dictionary of tile id to identifier.
+        '''
+        output_tiles = [(tile.identifier, tile.char, tile.r, tile.g, tile.b) for tile in self.output_tiles.values()]
+        mapping = dict((id, tile.identifier) for id, tile in self.id_to_output_tile_mapping.iteritems())
+
+        return output_tiles, mapping
+
+    def get_ids_from_output_tile(self, output_tile):
+        return list(self.output_tile_ids.get(output_tile, ()))
 
     def unknown_id_count(self):
         '''
             Corresponds to the number of ids which don't have a related output tile.
         '''
-        return reduce(lambda x, y: x + 1 if not y in self.id_to_output_tile_mapping else x, self.id_image_mapping.keys(), 0)
+        return self.num_unknown_ids
 
     def unknown_tile_count(self):
         '''
             Corresponds to the number of tiles which have ids that are unknown.
         '''
-        unknown = 0
-        for row in self.id_map:
-            unknown += reduce(lambda x, y: x + 1 if not y in self.id_to_output_tile_mapping else x, row, 0)
+        return self.num_unknown_tiles
 
-        return unknown
+    def get_stats(self):
+        '''
+            Counts of the tiles and ids which do and don't have an output tile.
+        '''
+        num_ids = len(self.id_image_mapping)
+        return {'tiles': self.num_tiles,
+                'mapped_tiles': self.num_tiles - self.num_unknown_tiles,
+                'unmapped_tiles': self.num_unknown_tiles,
+                'ids': num_ids,
+                'mapped_ids': num_ids - self.num_unknown_ids,
+                'unmapped_ids': self.num_unknown_ids}
+
+    def get_output_tile_coverage(self):
+        '''
+            The number of tiles in the map converted to each output tile, by
+            identifier.
+        '''
+        return dict((tile.identifier, count) for tile, count in self.output_tile_coverage.iteritems() if count > 0)
 
     def get_most_unknown_id(self):
         '''
             Retrieve the id of the tile which has the most instances but is also unknown.
         '''
-        for id in self.id_counts:
+        while self.unknown_id_heap:
+            count, id = self.unknown_id_heap[0]
             if not id in self.id_to_output_tile_mapping:
                 return id
 
+            heapq.heappop(self.unknown_id_heap)
+
         return None
 
+    def _index_id_positions(self):
+        '''
+            Builds the index of id to the positions (as y * width + x, in
+            order) of the tiles with that id.
+        '''
+        width = len(self.id_map[0]) if len(self.id_map) > 0 else 0
+
+        if numpy and isinstance(self.id_map, numpy.ndarray):
+            # Sorting the positions by id groups each id's positions together
+            # and each id's positions are a view onto its group.
+            flat = self.id_map.ravel()
+            order = numpy.argsort(flat, kind='mergesort')
+            starts = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(flat))))
+            self.id_positions = dict((int(id), order[starts[id]:starts[id + 1]]) for id in self.id_counts)
+        else:
+            self.id_positions = {}
+            for y, row in enumerate(self.id_map):
+                for x, id in enumerate(row):
+                    self.id_positions.setdefault(id, array.array('L')).append(y * width + x)
+
+        self.id_positions_width = width
+
+    def get_positions_of(self, id):
+        '''
+            All the (x, y) positions at which a given id appears, row by row.
+        '''
+        if self.id_positions is None:
+            self._index_id_positions()
+
+        width = self.id_positions_width
+        return [(int(position) % width, int(position) // width) for position in self.id_positions.get(id, ())]
+
+    def get_position_arrays_of(self, id):
+        '''
+            get_positions_of as a numpy array of the xs and one of the ys, for
+            an id map which is a numpy array.
+        '''
+        if self.id_positions is None:
+            self._index_id_positions()
+
+        positions = numpy.asarray(self.id_positions.get(id, ()), dtype=numpy.intp)
+        return positions % self.id_positions_width, positions // self.id_positions_width
+
     def get_first_instance_of(self, id):
         '''
             Find the first place that a given id appears.
         '''
-        for y in range(0, len(self.id_map)):
-            for x in range(0, len(self.id_map[y])):
-                if self.id_map[y][x] == id:
-                    return x,y
+        if self.id_positions is None:
+            self._index_id_positions()
 
-        return None
+        positions = self.id_positions.get(id, ())
+        if len(positions) == 0:
+            return None
+
+        return int(positions[0]) % self.id_positions_width, int(positions[0]) // self.id_positions_width
 
 def save(project_dir, project):
-    def _save_output_tiles():
-        with open(os.path.join(project_dir, "output_tiles.txt"), "w") as output_tiles_file:
-            for identifier in project.output_tiles:
-                tile = project.output_tiles[identifier]
-                output_tiles_file.write("{0},{1},{2},{3},{4}\n".format(tile.identifier, tile.char, tile.r, tile.g, tile.b))
+    output_tiles, identifiers = project.output_state()
 
-    def _save_output_tile_id_mappings():
-        with open(os.path.join(project_dir, "output_tiles_id_mapping.txt"), "w") as mappings_file:
-            for id in project.id_to_output_tile_mapping:
-                mappings_file.write("{0},{1}\n".format(id, project.id_to_output_tile_mapping[id].identifier))
+    def _save_output_files():
+        '''
+            Compacting the journal writes the output files and empties it.
+        '''
+        if project.journal:
+            project.journal.compact(output_tiles, identifiers, background=False)
+        else:
+            project_files.write_output_tiles(project_dir, output_tiles)
+            project_files.write_output_tile_id_mapping(project_dir, identifiers)
 
     def _save_identifier_map():
         with open(os.path.join(project_dir, "identifier_map.txt"), "w") as map_file:
             for row in project.id_map:
-                map_file.write(",".join(map(lambda id: project.get_tile_by_id(id).identifier if project.get_tile_by_id(id) else "", row)) + "\n")
+                map_file.write(",".join([identifiers.get(id, "") for id in row]) + "\n")
 
-    _save_output_tiles()
-    _save_output_tile_id_mappings()
-    _save_identifier_map()
+    def _save_id_map():
+        '''
+            The ids never change while editing so the id map only needs
+            writing once to move a project with a text id map onto the faster
+            binary format.
+        '''
+        if not id_map.has_binary_id_map(project_dir):
+            id_map.write_id_map(project_dir, id_map.BINARY_FORMAT, project.id_map, project.tile_width, project.tile_height)
 
-def load(project_dir):
-    def _load_project_file():
-        tile_width, tile_height, image_width_tiles, image_height_tiles = 0, 0, 0, 0
-        with open(os.path.join(project_dir, 'tiles.project')) as project_file:
-            for line in project_file:
-                line = line.strip()
-                if line.startswith("tile_width"):
-                    tile_width = int(line.split("=")[1])
-                elif line.startswith("tile_height"):
-                    tile_height = int(line.split("=")[1])
-                elif line.startswith("image_width_tiles"):
-                    image_width_tiles = int(line.split("=")[1])
-                elif line.startswith("image_height_tiles"):
-                    image_height_tiles = int(line.split("=")[1])
-
-        return tile_width, tile_height, image_width_tiles, image_height_tiles
-
-    def _load_id_map():
-        id_map = []
-        with open(os.path.join(project_dir, 'id_map.txt')) as id_map_file:
-            for line in id_map_file:
-                id_map.append([int(x) for x in line.strip().split(",")])
-
-        return id_map
-
-    def _load_image_tiles():
-        image_tiles = {}
-        tiles_dir = os.path.join(project_dir, 'tiles')
-        for tile_file in os.listdir(tiles_dir):
-            if tile_file.endswith(".png"):
-                image_tiles[int(tile_file.replace(".png", ""))] = pygame.image.load(os.path.join(tiles_dir, tile_file))
-
-        return image_tiles
-
-    def _load_output_tiles():
+    _save_output_files()
+    _save_identifier_map()
+    _save_id_map()
+
+def load(project_dir, max_tile_surfaces=tile_cache.DEFAULT_MAX_SURFACES, max_tile_bytes=None):
+    '''
+        Loads the project including any changes in its journal which haven't
+        been compacted into the project files yet.
+    '''
+    def _load_output_tiles(output_tile_list):
         output_tiles = {}
-        with open(os.path.join(project_dir, "output_tiles.txt")) as output_tiles_file:
-            for line in output_tiles_file:
-                parts = line.strip().split(",")
-                output_tiles[parts[0]] = OutputTile(parts[0], parts[1], int(parts[2]), int(parts[3]), int(parts[4]))
+        for identifier, char, r, g, b in output_tile_list:
+            output_tiles[identifier] = OutputTile(identifier, char, r, g, b)
 
         return output_tiles
 
-    def _load_output_tile_id_mapping(output_tiles):
+    def _load_output_tile_id_mapping(output_tiles, identifiers):
         mapping = {}
-        with open(os.path.join(project_dir, "output_tiles_id_mapping.txt")) as mapping_file:
-            for line in mapping_file:
-                idStr, identifier = line.strip().split(",")
-                id = int(idStr)
-                mapping[id] = output_tiles[identifier]                    
+        for id, identifier in identifiers.iteritems():
+            mapping[id] = output_tiles[identifier]
 
         return mapping
 
-    tile_width, tile_height, image_width_tiles, image_height_tiles = _load_project_file()
-    output_tiles = _load_output_tiles()
+    tile_width, tile_height, image_width_tiles, image_height_tiles = project_files.read_project_file(project_dir)
+    output_tile_list, identifiers = journal.load_output_state(project_dir)
+    output_tiles = _load_output_tiles(output_tile_list)
 
-    return Project(tile_width, tile_height, image_width_tiles, image_height_tiles, _load_image_tiles(), _load_id_map(), output_tiles, _load_output_tile_id_mapping(output_tiles))
+    return Project(tile_width, tile_height, image_width_tiles, image_height_tiles, tile_cache.open_tile_cache(project_dir, tile_width, tile_height, max_tile_surfaces, max_tile_bytes), id_map.load_id_map(project_dir), output_tiles, _load_output_tile_id_mapping(output_tiles, identifiers), tile_transforms.load_transform_map(project_dir))
 
 class OutputTile():
 
     def __init__(self, identifier, char, r, g, b):
         self.identifier = identifier
+        self.set_appearance(char, r, g, b)
+
+    def set_appearance(self, char, r, g, b):
         self.char = char
         self.r = r
         self.g = g
@@ -0,0 +1,116 @@
+'''
+    Reads the text files which make up a project. Nothing here depends on
+    pygame so that projects can be read without a display.
+'''
+import os
+
+def read_project_file(project_dir):
+    tile_width, tile_height, image_width_tiles, image_height_tiles = 0, 0, 0, 0
+    with open(os.path.join(project_dir, 'tiles.project')) as project_file:
+        for line in project_file:
+            line = line.strip()
+            if line.startswith("tile_width"):
+                tile_width = int(line.split("=")[1])
+            elif line.startswith("tile_height"):
+                tile_height = int(line.split("=")[1])
+            elif line.startswith("image_width_tiles"):
+                image_width_tiles = int(line.split("=")[1])
+            elif line.startswith("image_height_tiles"):
+                image_height_tiles = int(line.split("=")[1])
+
+    return tile_width, tile_height, image_width_tiles, image_height_tiles
+
+def read_grid_offset(project_dir):
+    '''
+        The (x, y) in the image of the top left of the first tile.
+    '''
+    offset_x, offset_y = 0, 0
+    with open(os.path.join(project_dir, 'tiles.project')) as project_file:
+        for line in project_file:
+            line = line.strip()
+            if line.startswith("offset_x"):
+                offset_x = int(line.split("=")[1])
+            elif line.startswith("offset_y"):
+                offset_y = int(line.split("=")[1])
+
+    return offset_x, offset_y
+
+def read_compare_mode(project_dir):
+    '''
+        Returns the (tolerance, metric, channel tolerances, compare function
+        name) the project's tiles were compared with, each None if it wasn't
+        used.
+    '''
+    tolerance, metric, channel_tolerances, compare = None, None, None, None
+    with open(os.path.join(project_dir, 'tiles.project')) as project_file:
+        for line in project_file:
+            line = line.strip()
+            if line.startswith("tolerance"):
+                tolerance = float(line.split("=")[1])
+            elif line.startswith("metric"):
+                metric = line.split("=")[1]
+            elif line.startswith("channel_tolerances"):
+                channel_tolerances = [float(t) for t in line.split("=")[1].split(",")]
+            elif line.startswith("compare"):
+                compare = line.split("=")[1]
+
+    return tolerance, metric, channel_tolerances, compare
+
+def read_output_tiles(project_dir):
+    '''
+        Returns a list of (identifier, char, r, g, b) for each output tile.
+        The char may itself be a comma or a space so it's whatever is left
+        between the identifier and the colour.
+    '''
+    output_tiles = []
+    with open(os.path.join(project_dir, "output_tiles.txt")) as output_tiles_file:
+        for line in output_tiles_file:
+            identifier, rest = line.rstrip("\r\n").split(",", 1)
+            char, r, g, b = rest.rsplit(",", 3)
+            output_tiles.append((identifier, char, int(r), int(g), int(b)))
+
+    return output_tiles
+
+def read_output_tile_id_mapping(project_dir):
+    '''
+        Returns a dictionary of tile id to output tile identifier.
+    '''
+    mapping = {}
+    with open(os.path.join(project_dir, "output_tiles_id_mapping.txt")) as mapping_file:
+        for line in mapping_file:
+            idStr, identifier = line.strip().split(",")
+            mapping[int(idStr)] = identifier
+
+    return mapping
+
+def _replace(source, destination):
+    try:
+        os.rename(source, destination)
+    except OSError:
+        # Windows won't rename over an existing file.
+        os.remove(destination)
+        os.rename(source, destination)
+
+def _write_lines(path, lines):
+    '''
+        Writes the lines to a temporary file which then replaces the file so
+        that it is never left half written.
+    '''
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w') as temporary_file:
+        for line in lines:
+            temporary_file.write(line)
+
+    _replace(temporary_path, path)
+
+def write_output_tiles(project_dir, output_tiles):
+    '''
+        output_tiles is a list of (identifier, char, r, g, b).
+    '''
+    _write_lines(os.path.join(project_dir, "output_tiles.txt"), ("{0},{1},{2},{3},{4}\n".format(*output_tile) for output_tile in output_tiles))
+
+def write_output_tile_id_mapping(project_dir, mapping):
+    '''
+        mapping is a dictionary of tile id to output tile identifier.
+    '''
+    _write_lines(os.path.join(project_dir, "output_tiles_id_mapping.txt"), ("{0},{1}\n".format(id, identifier) for id, identifier in mapping.iteritems()))
@@ -0,0 +1,254 @@
+'''
+    Brings a project up to date with a new version of its image without
+    losing the output tiles that have been set.
+
+    Each cell of the new image is compared with the stored tile for the id
+    it had. Only the cells which changed are matched against the known tiles,
+    tiles which haven't been seen before get new ids after the existing ones
+    and every other id keeps its number, so the output tile mapping still
+    applies. Tiles are compared the same way, exactly or within a tolerance,
+    as when the project was created.
+'''
+import os
+import time
+import Image
+import extract_tiles
+import id_map
+import journal
+import project_files
+import tile_atlas
+import tile_transforms
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class ProjectUpdater():
+
+    def __init__(self, image_file, project_dir, verbose=True):
+        self.image_file = image_file
+        self.project_dir = project_dir
+        self.verbose = verbose
+        self.tile_width, self.tile_height = project_files.read_project_file(project_dir)[:2]
+        self.offset_x, self.offset_y = project_files.read_grid_offset(project_dir)
+        self.tolerance, self.metric, self.channel_tolerances, self.compare = project_files.read_compare_mode(project_dir)
+
+    def report(self, message):
+        if self.verbose:
+            print(message)
+
+    def load_tiles(self):
+        '''
+            Returns a dictionary of id to the stored image of each tile.
+        '''
+        if tile_atlas.has_atlas(self.project_dir):
+            atlas = Image.open(os.path.join(self.project_dir, tile_atlas.ATLAS_IMAGE_FILE))
+            atlas.load()
+            return dict((id, atlas.crop((x, y, x + self.tile_width, y + self.tile_height))) for id, (x, y) in tile_atlas.read_index(self.project_dir).iteritems())
+
+        tiles_dir = os.path.join(self.project_dir, 'tiles')
+        tiles = {}
+        for tile_file in os.listdir(tiles_dir):
+            if tile_file.endswith('.png'):
+                tile = Image.open(os.path.join(tiles_dir, tile_file))
+                tile.load()
+                tiles[int(tile_file.replace('.png', ''))] = tile
+
+        return tiles
+
+    def read_counts(self):
+        counts = {}
+        with open(os.path.join(self.project_dir, 'counts.csv')) as counts_file:
+            for line in counts_file:
+                id, count = line.split(',')
+                counts[int(id)] = int(count)
+
+        return counts
+
+    def is_exact(self):
+        return self.tolerance is None and self.metric is None
+
+    def create_tile_index(self, tiles):
+        tile_index = extract_tiles.create_tile_index(tolerance=self.tolerance, metric=self.metric, channel_tolerances=self.channel_tolerances)
+        for id in sorted(tiles):
+            tile_index.add(tiles[id], id)
+
+        return tile_index
+
+    def changed_cells(self, im, ids, tiles):
+        '''
+            The (x, y) of every cell which no longer matches the stored tile
+            for its id, column by column. Cells which were merged with a near
+            match when the project was created are only changed if they are
+            no longer within the tolerance of their tile.
+        '''
+        changed = self.different_cells(im, ids, tiles)
+        if self.is_exact() or not changed:
+            return changed
+
+        tile_index = self.create_tile_index(tiles)
+        return [(x, y) for x, y in changed if not tile_index.matches(self.crop(im, x, y), int(ids[y][x]))]
+
+    def different_cells(self, im, ids, tiles):
+        '''
+            The (x, y) of every cell whose pixels aren't exactly the same as
+            the stored tile for its id, column by column.
+        '''
+        rows, cols = len(ids), len(ids[0])
+        changed = []
+
+        if numpy:
+            # A band of tiles at a time is compared with the stored tiles for
+            # that row of the id map.
+            num_ids = max(tiles) + 1
+            example = numpy.asarray(tiles[min(tiles)])
+            stored = numpy.zeros((num_ids,) + example.shape, dtype=example.dtype)
+            for id, tile in tiles.iteritems():
+                stored[id] = numpy.asarray(tile)
+            stored = stored.reshape(num_ids, -1)
+
+            for y in range(rows):
+                top = self.offset_y + y * self.tile_height
+                band = numpy.asarray(im.crop((self.offset_x, top, self.offset_x + cols * self.tile_width, top + self.tile_height)))
+                cells = band.reshape((self.tile_height, cols, self.tile_width) + band.shape[2:]).swapaxes(0, 1).reshape(cols, -1)
+                for x in numpy.flatnonzero((cells != stored[numpy.asarray(ids[y])]).any(axis=1)):
+                    changed.append((int(x), y))
+        else:
+            stored = dict((id, extract_tiles.tile_bytes(tile)) for id, tile in tiles.iteritems())
+            for y in range(rows):
+                for x in range(cols):
+                    if extract_tiles.tile_bytes(self.crop(im, x, y)) != stored[ids[y][x]]:
+                        changed.append((x, y))
+
+        return sorted(changed)
+
+    def crop(self, im, x, y):
+        left, top = self.offset_x + x * self.tile_width, self.offset_y + y * self.tile_height
+        return im.crop((left, top, left + self.tile_width, top + self.tile_height))
+
+    def write_tiles(self, new_tiles):
+        '''
+            Adds the new tiles, a list of (id, image), to the project. The
+            atlas keeps the existing tiles where they are and the new ones are
+            placed in rows below them.
+        '''
+        if not tile_atlas.has_atlas(self.project_dir):
+            for id, tile in new_tiles:
+                tile.save(os.path.join(self.project_dir, 'tiles', '{0}.png'.format(id)))
+            return
+
+        atlas_file = os.path.join(self.project_dir, tile_atlas.ATLAS_IMAGE_FILE)
+        atlas = Image.open(atlas_file)
+        offsets = tile_atlas.read_index(self.project_dir)
+        columns = max(1, atlas.size[0] // self.tile_width)
+        extra_rows = -(-len(new_tiles) // columns)
+
+        new_atlas = Image.new(atlas.mode, (atlas.size[0], atlas.size[1] + extra_rows * self.tile_height))
+        if atlas.mode == 'P':
+            new_atlas.putpalette(atlas.getpalette())
+        new_atlas.paste(atlas, (0, 0))
+
+        for i, (id, tile) in enumerate(new_tiles):
+            offsets[id] = ((i % columns) * self.tile_width, atlas.size[1] + (i // columns) * self.tile_height)
+            new_atlas.paste(tile, offsets[id])
+
+        # A new image doesn't keep the atlas's transparent colour.
+        options = {}
+        if 'transparency' in atlas.info:
+            options['transparency'] = atlas.info['transparency']
+
+        new_atlas.save(atlas_file, **options)
+        tile_atlas.write_index(self.project_dir, [(id, x, y) for id, (x, y) in sorted(offsets.iteritems())])
+
+    def write_identifier_map(self):
+        '''
+            The identifier map is written when the project is saved, it is
+            only rewritten if there is one so that it isn't left out of date.
+        '''
+        path = os.path.join(self.project_dir, 'identifier_map.txt')
+        if not os.path.isfile(path):
+            return
+
+        output_tiles, identifiers = journal.load_output_state(self.project_dir)
+        with open(path, 'w') as map_file:
+            for row in id_map.iter_rows(self.project_dir):
+                map_file.write(",".join([identifiers.get(id, "") for id in row]) + "\n")
+
+    def update(self):
+        '''
+            Returns a dictionary of the number of changed cells, new tiles and
+            ids which are no longer used, or None if the new image can't
+            replace the old one.
+        '''
+        if tile_transforms.has_transform_map(self.project_dir):
+            print('Projects which store flipped and rotated tiles once can\'t be updated, create the project again instead')
+            return None
+        elif self.compare is not None:
+            print('Projects whose tiles were compared with {0} can\'t be updated, create the project again instead'.format(self.compare))
+            return None
+        elif self.metric is not None and not extract_tiles.tile_similarity:
+            print('Updating a project whose tiles were compared with a metric requires numpy to be installed')
+            return None
+
+        start = time.time()
+        ids = id_map.load_id_map(self.project_dir)
+        rows = len(ids)
+        cols = len(ids[0]) if rows > 0 else 0
+
+        im = Image.open(self.image_file)
+        tiles = self.load_tiles()
+        example = tiles[min(tiles)] if tiles else None
+
+        if ((im.size[0] - self.offset_x) // self.tile_width, (im.size[1] - self.offset_y) // self.tile_height) != (cols, rows):
+            print('The new image must have the same number of tiles ({0}x{1}) as the project, create a new project instead'.format(cols, rows))
+            return None
+        elif example is not None and im.mode != example.mode:
+            print('The new image must have the same mode ({0}) as the project\'s tiles'.format(example.mode))
+            return None
+        elif im.mode == 'P' and example is not None and im.getpalette() != example.getpalette():
+            print('The new image must have the same palette as the project\'s tiles')
+            return None
+
+        im.load()
+        changed = self.changed_cells(im, ids, tiles)
+        self.report('{0} of {1} cells have changed'.format(len(changed), rows * cols))
+
+        counts = self.read_counts()
+        tile_index = None
+        next_id = max(tiles) + 1 if tiles else 0
+        new_tiles, cells = [], []
+
+        for x, y in changed:
+            if tile_index is None:
+                # Only built once it's known that something changed.
+                tile_index = self.create_tile_index(tiles)
+
+            tile = self.crop(im, x, y)
+            id = tile_index.find(tile)
+            if id is None:
+                id = next_id
+                next_id += 1
+                tile_index.add(tile, id)
+                new_tiles.append((id, tile))
+
+            old_id = int(ids[y][x])
+            counts[old_id] -= 1
+            counts[id] = counts.get(id, 0) + 1
+            cells.append((x, y, id))
+
+        # The id map is written last so that it never refers to a tile which
+        # hasn't been written.
+        if cells:
+            self.write_tiles(new_tiles)
+            with open(os.path.join(self.project_dir, 'counts.csv'), 'w') as counts_file:
+                for id in sorted(counts):
+                    counts_file.write('{0}, {1}\n'.format(id, counts[id]))
+
+            id_map.write_cells(self.project_dir, cells)
+            self.write_identifier_map()
+
+        unused = len([id for id, count in counts.iteritems() if count == 0])
+        self.report('Added {0} new tiles in {1:.2f}s, {2} ids are no longer used by the map'.format(len(new_tiles), time.time() - start, unused))
+
+        return {'changed_cells': len(changed), 'new_tiles': len(new_tiles), 'unused_ids': unused}
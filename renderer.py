@@ -1,5 +1,6 @@
 import pygame
 import sys
+import map_pyramid
 
 MAP_VIEW = 1
 ID_VIEW = 2
@@ -17,12 +18,62 @@ STATUS_AREA_MARGIN_RIGHT = 10
 STATUS_AREA_MARGIN_TOP = 10
 STATUS_AREA_HEIGHT = 20
 
+# The number of tiles around the visible area whose images are loaded ahead
+# of being scrolled onto the screen.
+PREFETCH_MARGIN = 4
+
+GLYPH_CACHE_SIZE = 4096
+
+# Zoomed out, tiles without an output tile are drawn this colour in the
+# character view.
+UNKNOWN_TILE_COLOR = (60, 60, 60)
+
+class GlyphCache():
+    '''
+        Keeps rendered text keyed by (font, text, color) so that the same
+        label is only rasterised once. The cache is emptied if it grows past
+        max_entries.
+
+        Renderings can be made for an owner, such as an output tile, so that
+        they can all be dropped when its appearance changes whatever it
+        looked like before.
+    '''
+
+    def __init__(self, max_entries=GLYPH_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.surfaces = {}
+        self.owned_keys = {}
+
+    def render(self, font, text, color, owner=None):
+        key = (font, text, tuple(color))
+        surface = self.surfaces.get(key)
+
+        if surface is None:
+            if len(self.surfaces) >= self.max_entries:
+                self.surfaces.clear()
+                self.owned_keys.clear()
+
+            surface = font.render(text, 1, color)
+            self.surfaces[key] = surface
+
+        if owner is not None:
+            self.owned_keys.setdefault(owner, set()).add(key)
+
+        return surface
+
+    def discard_owner(self, owner):
+        '''
+            Drop every rendering made for owner.
+        '''
+        for key in self.owned_keys.pop(owner, ()):
+            self.surfaces.pop(key, None)
+
 class Renderer():
     def __init__(self, game_surface, font, project):
         self.game_surface = game_surface
         self.font = font
-        self.highlighted_ids = []
-        self.highlighted_output_tiles = []
+        self.highlighted_ids = set()
+        self.highlighted_output_tiles = set()
         self.project = project
         
         self.selected_highlight = pygame.Surface((project.tile_width, project.tile_height), flags=pygame.SRCALPHA)
@@ -43,19 +94,46 @@ class Renderer():
         self.leftmost_tile = 0
         self.topmost_tile = 0
         self.highlight_unknown = False
+        self.prefetched_position = None
+        self.viewports = {}
+        self.glyphs = GlyphCache()
+
+        map_width = len(project.id_map[0]) if len(project.id_map) > 0 else 0
+        self.zoom_scales = map_pyramid.zoom_scales(project.tile_width, project.tile_height, map_width, len(project.id_map), game_surface.get_width(), game_surface.get_height())
+        self.zoom = 0
+        self.pyramids = {}
 
     def get_num_tiles_x(self):
-        return self.game_surface.get_width() // self.project.tile_width
+        return int(self.game_surface.get_width() // self.zoom_scales[self.zoom][0])
 
     def get_num_tiles_y(self):
-        return self.game_surface.get_height() // self.project.tile_height
+        return int(self.game_surface.get_height() // self.zoom_scales[self.zoom][1])
+
+    def change_zoom(self, amount):
+        '''
+            Zooms out by amount levels (in if it's negative) keeping the tile
+            in the centre of the display where it is.
+        '''
+        centre_x = self.leftmost_tile + self.get_num_tiles_x() // 2
+        centre_y = self.topmost_tile + self.get_num_tiles_y() // 2
+        self.zoom = min(max(0, self.zoom + amount), len(self.zoom_scales) - 1)
+        self.leftmost_tile = centre_x - self.get_num_tiles_x() // 2
+        self.topmost_tile = centre_y - self.get_num_tiles_y() // 2
+
+    def scroll_step(self):
+        '''
+            The number of tiles to scroll by so that the display moves by
+            about a full sized tile at any zoom level.
+        '''
+        scale = self.zoom_scales[self.zoom]
+        return max(1, int(round(self.project.tile_width / float(scale[0])))), max(1, int(round(self.project.tile_height / float(scale[1]))))
 
     def get_highlighted_ids(self):
-        ids = []
+        ids = set(self.highlighted_ids)
         for output_tile in self.highlighted_output_tiles:
-            ids = ids + self.project.get_ids_from_output_tile(output_tile)
+            ids.update(self.project.get_ids_from_output_tile(output_tile))
 
-        return list(set(ids + self.highlighted_ids))
+        return ids
 
     def num_output_tile_pages(self):
         return len(self.project.output_tiles) // self.num_output_tile_rows
@@ -76,8 +154,9 @@ class Renderer():
         return self.project.get_id_at(x, y)
 
     def screen_to_map_coords(self, screen_x, screen_y):
-        x = self.leftmost_tile + screen_x // self.project.tile_width
-        y = self.topmost_tile + screen_y // self.project.tile_height
+        scale = self.zoom_scales[self.zoom]
+        x = self.leftmost_tile + int(screen_x // scale[0])
+        y = self.topmost_tile + int(screen_y // scale[1])
 
         return x,y
 
@@ -88,8 +167,8 @@ class Renderer():
         return self.game_surface.get_height() - self.tile_surface.get_height() - OUTPUT_TILE_AREA_MARGIN_BOTTOM
 
     def clear_highlighted_ids(self):
-        self.highlighted_ids = []
-        self.highlighted_output_tiles = []
+        self.highlighted_ids = set()
+        self.highlighted_output_tiles = set()
 
     def centre_display_on(self, x, y):
         if len(self.project.id_map) > 0:
@@ -106,67 +185,201 @@ class Renderer():
     def toggle_highlighted_id(self, id, append, remove_if_exists=True):
         if id in self.highlighted_ids:
             if remove_if_exists:
-                self.highlighted_ids.remove(id)
+                self.highlighted_ids.discard(id)
         else:
             if append:
-                self.highlighted_ids.append(id)
+                self.highlighted_ids.add(id)
             else:
-                self.highlighted_output_tiles = []
-                self.highlighted_ids = [id]
+                self.highlighted_output_tiles = set()
+                self.highlighted_ids = set([id])
+
+    def highlight_ids(self, ids):
+        '''
+            Adds the ids to the highlighted ids, leaving any already there.
+        '''
+        self.highlighted_ids.update(ids)
+
+    def highlight_region(self, left, top, right, bottom):
+        '''
+            Adds every id in the tiles from (left, top) up to but not including
+            (right, bottom) to the highlighted ids.
+        '''
+        self.highlight_ids(self.project.get_ids_in_region(left, top, right, bottom))
 
     def toggle_highlighted_output_tile(self, output_tile, append, remove_if_exists=True):
-        ids = self.project.get_ids_from_output_tile(output_tile)
-
-        for id in ids:
-            if id in self.highlighted_ids:
-                self.highlighted_ids.remove(id)
+        self.highlighted_ids.difference_update(self.project.get_ids_from_output_tile(output_tile))
 
         if output_tile in self.highlighted_output_tiles:
             if remove_if_exists:
-                self.highlighted_output_tiles.remove(output_tile)
+                self.highlighted_output_tiles.discard(output_tile)
         else:
             if append:
-                self.highlighted_output_tiles.append(output_tile)
+                self.highlighted_output_tiles.add(output_tile)
+            else:
+                self.highlighted_ids = set()
+                self.highlighted_output_tiles = set([output_tile])
+
+    def prefetch_around_display(self):
+        '''
+            Make sure that the images for the tiles on and just off the screen
+            are loaded. Only needs doing when the display has moved.
+        '''
+        if self.prefetched_position == (self.leftmost_tile, self.topmost_tile):
+            return
+
+        self.prefetched_position = (self.leftmost_tile, self.topmost_tile)
+        visible = self.project.get_ids_in_region(self.leftmost_tile, self.topmost_tile, self.leftmost_tile + self.get_num_tiles_x(), self.topmost_tile + self.get_num_tiles_y())
+        around = self.project.get_ids_in_region(self.leftmost_tile - PREFETCH_MARGIN, self.topmost_tile - PREFETCH_MARGIN,
+                                                self.leftmost_tile + self.get_num_tiles_x() + PREFETCH_MARGIN, self.topmost_tile + self.get_num_tiles_y() + PREFETCH_MARGIN)
+
+        # The tiles on screen come last so that they are the last to be
+        # dropped if the cache can't hold everything.
+        self.project.prefetch_images([id for id in around if not id in visible] + list(visible))
+
+    def invalidate_ids(self, ids):
+        '''
+            Mark the tiles with these ids as needing to be redrawn, e.g. after
+            their output tile has changed.
+        '''
+        for viewport in self.viewports.values():
+            viewport['dirty_ids'].update(ids)
+
+        # Only the character view's colours depend on the output tiles.
+        if CHAR_VIEW in self.pyramids:
+            self.pyramids[CHAR_VIEW].invalidate_ids(ids)
+
+    def get_pyramid(self, view_mode):
+        '''
+            Zoomed out, the map and id views show the tile images and the
+            character view shows the colour of each tile's output tile.
+        '''
+        if view_mode != CHAR_VIEW:
+            view_mode = MAP_VIEW
+
+        if not view_mode in self.pyramids:
+            if view_mode == MAP_VIEW:
+                self.pyramids[view_mode] = map_pyramid.MapPyramid(self.project, self.project.get_average_colour, self.project.get_image_by_id)
             else:
-                self.highlighted_ids = []
-                self.highlighted_output_tiles = [output_tile]
+                self.pyramids[view_mode] = map_pyramid.MapPyramid(self.project, self.output_tile_color)
+
+        return self.pyramids[view_mode]
+
+    def output_tile_color(self, id):
+        output_tile = self.project.get_tile_by_id(id)
+        return (output_tile.r, output_tile.g, output_tile.b) if output_tile else UNKNOWN_TILE_COLOR
+
+    def invalidate_output_tile(self, output_tile):
+        '''
+            Called when an output tile is added or changed so that its old
+            glyphs are dropped and the tiles mapped to it are redrawn.
+        '''
+        self.glyphs.discard_owner(output_tile)
+        self.invalidate_ids(self.project.get_ids_from_output_tile(output_tile))
+
+    def output_tile_label(self, output_tile):
+        return output_tile.identifier + " - " + output_tile.char
+
+    def render_tile(self, surface, view_mode, col, row, highlighted):
+        '''
+            Draw a single tile of the map onto the viewport surface. Drawing is
+            clipped to the tile so that text wider than a tile can't spill
+            onto its neighbours, which may not be redrawn.
+        '''
+        x, y = (col - self.leftmost_tile) * self.project.tile_width, (row - self.topmost_tile) * self.project.tile_height
+        surface.set_clip((x, y, self.project.tile_width, self.project.tile_height))
+        surface.fill((0, 0, 0))
+
+        id = self.project.get_id_at(col, row)
+
+        if id != None:
+            if view_mode == MAP_VIEW:
+                output_image = self.project.get_image_at(col, row)
+
+                surface.blit(output_image, (x, y))
+            elif view_mode == ID_VIEW:
+                surface.blit(self.glyphs.render(self.font, str(id), (255, 255, 255, 0)), (x, y))
+            elif view_mode == CHAR_VIEW:
+                output_tile = self.project.get_tile_by_id(id)
+                char = output_tile.char if output_tile else "?"
+                color = output_tile.color if output_tile else pygame.Color(255, 255, 255, 0)
+
+                surface.blit(self.glyphs.render(self.font, char, color, output_tile), (x, y))
+
+            if highlighted:
+                surface.blit(self.selected_highlight, (x, y))
+
+            if self.highlight_unknown and self.project.get_tile_by_id(id):
+                surface.blit(self.known_highlight, (x, y))
+
+        surface.set_clip(None)
+
+    def render_tiles(self, surface, view_mode, cols, rows, highlight_mask):
+        '''
+            highlight_mask is the project's id mask of the highlighted ids over
+            the whole display.
+        '''
+        for col in cols:
+            for row in rows:
+                self.render_tile(surface, view_mode, col, row, highlight_mask[row - self.topmost_tile][col - self.leftmost_tile])
 
     def render(self, view_mode):
+        '''
+            Each view mode keeps the last frame it drew. When the display
+            scrolls that frame is shifted and only the newly exposed rows and
+            columns are drawn, and only tiles whose highlight or output tile
+            has changed since are redrawn.
+
+            Zoomed out the map is drawn from a map_pyramid.MapPyramid without
+            highlights.
+        '''
+        if self.zoom > 0:
+            self.get_pyramid(view_mode).render(self.game_surface, self.zoom_scales[self.zoom], self.leftmost_tile, self.topmost_tile)
+            return
+
         num_tiles_x = self.get_num_tiles_x()
         num_tiles_y = self.get_num_tiles_y()
         highlighted_ids = self.get_highlighted_ids()
+        cols = range(self.leftmost_tile, self.leftmost_tile + num_tiles_x)
+        rows = range(self.topmost_tile, self.topmost_tile + num_tiles_y)
+        display = (self.leftmost_tile, self.topmost_tile, self.leftmost_tile + num_tiles_x, self.topmost_tile + num_tiles_y)
+        highlight_mask = self.project.get_id_mask(highlighted_ids, *display)
+
+        if view_mode == MAP_VIEW:
+            self.prefetch_around_display()
+
+        viewport = self.viewports.get(view_mode)
+        if viewport:
+            shift_x, shift_y = self.leftmost_tile - viewport['leftmost_tile'], self.topmost_tile - viewport['topmost_tile']
+
+        if (not viewport or viewport['highlight_unknown'] != self.highlight_unknown or
+            abs(shift_x) >= num_tiles_x or abs(shift_y) >= num_tiles_y):
+            surface = pygame.Surface((num_tiles_x * self.project.tile_width, num_tiles_y * self.project.tile_height))
+            self.render_tiles(surface, view_mode, cols, rows, highlight_mask)
+        else:
+            surface = viewport['surface']
 
-        for col in range(self.leftmost_tile, self.leftmost_tile + num_tiles_x):
-            for row in range(self.topmost_tile, self.topmost_tile + num_tiles_y):
-                id = self.project.get_id_at(col, row)
-
-                if id != None:
-                    x, y = (col - self.leftmost_tile) * self.project.tile_width, (row - self.topmost_tile) * self.project.tile_height
-
-                    if view_mode == MAP_VIEW:
-                        output_image = self.project.get_image_by_id(id)
-                        
-                        self.game_surface.blit(output_image, (x, y))
-                    elif view_mode == ID_VIEW:
-                        self.game_surface.blit(self.font.render(str(id), 1, (255, 255, 255, 0)), (x, y))
-                    elif view_mode == CHAR_VIEW:
-                        output_tile = self.project.get_tile_by_id(id)
-                        char = output_tile.char if output_tile else "?"
-                        color = output_tile.color if output_tile else pygame.Color(255, 255, 255, 0)
+            if shift_x or shift_y:
+                surface.scroll(-shift_x * self.project.tile_width, -shift_y * self.project.tile_height)
 
-                        self.game_surface.blit(self.font.render(char, 1, color), (x, y))
+                exposed_cols = cols[num_tiles_x - shift_x:] if shift_x > 0 else cols[:-shift_x]
+                exposed_rows = rows[num_tiles_y - shift_y:] if shift_y > 0 else rows[:-shift_y]
+                self.render_tiles(surface, view_mode, exposed_cols, rows, highlight_mask)
+                self.render_tiles(surface, view_mode, cols, exposed_rows, highlight_mask)
 
-                    if id in highlighted_ids:
-                        self.game_surface.blit(self.selected_highlight, (x, y))
+            changed_ids = (highlighted_ids ^ viewport['highlighted_ids']) | viewport['dirty_ids']
+            if changed_ids:
+                for col, row in self.project.get_positions_in_region(changed_ids, *display):
+                    self.render_tile(surface, view_mode, col, row, highlight_mask[row - self.topmost_tile][col - self.leftmost_tile])
 
-                    if self.highlight_unknown and self.project.get_tile_by_id(id):
-                        self.game_surface.blit(self.known_highlight, (x, y))
+        self.viewports[view_mode] = {'surface':surface, 'leftmost_tile':self.leftmost_tile, 'topmost_tile':self.topmost_tile,
+                                     'highlighted_ids':highlighted_ids, 'highlight_unknown':self.highlight_unknown, 'dirty_ids':set()}
+        self.game_surface.blit(surface, (0, 0))
 
     def render_output_tile_area(self):
         self.tile_surface.fill((250,250,250))
         pygame.draw.rect(self.tile_surface, (50, 50, 50), (0, 0, self.tile_surface.get_width() - 1, self.tile_surface.get_height() - 1), 2)
 
-        self.tile_surface.blit(self.font.render("(" + str(self.output_tile_page + 1) + "/" + str(self.num_output_tile_pages() + 1) + ")", 1, (0, 0 ,0)), (OUTPUT_TILE_AREA_DIMENSIONS[0] - 50, 0))
+        self.tile_surface.blit(self.glyphs.render(self.font, "(" + str(self.output_tile_page + 1) + "/" + str(self.num_output_tile_pages() + 1) + ")", (0, 0 ,0)), (OUTPUT_TILE_AREA_DIMENSIONS[0] - 50, 0))
 
         count = 0
         page_count = 0
@@ -178,7 +391,7 @@ class Renderer():
                 if output_tile.r + output_tile.g + output_tile.b > 382.5:
                     pygame.draw.rect(self.tile_surface, (50, 50, 50), (0, y, self.tile_surface.get_width(), OUTPUT_TILE_AREA_ROW_HEIGHT))
 
-                self.tile_surface.blit(self.font.render(output_tile.identifier + " - " + output_tile.char, 1, output_tile.color), (x, y))
+                self.tile_surface.blit(self.glyphs.render(self.font, self.output_tile_label(output_tile), output_tile.color, output_tile), (x, y))
 
                 if output_tile in self.highlighted_output_tiles:
                     self.tile_surface.blit(self.output_tile_highlighter, (0, OUTPUT_TILE_AREA_PADDING_TOP + page_count * OUTPUT_TILE_AREA_ROW_HEIGHT))
@@ -192,6 +405,8 @@ class Renderer():
         self.status_area_surface.fill((250,250,250,100))
 
         status_string = "Unknown: {0} ({1} ids)".format(self.project.unknown_tile_count(), self.project.unknown_id_count())
+        # The counts change as tiles are mapped so the status isn't worth
+        # caching.
         status_string_surface = self.font.render(status_string, 1, (50, 50, 50))
         self.status_area_surface.blit(status_string_surface, (0, 0))
 
@@ -0,0 +1,135 @@
+'''
+    Suggests an output tile for each tile id that doesn't have one yet, based
+    on the output tile of the most similar looking tile which does.
+'''
+import os
+import Image
+import numpy
+import tile_atlas
+
+# Each tile is described by the mean colour of each cell of a grid this size.
+FEATURE_GRID = 4
+
+# The number of tiles handled in one go, this bounds the memory used.
+BATCH_SIZE = 1024
+
+# Suggestions below this confidence aren't highlighted in the editor.
+DEFAULT_MIN_CONFIDENCE = 0.25
+
+SUGGESTIONS_FILE = 'suggestions.txt'
+
+def _grid_means(pixels, grid_width, grid_height):
+    '''
+        Averages a (n, height, width, 3) batch of tiles over a grid of cells,
+        returning (n, grid_height * grid_width * 3).
+    '''
+    height, width = pixels.shape[1], pixels.shape[2]
+    row_starts = (numpy.arange(grid_height) * height) // grid_height
+    col_starts = (numpy.arange(grid_width) * width) // grid_width
+    row_sizes = numpy.diff(numpy.append(row_starts, height))
+    col_sizes = numpy.diff(numpy.append(col_starts, width))
+
+    sums = numpy.add.reduceat(numpy.add.reduceat(pixels, row_starts, axis=1, dtype=numpy.float32), col_starts, axis=2)
+    means = sums / (row_sizes[:, numpy.newaxis, numpy.newaxis] * col_sizes[numpy.newaxis, :, numpy.newaxis])
+
+    return means.reshape(len(pixels), -1)
+
+def load_tile_features(project_dir, tile_width, tile_height):
+    '''
+        Returns the tile ids and an array of their features, one row per id.
+    '''
+    grid_width, grid_height = min(FEATURE_GRID, tile_width), min(FEATURE_GRID, tile_height)
+
+    if tile_atlas.has_atlas(project_dir):
+        offsets = tile_atlas.read_index(project_dir)
+        ids = sorted(offsets)
+        atlas = numpy.asarray(Image.open(os.path.join(project_dir, tile_atlas.ATLAS_IMAGE_FILE)).convert('RGB'))
+        tile_rows, tile_cols = numpy.arange(tile_height), numpy.arange(tile_width)
+
+        features = []
+        for start in range(0, len(ids), BATCH_SIZE):
+            batch = numpy.array([offsets[id] for id in ids[start:start + BATCH_SIZE]])
+            rows = batch[:, 1, numpy.newaxis] + tile_rows
+            cols = batch[:, 0, numpy.newaxis] + tile_cols
+            features.append(_grid_means(atlas[rows[:, :, numpy.newaxis], cols[:, numpy.newaxis, :]], grid_width, grid_height))
+    else:
+        tiles_dir = os.path.join(project_dir, 'tiles')
+        ids = sorted(int(tile_file.replace('.png', '')) for tile_file in os.listdir(tiles_dir) if tile_file.endswith('.png'))
+
+        features = []
+        for start in range(0, len(ids), BATCH_SIZE):
+            batch = numpy.array([numpy.asarray(Image.open(os.path.join(tiles_dir, '{0}.png'.format(id))).convert('RGB')) for id in ids[start:start + BATCH_SIZE]])
+            features.append(_grid_means(batch, grid_width, grid_height))
+
+    if not features:
+        return ids, numpy.zeros((0, grid_width * grid_height * 3), dtype=numpy.float32)
+
+    return ids, numpy.concatenate(features)
+
+class TileSuggester():
+    '''
+        Suggests output tiles by nearest neighbour over the tile features.
+
+        The confidence of a suggestion compares the distance to the nearest
+        mapped tile (d1) with the distance to the nearest tile mapped to a
+        different output tile (d2) as (d2 - d1) / (d2 + d1). It is 1 for an
+        exact match or when there's only one output tile in use, and 0 when
+        the tile is as close to another output tile.
+    '''
+
+    def __init__(self, project_dir, tile_width, tile_height):
+        self.ids, self.features = load_tile_features(project_dir, tile_width, tile_height)
+        self.squared_norms = (self.features * self.features).sum(axis=1)
+
+    def suggest(self, mapping):
+        '''
+            mapping is a dictionary of id to output tile identifier. Returns
+            a list of (id, identifier, confidence) for every unmapped id.
+        '''
+        mapped = [i for i, id in enumerate(self.ids) if id in mapping]
+        unmapped = [i for i, id in enumerate(self.ids) if not id in mapping]
+        if not mapped or not unmapped:
+            return []
+
+        # Group the mapped tiles by output tile so the nearest tile of each
+        # output tile can be found with a single reduction.
+        identifiers = sorted(set(mapping[self.ids[i]] for i in mapped))
+        labels = dict((identifier, label) for label, identifier in enumerate(identifiers))
+        mapped.sort(key=lambda i: labels[mapping[self.ids[i]]])
+        mapped_labels = numpy.array([labels[mapping[self.ids[i]]] for i in mapped])
+        label_starts = numpy.flatnonzero(numpy.diff(numpy.append(-1, mapped_labels)))
+        scaled_features = -2 * self.features[mapped].T
+        mapped_norms = self.squared_norms[mapped]
+
+        suggestions = []
+        for start in range(0, len(unmapped), BATCH_SIZE):
+            batch = unmapped[start:start + BATCH_SIZE]
+
+            # |a - b|^2 = |a|^2 + |b|^2 - 2a.b for every pair at once. |a|^2 is
+            # the same along each row so it's only added to the minimums.
+            squared = self.features[batch].dot(scaled_features)
+            squared += mapped_norms
+            squared = numpy.minimum.reduceat(squared, label_starts, axis=1) + self.squared_norms[batch][:, numpy.newaxis]
+            label_distances = numpy.sqrt(numpy.maximum(squared, 0))
+
+            nearest_labels = label_distances.argmin(axis=1)
+            if len(identifiers) > 1:
+                closest_two = numpy.partition(label_distances, 1, axis=1)
+                d1, d2 = closest_two[:, 0], closest_two[:, 1]
+                with numpy.errstate(invalid='ignore', divide='ignore'):
+                    confidence = numpy.where(d1 == 0, 1.0, (d2 - d1) / (d2 + d1))
+            else:
+                confidence = numpy.ones(len(batch))
+
+            for i, label, score in zip(batch, nearest_labels, confidence):
+                suggestions.append((self.ids[i], identifiers[label], float(score)))
+
+        return suggestions
+
+def write_suggestions(project_dir, suggestions):
+    '''
+        Writes id,identifier,confidence lines, most confident first.
+    '''
+    with open(os.path.join(project_dir, SUGGESTIONS_FILE), 'w') as suggestions_file:
+        for id, identifier, confidence in sorted(suggestions, key=lambda suggestion: -suggestion[2]):
+            suggestions_file.write('{0},{1},{2:.3f}\n'.format(id, identifier, confidence))
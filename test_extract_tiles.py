@@ -0,0 +1,127 @@
+import os
+import shutil
+import tempfile
+import unittest
+import Image
+import extract_tiles
+import id_map
+import journal
+import tile_atlas
+import tile_cache
+
+TILE_SIZE = 8
+
+class ExtractOverExistingProjectTest(unittest.TestCase):
+    '''
+        Creating a project in a directory which already holds one, keeping
+        the files when asked.
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.image_file = os.path.join(self.directory, 'map.png')
+        self.project_dir = os.path.join(self.directory, 'project')
+
+        im = Image.new('RGB', (4 * TILE_SIZE, 2 * TILE_SIZE))
+        for x in range(4):
+            im.paste((x * 60, 0, 0), (x * TILE_SIZE, 0, (x + 1) * TILE_SIZE, TILE_SIZE))
+        im.save(self.image_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def create(self, **kwargs):
+        extract_tiles.raw_input = lambda prompt: 'n'
+        try:
+            extract_tiles.ProjectCreator(self.image_file, self.project_dir, TILE_SIZE, TILE_SIZE, verbose=False, **kwargs).create()
+        finally:
+            del extract_tiles.raw_input
+
+    def project_file_exists(self, name):
+        return os.path.isfile(os.path.join(self.project_dir, name))
+
+    def test_other_id_map_format_is_removed(self):
+        self.create(id_map_format=id_map.BINARY_FORMAT)
+        self.assertTrue(self.project_file_exists(id_map.ID_MAP_BINARY_FILE))
+
+        self.create(id_map_format=id_map.TEXT_FORMAT)
+        self.assertFalse(self.project_file_exists(id_map.ID_MAP_BINARY_FILE))
+        self.assertTrue(self.project_file_exists(id_map.ID_MAP_TEXT_FILE))
+
+        self.create(id_map_format=id_map.BINARY_FORMAT)
+        self.assertFalse(self.project_file_exists(id_map.ID_MAP_TEXT_FILE))
+
+    def test_atlas_is_removed_when_storing_tile_images(self):
+        self.create(storage=extract_tiles.ATLAS_STORAGE)
+        self.assertTrue(tile_atlas.has_atlas(self.project_dir))
+
+        self.create(storage=extract_tiles.FILES_STORAGE)
+        self.assertFalse(tile_atlas.has_atlas(self.project_dir))
+        self.assertFalse(self.project_file_exists(tile_atlas.ATLAS_IMAGE_FILE))
+        self.assertEqual(sorted(tile_cache.open_tile_cache(self.project_dir, TILE_SIZE, TILE_SIZE).keys()), [0, 1, 2, 3])
+
+    def test_journal_is_removed(self):
+        self.create()
+        project_journal = journal.Journal(self.project_dir)
+        project_journal.record_output_tile('wall', '#', 200, 200, 200)
+        project_journal.record_mapping(0, 'wall')
+        project_journal.close()
+        os.rename(os.path.join(self.project_dir, journal.JOURNAL_FILE), os.path.join(self.project_dir, journal.COMPACTING_JOURNAL_FILE))
+        project_journal = journal.Journal(self.project_dir)
+        project_journal.record_mapping(1, 'wall')
+        project_journal.close()
+
+        self.create()
+        self.assertEqual(journal.load_output_state(self.project_dir), ([], {}))
+
+class ToleranceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.image_file = os.path.join(self.directory, 'map.png')
+
+        im = Image.new('RGB', (4 * TILE_SIZE, 2 * TILE_SIZE))
+        for x in range(4):
+            im.paste((x % 2 * 60, 0, 0), (x * TILE_SIZE, 0, (x + 1) * TILE_SIZE, TILE_SIZE))
+            im.paste((x % 3 * 60, 0, 0), (x * TILE_SIZE, TILE_SIZE, (x + 1) * TILE_SIZE, 2 * TILE_SIZE))
+        im.save(self.image_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def ids(self, **kwargs):
+        project_dir = os.path.join(self.directory, 'project{0}'.format(len(os.listdir(self.directory))))
+        extract_tiles.ProjectCreator(self.image_file, project_dir, TILE_SIZE, TILE_SIZE, verbose=False, **kwargs).create()
+        return [list(row) for row in id_map.iter_rows(project_dir)]
+
+    def test_identical_tiles_are_within_no_tolerance(self):
+        tile = Image.new('RGB', (TILE_SIZE, TILE_SIZE), (10, 20, 30))
+        self.assertTrue(extract_tiles.compare_tiles_expensive(tile, tile.copy(), 0))
+
+    def test_no_tolerance_is_an_exact_match(self):
+        self.assertEqual(self.ids(tolerance=0), self.ids())
+
+class AtlasTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.image_file = os.path.join(self.directory, 'map.png')
+        self.project_dir = os.path.join(self.directory, 'project')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_transparency_is_kept(self):
+        im = Image.new('P', (3 * TILE_SIZE, TILE_SIZE))
+        im.putpalette([0, 0, 0, 255, 0, 0, 0, 255, 0] + [0] * 759)
+        for x in range(3):
+            im.paste(x, (x * TILE_SIZE, 0, (x + 1) * TILE_SIZE, TILE_SIZE))
+        im.save(self.image_file, transparency=0)
+
+        extract_tiles.ProjectCreator(self.image_file, self.project_dir, TILE_SIZE, TILE_SIZE, verbose=False).create()
+        atlas = Image.open(os.path.join(self.project_dir, tile_atlas.ATLAS_IMAGE_FILE))
+        self.assertEqual(atlas.mode, 'P')
+        self.assertEqual(atlas.info.get('transparency'), 0)
+
+if __name__ == '__main__':
+    unittest.main()
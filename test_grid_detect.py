@@ -0,0 +1,47 @@
+import random
+import unittest
+
+try:
+    import numpy
+    import grid_detect
+except ImportError:
+    numpy = None
+
+TILE_SIZE = 8
+
+def make_pixels(cols, rows, seed=1):
+    '''
+        A map of cols x rows tiles, each a block of colour inside a darker
+        border, as a (height, width, channels) array.
+    '''
+    rnd = random.Random(seed)
+    colours = [[rnd.randrange(64, 256) for c in range(3)] for i in range(4)]
+    pixels = numpy.zeros((rows * TILE_SIZE, cols * TILE_SIZE, 3), dtype=numpy.uint8)
+    for y in range(0, rows * TILE_SIZE, TILE_SIZE):
+        for x in range(0, cols * TILE_SIZE, TILE_SIZE):
+            pixels[y:y + TILE_SIZE, x:x + TILE_SIZE] = [c // 4 for c in rnd.choice(colours)]
+            pixels[y + 1:y + TILE_SIZE - 1, x + 1:x + TILE_SIZE - 1] = rnd.choice(colours)
+
+    return pixels
+
+@unittest.skipIf(numpy is None, 'grid detection requires numpy')
+class GridDetectTest(unittest.TestCase):
+
+    def test_no_rows(self):
+        self.assertEqual(grid_detect.count_unique_rows(numpy.zeros((0, TILE_SIZE), dtype=numpy.uint32)), 0)
+
+    def test_offsets_without_a_whole_run_are_skipped(self):
+        lines = grid_detect.pack_pixels(make_pixels(5, 1))
+        self.assertEqual(grid_detect.unique_segments(lines, 39, 2), None)
+
+    def test_small_image(self):
+        # Sizes up to the width of the image are tried, most of whose
+        # offsets leave no room for a single tile.
+        pixels = make_pixels(5, 5)
+        tile_width, tile_height, offset_x, offset_y = grid_detect.detect_grid(pixels)
+        self.assertTrue(offset_x + tile_width <= pixels.shape[1] and offset_y + tile_height <= pixels.shape[0])
+
+        self.assertEqual(grid_detect.detect_grid(pixels, TILE_SIZE, TILE_SIZE), (TILE_SIZE, TILE_SIZE, 0, 0))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import os
+import shutil
+import tempfile
+import unittest
+import journal
+import project_files
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.project_dir = tempfile.mkdtemp()
+        project_files.write_output_tiles(self.project_dir, [('wall', '#', 200, 200, 200)])
+        project_files.write_output_tile_id_mapping(self.project_dir, {0: 'wall'})
+
+    def tearDown(self):
+        shutil.rmtree(self.project_dir)
+
+    def record_fence(self):
+        project_journal = journal.Journal(self.project_dir)
+        project_journal.record_output_tile('fence', ',', 120, 80, 40)
+        project_journal.record_output_tile('floor', ' ', 0, 0, 0)
+        project_journal.record_mapping(1, 'fence')
+        project_journal.record_mapping(2, 'floor')
+        return project_journal
+
+    def test_comma_and_space_chars_are_replayed(self):
+        self.record_fence().close()
+
+        output_tiles, mapping = journal.load_output_state(self.project_dir)
+        self.assertEqual(output_tiles, [('wall', '#', 200, 200, 200), ('fence', ',', 120, 80, 40), ('floor', ' ', 0, 0, 0)])
+        self.assertEqual(mapping, {0: 'wall', 1: 'fence', 2: 'floor'})
+
+    def test_comma_and_space_chars_survive_compaction(self):
+        project_journal = self.record_fence()
+        output_tiles, mapping = journal.load_output_state(self.project_dir)
+        project_journal.compact(output_tiles, mapping, background=False)
+        project_journal.close()
+
+        self.assertEqual(journal.load_output_state(self.project_dir), (output_tiles, mapping))
+
+    def test_partly_written_last_line_is_skipped(self):
+        self.record_fence().close()
+        with open(os.path.join(self.project_dir, journal.JOURNAL_FILE), 'a') as journal_file:
+            journal_file.write('m,3,wa')
+
+        output_tiles, mapping = journal.load_output_state(self.project_dir)
+        self.assertNotIn(3, mapping)
+
+    def test_malformed_line_is_an_error(self):
+        with open(os.path.join(self.project_dir, journal.JOURNAL_FILE), 'w') as journal_file:
+            journal_file.write('t,fence,44,120,80,40\nt,fence,,,120,80,40\nm,1,fence\n')
+
+        self.assertRaises(ValueError, journal.load_output_state, self.project_dir)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import Image
+import extract_tiles
+import id_map
+import project_updater
+import tile_atlas
+
+TILE_SIZE = 8
+
+def make_image(path, cols, rows, uniques, noise=0, seed=1):
+    '''
+        Saves a map of cols x rows tiles drawn from uniques random tiles.
+        With noise each cell has a pixel changed by up to that much, so that
+        the cells only match within a tolerance.
+    '''
+    rnd = random.Random(seed)
+    palette = [[tuple(rnd.randrange(256) for c in range(3)) for p in range(TILE_SIZE * TILE_SIZE)] for u in range(uniques)]
+    im = Image.new('RGB', (cols * TILE_SIZE, rows * TILE_SIZE))
+
+    for x in range(cols):
+        for y in range(rows):
+            pixels = list(palette[rnd.randrange(uniques)])
+            if noise:
+                pixels[0] = tuple(max(0, min(255, c + rnd.randint(-noise, noise))) for c in pixels[0])
+
+            tile = Image.new('RGB', (TILE_SIZE, TILE_SIZE))
+            tile.putdata(pixels)
+            im.paste(tile, (x * TILE_SIZE, y * TILE_SIZE))
+
+    im.save(path)
+
+class ProjectUpdaterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.image_file = os.path.join(self.directory, 'map.png')
+        self.project_dir = os.path.join(self.directory, 'project')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def create(self, **kwargs):
+        extract_tiles.ProjectCreator(self.image_file, self.project_dir, TILE_SIZE, TILE_SIZE, verbose=False, **kwargs).create()
+        return [list(row) for row in id_map.iter_rows(self.project_dir)]
+
+    def update(self, image_file):
+        result = project_updater.ProjectUpdater(image_file, self.project_dir, verbose=False).update()
+        return result, [list(row) for row in id_map.iter_rows(self.project_dir)]
+
+    def assert_unchanged_image_is_a_no_op(self, **kwargs):
+        ids = self.create(**kwargs)
+        with open(os.path.join(self.project_dir, 'counts.csv')) as counts_file:
+            counts = counts_file.read()
+
+        result, updated_ids = self.update(self.image_file)
+
+        self.assertEqual(result, {'changed_cells': 0, 'new_tiles': 0, 'unused_ids': 0})
+        self.assertEqual(updated_ids, ids)
+        with open(os.path.join(self.project_dir, 'counts.csv')) as counts_file:
+            self.assertEqual(counts_file.read(), counts)
+
+    def test_unchanged_image_exact(self):
+        make_image(self.image_file, 12, 10, 6)
+        self.assert_unchanged_image_is_a_no_op()
+
+    def test_unchanged_image_with_tolerance(self):
+        make_image(self.image_file, 12, 10, 6, noise=20)
+        self.assert_unchanged_image_is_a_no_op(tolerance=10)
+
+    def test_unchanged_image_with_metric(self):
+        if not extract_tiles.tile_similarity:
+            self.skipTest('the metrics require numpy')
+
+        make_image(self.image_file, 12, 10, 6, noise=20)
+        self.assert_unchanged_image_is_a_no_op(metric='max', tolerance=20)
+
+    def test_changed_cell_within_tolerance_keeps_its_id(self):
+        make_image(self.image_file, 12, 10, 6, noise=20)
+        ids = self.create(tolerance=10)
+
+        im = Image.open(self.image_file)
+        im.putpixel((TILE_SIZE + 1, 1), tuple(min(255, c + 1) for c in im.getpixel((TILE_SIZE + 1, 1))))
+        changed_file = os.path.join(self.directory, 'changed.png')
+        im.save(changed_file)
+
+        result, updated_ids = self.update(changed_file)
+        self.assertEqual(result['new_tiles'], 0)
+        self.assertEqual(updated_ids, ids)
+
+    def test_new_tile_gets_a_new_id(self):
+        make_image(self.image_file, 12, 10, 6)
+        ids = self.create()
+
+        im = Image.open(self.image_file)
+        im.paste((250, 0, 0), (0, 0, TILE_SIZE, TILE_SIZE))
+        changed_file = os.path.join(self.directory, 'changed.png')
+        im.save(changed_file)
+
+        result, updated_ids = self.update(changed_file)
+        self.assertEqual(result['changed_cells'], 1)
+        self.assertEqual(result['new_tiles'], 1)
+        self.assertEqual(updated_ids[0][0], max(max(row) for row in ids) + 1)
+
+    def test_atlas_keeps_its_transparency(self):
+        im = Image.new('RGB', (3 * TILE_SIZE, TILE_SIZE))
+        for x in range(3):
+            im.paste((x * 100, 0, 0), (x * TILE_SIZE, 0, (x + 1) * TILE_SIZE, TILE_SIZE))
+        im.save(self.image_file, transparency=(0, 0, 0))
+        self.create()
+
+        im.paste((0, 0, 250), (0, 0, TILE_SIZE, TILE_SIZE))
+        changed_file = os.path.join(self.directory, 'changed.png')
+        im.save(changed_file, transparency=(0, 0, 0))
+
+        result, updated_ids = self.update(changed_file)
+        self.assertEqual(result['new_tiles'], 1)
+        atlas = Image.open(os.path.join(self.project_dir, tile_atlas.ATLAS_IMAGE_FILE))
+        self.assertEqual(atlas.info.get('transparency'), (0, 0, 0))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import Image
+import extract_tiles
+import extraction_cache
+import id_map
+import tile_transforms
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def random_tile(rnd, width, height, colours=4):
+    '''
+        A tile of few colours so that some tiles are symmetric and variants
+        often share their first pixels.
+    '''
+    tile = Image.new('RGB', (width, height))
+    tile.putdata([tuple(rnd.randrange(colours) * 60 for c in range(3)) for p in range(width * height)])
+    return tile
+
+def make_map(path, cols, rows, tile_width, tile_height, uniques, seed=1):
+    '''
+        Saves a map of tiles drawn from uniques random tiles, each placed in
+        a random orientation.
+    '''
+    rnd = random.Random(seed)
+    tiles = [random_tile(rnd, tile_width, tile_height, 256) for u in range(uniques)]
+    im = Image.new('RGB', (cols * tile_width, rows * tile_height))
+
+    for x in range(cols):
+        for y in range(rows):
+            transform = rnd.choice(tile_transforms.transforms_for(tile_width, tile_height))
+            im.paste(tile_transforms.transform_image(rnd.choice(tiles), transform), (x * tile_width, y * tile_height))
+
+    im.save(path)
+
+class TransformTest(unittest.TestCase):
+
+    def test_inverse_undoes_every_transform(self):
+        tile = random_tile(random.Random(1), 8, 8, 256)
+        for transform in range(8):
+            turned = tile_transforms.transform_image(tile, transform)
+            self.assertEqual(extract_tiles.tile_bytes(tile_transforms.transform_image(turned, tile_transforms.inverse(transform))), extract_tiles.tile_bytes(tile))
+
+    def test_transforms_are_distinct(self):
+        tile = random_tile(random.Random(1), 8, 8, 256)
+        variants = set(extract_tiles.tile_bytes(tile_transforms.transform_image(tile, transform)) for transform in range(8))
+        self.assertEqual(len(variants), 8)
+
+    def test_every_orientation_has_the_same_canonical_tile(self):
+        rnd = random.Random(2)
+        for width, height in ((8, 8), (8, 6)):
+            tile = random_tile(rnd, width, height)
+            canonical = set()
+            for transform in tile_transforms.transforms_for(width, height):
+                turned = tile_transforms.transform_image(tile, transform)
+                canonical_tile, back = tile_transforms.canonical_image(turned, extract_tiles.tile_bytes)
+                canonical.add(extract_tiles.tile_bytes(canonical_tile))
+                self.assertEqual(extract_tiles.tile_bytes(tile_transforms.transform_image(canonical_tile, back)), extract_tiles.tile_bytes(turned))
+
+            self.assertEqual(len(canonical), 1)
+
+    @unittest.skipIf(numpy is None, 'requires numpy')
+    def test_transform_pixels_matches_transform_image(self):
+        tile = random_tile(random.Random(3), 8, 6, 256)
+        pixels = numpy.asarray(tile)[numpy.newaxis]
+        for transform in range(8):
+            expected = numpy.asarray(tile_transforms.transform_image(tile, transform))
+            self.assertTrue((tile_transforms.transform_pixels(pixels, transform)[0] == expected).all())
+
+    @unittest.skipIf(numpy is None, 'requires numpy')
+    def test_canonical_pixels_matches_canonical_image(self):
+        rnd = random.Random(4)
+        for width, height in ((8, 8), (8, 6)):
+            tiles = [random_tile(rnd, width, height) for i in range(200)]
+            canonical, applied = tile_transforms.canonical_pixels(numpy.array([numpy.asarray(tile) for tile in tiles]))
+
+            for tile, canonical_data, transform in zip(tiles, canonical, applied):
+                canonical_tile, back = tile_transforms.canonical_image(tile, extract_tiles.tile_bytes)
+                self.assertEqual(canonical_data.tobytes(), extract_tiles.tile_bytes(canonical_tile))
+                self.assertEqual(tile_transforms.inverse(int(transform)), back)
+
+class TransformProjectTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.image_file = os.path.join(self.directory, 'map.png')
+        make_map(self.image_file, 20, 15, 8, 8, 6)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def create(self, name, **kwargs):
+        project_dir = os.path.join(self.directory, name)
+        extract_tiles.ProjectCreator(self.image_file, project_dir, 8, 8, verbose=False, **kwargs).create()
+
+        ids = [list(row) for row in id_map.iter_rows(project_dir)]
+        transform_map = tile_transforms.load_transform_map(project_dir)
+        transforms = [list(row) for row in transform_map] if transform_map is not None else None
+
+        return project_dir, ids, transforms
+
+    def test_engines_agree(self):
+        project_dir, ids, transforms = self.create('pil', engine=extract_tiles.PIL_ENGINE, transforms=True)
+        self.assertEqual(len(set(id for row in ids for id in row)), 6)
+
+        engines = [dict(jobs=2, engine=extract_tiles.PIL_ENGINE)]
+        if numpy:
+            engines += [dict(engine=extract_tiles.NUMPY_ENGINE), dict(jobs=2, engine=extract_tiles.NUMPY_ENGINE)]
+
+        for i, kwargs in enumerate(engines):
+            other_dir, other_ids, other_transforms = self.create('engine{0}'.format(i), transforms=True, **kwargs)
+            self.assertEqual(other_ids, ids)
+            self.assertEqual(other_transforms, transforms)
+
+    def test_stale_transform_map_is_removed(self):
+        cache = extraction_cache.ExtractionCache(os.path.join(self.directory, 'cache'))
+        self.create('cached', cache=cache)
+        project_dir, ids, transforms = self.create('project', transforms=True)
+
+        # Keep the existing directory rather than emptying it, the project is
+        # then restored from the cache.
+        extract_tiles.raw_input = lambda prompt: 'n'
+        try:
+            project_dir, ids, transforms = self.create('project', cache=cache)
+        finally:
+            del extract_tiles.raw_input
+
+        self.assertIsNone(transforms)
+
+if __name__ == '__main__':
+    unittest.main()
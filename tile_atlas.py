@@ -0,0 +1,41 @@
+import math
+import os
+
+ATLAS_IMAGE_FILE = 'tiles_atlas.png'
+ATLAS_INDEX_FILE = 'tiles_atlas.txt'
+
+def has_atlas(project_dir):
+    return os.path.isfile(os.path.join(project_dir, ATLAS_INDEX_FILE))
+
+def atlas_layout(num_tiles, tile_width, tile_height):
+    '''
+        Lays the tiles out in a roughly square grid in id order. Returns the
+        size of the atlas and the top left of each tile in it.
+    '''
+    columns = max(1, int(math.ceil(math.sqrt(num_tiles))))
+    rows = max(1, -(-num_tiles // columns))
+    offsets = [((i % columns) * tile_width, (i // columns) * tile_height) for i in range(num_tiles)]
+
+    return (columns * tile_width, rows * tile_height), offsets
+
+def write_index(project_dir, offsets):
+    '''
+        Writes the position of each tile in the atlas, offsets is a list of
+        (id, x, y).
+    '''
+    with open(os.path.join(project_dir, ATLAS_INDEX_FILE), 'w') as index_file:
+        for id, x, y in offsets:
+            index_file.write('{0},{1},{2}\n'.format(id, x, y))
+
+def read_index(project_dir):
+    '''
+        Returns a dictionary of tile id to the top left of the tile in the
+        atlas.
+    '''
+    offsets = {}
+    with open(os.path.join(project_dir, ATLAS_INDEX_FILE)) as index_file:
+        for line in index_file:
+            id, x, y = line.strip().split(',')
+            offsets[int(id)] = (int(x), int(y))
+
+    return offsets
@@ -0,0 +1,256 @@
+import collections
+import os
+import tempfile
+import pygame
+import tile_atlas
+
+try:
+    import numpy
+    import pygame.surfarray
+except ImportError:
+    numpy = None
+
+DEFAULT_MAX_SURFACES = 4096
+
+# The atlas is copied out this many rows of pixels at a time.
+ATLAS_BAND_HEIGHT = 256
+
+def _surface_from_bytes(data, size, format):
+    if hasattr(pygame.image, 'frombytes'):
+        return pygame.image.frombytes(data, size, format)
+
+    return pygame.image.fromstring(data, size, format)
+
+def _surface_to_bytes(surface, format):
+    if hasattr(pygame.image, 'tobytes'):
+        return pygame.image.tobytes(surface, format)
+
+    return pygame.image.tostring(surface, format)
+
+def surface_size(surface):
+    '''
+        The number of bytes a surface's pixels take.
+    '''
+    return surface.get_width() * surface.get_height() * surface.get_bytesize()
+
+class FileTileLoader():
+    '''
+        Loads tiles stored as one image per tile in the tiles directory.
+    '''
+
+    def __init__(self, project_dir):
+        self.tiles_dir = os.path.join(project_dir, 'tiles')
+
+    def ids(self):
+        return [int(tile_file.replace(".png", "")) for tile_file in os.listdir(self.tiles_dir) if tile_file.endswith(".png")]
+
+    def load(self, id):
+        return pygame.image.load(os.path.join(self.tiles_dir, '{0}.png'.format(id)))
+
+    def average_colours(self):
+        '''
+            A dictionary of tile id to the (r, g, b) average of its pixels.
+        '''
+        return dict((id, tuple(pygame.transform.average_color(self.load(id)))[:3]) for id in self.ids())
+
+class AtlasTileLoader():
+    '''
+        Loads tiles from the tile atlas. The atlas can't be decoded a piece at
+        a time, so the first time a tile is needed it is decoded once and
+        written uncompressed to a temporary file. Each tile is then read from
+        its rows of that file into a surface of its own, so that dropping a
+        tile from the cache frees it and the decoded atlas isn't kept in
+        memory.
+    '''
+
+    def __init__(self, project_dir, tile_width, tile_height):
+        self.project_dir = project_dir
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.offsets = tile_atlas.read_index(project_dir)
+        self.pixels = None
+        self.format = 'RGB'
+        self.stride = 0
+
+    def ids(self):
+        return self.offsets.keys()
+
+    def decode_atlas(self):
+        atlas = pygame.image.load(os.path.join(self.project_dir, tile_atlas.ATLAS_IMAGE_FILE))
+        width, height = atlas.get_size()
+
+        # Transparency, either an alpha channel or a transparent palette
+        # entry, is kept by storing the pixels as RGBA.
+        if atlas.get_flags() & pygame.SRCALPHA or atlas.get_colorkey() is not None:
+            self.format = 'RGBA'
+
+        self.pixels = tempfile.TemporaryFile()
+        self.stride = width * len(self.format)
+        for top in range(0, height, ATLAS_BAND_HEIGHT):
+            band = atlas.subsurface((0, top, width, min(ATLAS_BAND_HEIGHT, height - top)))
+            self.pixels.write(_surface_to_bytes(band, self.format))
+
+    def load(self, id):
+        if self.pixels is None:
+            self.decode_atlas()
+
+        x, y = self.offsets[id]
+        pixel_bytes = len(self.format)
+        rows = []
+        for row in range(y, y + self.tile_height):
+            self.pixels.seek(row * self.stride + x * pixel_bytes)
+            rows.append(self.pixels.read(self.tile_width * pixel_bytes))
+
+        return _surface_from_bytes(b''.join(rows), (self.tile_width, self.tile_height), self.format)
+
+    def average_colours(self):
+        '''
+            A dictionary of tile id to the (r, g, b) average of its pixels,
+            worked out from the atlas in one pass rather than tile by tile.
+        '''
+        atlas = pygame.image.load(os.path.join(self.project_dir, tile_atlas.ATLAS_IMAGE_FILE))
+        if not numpy:
+            return dict((id, tuple(pygame.transform.average_color(atlas, (x, y, self.tile_width, self.tile_height)))[:3]) for id, (x, y) in self.offsets.iteritems())
+
+        # The tiles are laid out in a grid (see tile_atlas.atlas_layout) so
+        # a band of rows of tiles at a time is summed by grid cell.
+        columns, rows = atlas.get_width() // self.tile_width, atlas.get_height() // self.tile_height
+        band_rows = max(1, ATLAS_BAND_HEIGHT // self.tile_height)
+        averages = numpy.zeros((rows, columns, 3), dtype=numpy.uint64)
+        for top in range(0, rows, band_rows):
+            band = min(band_rows, rows - top)
+            pixels = pygame.surfarray.array3d(atlas.subsurface((0, top * self.tile_height, columns * self.tile_width, band * self.tile_height)))
+            sums = pixels.reshape(columns, self.tile_width, band, self.tile_height, 3).sum(axis=(1, 3), dtype=numpy.uint64)
+            averages[top:top + band] = sums.swapaxes(0, 1) // (self.tile_width * self.tile_height)
+
+        ids = list(self.offsets.keys())
+        xs = numpy.array([self.offsets[id][0] // self.tile_width for id in ids], dtype=numpy.intp)
+        ys = numpy.array([self.offsets[id][1] // self.tile_height for id in ids], dtype=numpy.intp)
+        return dict(zip(ids, (tuple(colour) for colour in averages[ys, xs].tolist())))
+
+class TileSurfaceCache():
+    '''
+        A dictionary of tile id to surface which loads surfaces when they are
+        first asked for and drops the least recently used ones once there are
+        more than max_surfaces of them or they take more than max_bytes.
+
+        The ids of all the tiles are known up front so the cache can be
+        iterated and queried without loading anything.
+    '''
+
+    def __init__(self, loader, max_surfaces=DEFAULT_MAX_SURFACES, max_bytes=None):
+        self.loader = loader
+        self.ids = set(loader.ids())
+        self.max_surfaces = max_surfaces
+        self.max_bytes = max_bytes
+        self.surfaces = collections.OrderedDict()
+        self.bytes = 0
+
+    def __getitem__(self, id):
+        if id in self.surfaces:
+            # Move the surface to the most recently used end.
+            surface = self.surfaces.pop(id)
+            self.surfaces[id] = surface
+            return surface
+        elif id not in self.ids:
+            raise KeyError(id)
+
+        surface = self.loader.load(id)
+        self.surfaces[id] = surface
+        self.bytes += surface_size(surface)
+        self._evict()
+
+        return surface
+
+    def __contains__(self, id):
+        return id in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def keys(self):
+        return list(self.ids)
+
+    def average_colours(self):
+        '''
+            A dictionary of tile id to the (r, g, b) average of the tile,
+            read without loading the tiles into the cache.
+        '''
+        return self.loader.average_colours()
+
+    def prefetch(self, ids):
+        '''
+            Load any of the tiles which aren't already loaded and mark them
+            all as used, in order, so the last ids are the last to be dropped.
+            At most max_surfaces tiles, the last ones, are prefetched so that
+            prefetching can't drop the tiles it has just loaded.
+        '''
+        ids = list(ids)
+        if self.max_surfaces:
+            ids = ids[-self.max_surfaces:]
+
+        for id in ids:
+            if id in self.ids:
+                self[id]
+
+    def _evict(self):
+        while len(self.surfaces) > 1 and ((self.max_surfaces and len(self.surfaces) > self.max_surfaces) or (self.max_bytes and self.bytes > self.max_bytes)):
+            id, surface = self.surfaces.popitem(last=False)
+            self.bytes -= surface_size(surface)
+
+def transform_surface(surface, transform):
+    '''
+        tile_transforms.transform_image for a surface.
+    '''
+    if transform >= 4:
+        surface = pygame.transform.flip(surface, True, False)
+    if transform % 4:
+        surface = pygame.transform.rotate(surface, 90 * (transform % 4))
+
+    return surface
+
+class TransformedTileCache():
+    '''
+        Surfaces of tiles flipped or rotated into the orientations they
+        appear in on the map, keyed by (id, transform). They are made from the
+        tile surfaces when first asked for and, like TileSurfaceCache, the
+        least recently used are dropped once there are more than max_surfaces
+        of them or they take more than max_bytes.
+    '''
+
+    def __init__(self, tiles, max_surfaces=DEFAULT_MAX_SURFACES, max_bytes=None):
+        self.tiles = tiles
+        self.max_surfaces = max_surfaces
+        self.max_bytes = max_bytes
+        self.surfaces = collections.OrderedDict()
+        self.bytes = 0
+
+    def get(self, id, transform):
+        key = (id, transform)
+        if key in self.surfaces:
+            surface = self.surfaces.pop(key)
+            self.surfaces[key] = surface
+            return surface
+
+        surface = transform_surface(self.tiles[id], transform)
+        self.surfaces[key] = surface
+        self.bytes += surface_size(surface)
+        self._evict()
+
+        return surface
+
+    def _evict(self):
+        while len(self.surfaces) > 1 and ((self.max_surfaces and len(self.surfaces) > self.max_surfaces) or (self.max_bytes and self.bytes > self.max_bytes)):
+            key, surface = self.surfaces.popitem(last=False)
+            self.bytes -= surface_size(surface)
+
+def open_tile_cache(project_dir, tile_width, tile_height, max_surfaces=DEFAULT_MAX_SURFACES, max_bytes=None):
+    if tile_atlas.has_atlas(project_dir):
+        loader = AtlasTileLoader(project_dir, tile_width, tile_height)
+    else:
+        loader = FileTileLoader(project_dir)
+
+    return TileSurfaceCache(loader, max_surfaces, max_bytes)
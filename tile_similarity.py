@@ -0,0 +1,128 @@
+import numpy
+
+# Metrics
+RMS_METRIC = 'rms'
+MAX_METRIC = 'max'
+CHANNEL_METRIC = 'channel'
+ALPHA_METRIC = 'alpha'
+METRICS = [RMS_METRIC, MAX_METRIC, CHANNEL_METRIC, ALPHA_METRIC]
+
+# Squared distances within this fraction of the tiles' squared norms are
+# rounding error.
+ROUNDING_ERROR = 1e-13
+
+def channel_count(mode):
+    '''
+        The number of channels tiles of an image mode are compared on, see
+        SimilarityEngine.tile_vector.
+    '''
+    return {'L': 1, 'RGB': 3, 'RGBA': 4}.get(mode, 3)
+
+class SimilarityEngine():
+    '''
+        Holds the pixels of every candidate tile in a single array so that a
+        tile can be scored against all of them in one vectorised operation.
+
+        The metrics are:
+        - rms: the same distance as compare_tiles_expensive, the root of the
+          summed squared band differences divided by the number of pixels.
+        - max: the largest difference in any band of any pixel.
+        - channel: the largest difference in each band divided by the
+          tolerance for that band, so anything up to 1 is within tolerance.
+        - alpha: rms on premultiplied RGBA so that differences in the colour
+          of transparent pixels are ignored.
+    '''
+
+    def __init__(self, metric=RMS_METRIC, channel_tolerances=None):
+        if metric == CHANNEL_METRIC and not channel_tolerances:
+            raise ValueError('The channel metric requires a tolerance for each channel')
+
+        self.metric = metric
+        self.channel_tolerances = numpy.array(channel_tolerances, dtype=numpy.float64) if channel_tolerances else None
+        self.vectors = None
+        self.squared_norms = None
+        self.size = 0
+
+    def tile_vector(self, tile):
+        '''
+            Converts a PIL image into a (pixels, channels) array for this
+            metric. Palette and other modes are compared on their colours.
+        '''
+        if self.metric == ALPHA_METRIC:
+            pixels = numpy.asarray(tile.convert('RGBA'), dtype=numpy.float64).reshape(-1, 4)
+            pixels[:, :3] *= pixels[:, 3:] / 255.0
+            return pixels
+        elif tile.mode not in ('L', 'RGB', 'RGBA'):
+            tile = tile.convert('RGB')
+
+        pixels = numpy.asarray(tile, dtype=numpy.float64)
+        return pixels.reshape(pixels.shape[0] * pixels.shape[1], -1)
+
+    def add(self, vector):
+        '''
+            Add a candidate, returning its index. Storage grows by doubling so
+            that adding n candidates costs O(n) copies.
+        '''
+        if self.vectors is None:
+            self.vectors = numpy.empty((16,) + vector.shape, dtype=numpy.float64)
+            self.squared_norms = numpy.empty(16, dtype=numpy.float64)
+        elif self.size == len(self.vectors):
+            self.vectors = numpy.concatenate((self.vectors, numpy.empty_like(self.vectors)))
+            self.squared_norms = numpy.concatenate((self.squared_norms, numpy.empty_like(self.squared_norms)))
+
+        self.vectors[self.size] = vector
+        self.squared_norms[self.size] = (vector * vector).sum()
+        self.size += 1
+
+        return self.size - 1
+
+    def distances(self, vector, candidates=None):
+        '''
+            The distance from the vector to every candidate (or to the
+            candidates with the given indices).
+        '''
+        if candidates is None:
+            candidates = slice(0, self.size)
+
+        stored = self.vectors[candidates]
+
+        if self.metric == RMS_METRIC or self.metric == ALPHA_METRIC:
+            # |a - b|^2 = |a|^2 + |b|^2 - 2a.b avoids building the difference
+            # of every candidate.
+            # Rounding leaves identical tiles a tiny distance apart, which
+            # would reject them at a tolerance of 0.
+            flat = stored.reshape(len(stored), -1)
+            norms = self.squared_norms[candidates] + (vector * vector).sum()
+            squared = norms - 2 * flat.dot(vector.ravel())
+            squared[squared <= ROUNDING_ERROR * norms] = 0
+            return numpy.sqrt(squared / vector.shape[0])
+
+        difference = numpy.abs(stored - vector)
+        if self.metric == MAX_METRIC:
+            return difference.reshape(len(stored), -1).max(axis=1)
+        elif self.metric == CHANNEL_METRIC:
+            if len(self.channel_tolerances) < vector.shape[1]:
+                raise ValueError('The channel metric needs a tolerance for each of the {0} channels, {1} were given'.format(vector.shape[1], len(self.channel_tolerances)))
+
+            return (difference.max(axis=1) / self.channel_tolerances[:vector.shape[1]]).max(axis=1)
+
+        raise ValueError('Unknown metric {0}'.format(self.metric))
+
+    def best_match(self, vector, candidates=None):
+        '''
+            Returns the index of the closest candidate and its distance, or
+            (None, None) if there are no candidates.
+        '''
+        if self.size == 0:
+            return None, None
+
+        distances = self.distances(vector, candidates)
+        if len(distances) == 0:
+            return None, None
+
+        best = int(distances.argmin())
+        distance = float(distances[best])
+        if candidates is not None:
+            best = candidates[best]
+
+        return best, distance
@@ -1,20 +1,29 @@
 import pygame
 from pygame.locals import *
 import project
+import journal
 import renderer
 import sys
 from output_tile_form import OutputTileForm
+import tile_cache
+
+try:
+    import suggest
+except ImportError:
+    suggest = None
 
 WIDTH = 1024
 HEIGHT = 768
 FPS = 30
 
 class TileToAsciiMapUI():
-    def __init__(self, project_dir):
+    def __init__(self, project_dir, max_tile_surfaces=tile_cache.DEFAULT_MAX_SURFACES, max_tile_bytes=None):
         pygame.init()
         pygame.display.set_caption("Tile to Ascii Converter")
 
         self.project_dir = project_dir
+        self.max_tile_surfaces = max_tile_surfaces
+        self.max_tile_bytes = max_tile_bytes
         self.surface = pygame.display.set_mode((WIDTH, HEIGHT))
         self.fps_clock = pygame.time.Clock()
         self.view_mode = renderer.MAP_VIEW
@@ -24,6 +33,7 @@ class TileToAsciiMapUI():
         self.viewing_output_tile_form = False
         self.selection_start_x = self.selection_start_y = None
         self.x_vel = self.y_vel = 0
+        self.suggester = None
 
     def handle_event(self, event):
         shift_down = pygame.key.get_mods() & KMOD_SHIFT
@@ -31,12 +41,17 @@ class TileToAsciiMapUI():
 
         if event.type == QUIT:
             project.save(self.project_dir, self.project)
+            self.project.journal.close()
             pygame.quit()
             sys.exit(0)
         else:
             if self.viewing_output_tile_form:
                 if self.output_tile_form.process_event(event):
                     self.viewing_output_tile_form = False
+
+                    if self.output_tile_form.saved_output_tile:
+                        self.ui_renderer.invalidate_output_tile(self.output_tile_form.saved_output_tile)
+                        self.output_tile_form.saved_output_tile = None
             else:
                 if event.type == KEYDOWN:
                     if event.key == K_LEFT:
@@ -69,6 +84,12 @@ class TileToAsciiMapUI():
                             self.ui_renderer.toggle_highlighted_id(id_to_view, False, remove_if_exists=False)
                             coords = self.project.get_first_instance_of(id_to_view)
                             self.ui_renderer.centre_display_on(coords[0], coords[1])
+                    elif event.key == K_s:
+                        self.highlight_suggestions()
+                    elif event.key in (K_EQUALS, K_PLUS, K_KP_PLUS):
+                        self.ui_renderer.change_zoom(-1)
+                    elif event.key in (K_MINUS, K_KP_MINUS):
+                        self.ui_renderer.change_zoom(1)
                     elif event.key == K_PAGEUP:
                         self.ui_renderer.output_tile_page_adj(-1)
                     elif event.key == K_PAGEDOWN:
@@ -85,13 +106,14 @@ class TileToAsciiMapUI():
                         if not shift_down:
                             self.ui_renderer.clear_highlighted_ids()
 
-                        for x in range(min(map_start_x, map_x), max(map_start_x, map_x) + 1):
-                            for y in range(min(map_start_y, map_y), max(map_start_y, map_y) + 1):
-                                id = self.project.get_id_at(x, y)
+                        if map_start_x == map_x and map_start_y == map_y and shift_down:
+                            id = self.project.get_id_at(map_x, map_y)
+
+                            if id != None:
+                                self.ui_renderer.toggle_highlighted_id(id, True)
+                        else:
+                            self.ui_renderer.highlight_region(min(map_start_x, map_x), min(map_start_y, map_y), max(map_start_x, map_x) + 1, max(map_start_y, map_y) + 1)
 
-                                if id != None:
-                                    self.ui_renderer.toggle_highlighted_id(self.project.get_id_at(x, y), True, remove_if_exists=(map_start_x == map_x and map_start_y == map_y and shift_down))
-                        
                 elif event.type == MOUSEBUTTONDOWN:
                     screen_x, screen_y = pygame.mouse.get_pos()
                     if pygame.mouse.get_pressed()[0]:
@@ -106,15 +128,47 @@ class TileToAsciiMapUI():
 
                         if output_tile:
                             self.ui_renderer.toggle_highlighted_output_tile(output_tile, True, remove_if_exists=False)
-                            for id in self.ui_renderer.get_highlighted_ids():
+                            ids = self.ui_renderer.get_highlighted_ids()
+                            for id in ids:
                                 self.project.set_output_tile(id, output_tile)
 
+                            self.ui_renderer.invalidate_ids(ids)
+
+    def highlight_suggestions(self):
+        '''
+            Highlights the unknown ids which look most like the ids of the
+            highlighted output tiles and centres the display on the best match.
+        '''
+        if not suggest:
+            print("Suggesting output tiles requires numpy to be installed")
+            return
+
+        identifiers = set(output_tile.identifier for output_tile in self.ui_renderer.highlighted_output_tiles)
+        if not identifiers:
+            return
+
+        # The tiles don't change while editing so their features are only
+        # calculated once.
+        if self.suggester is None:
+            self.suggester = suggest.TileSuggester(self.project_dir, self.project.tile_width, self.project.tile_height)
+
+        mapping = dict((id, tile.identifier) for id, tile in self.project.id_to_output_tile_mapping.iteritems())
+        suggestions = [s for s in self.suggester.suggest(mapping) if s[1] in identifiers and s[2] >= suggest.DEFAULT_MIN_CONFIDENCE]
+        suggestions.sort(key=lambda s: -s[2])
+
+        if suggestions:
+            self.ui_renderer.highlight_ids([s[0] for s in suggestions])
+            coords = self.project.get_first_instance_of(suggestions[0][0])
+            self.ui_renderer.centre_display_on(coords[0], coords[1])
+
     def ui_velocity(self):
         shift_down = pygame.key.get_mods() & KMOD_SHIFT
-        return self.x_vel * (5 if shift_down else 1), self.y_vel * (5 if shift_down else 1)
+        step_x, step_y = self.ui_renderer.scroll_step()
+        return self.x_vel * step_x * (5 if shift_down else 1), self.y_vel * step_y * (5 if shift_down else 1)
 
     def run(self):
-        self.project = project.load(self.project_dir)
+        self.project = project.load(self.project_dir, self.max_tile_surfaces, self.max_tile_bytes)
+        self.project.journal = journal.Journal(self.project_dir)
         self.ui_renderer = renderer.Renderer(self.surface, pygame.font.SysFont('consolas', 12), self.project)
         self.output_tile_form = OutputTileForm(self.project, self.surface, pygame.font.SysFont('consolas', 14))
 
@@ -129,6 +183,10 @@ class TileToAsciiMapUI():
             for event in pygame.event.get():
                 self.handle_event(event)
 
+            if self.project.journal.needs_compaction():
+                output_tiles, mapping = self.project.output_state()
+                self.project.journal.compact(output_tiles, mapping)
+
             self.ui_renderer.shift_display(self.ui_velocity()[0], self.ui_velocity()[1])
 
             self.surface.fill((0,0,0,0))
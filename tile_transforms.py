@@ -0,0 +1,191 @@
+'''
+    Tiles which are flips or rotations of each other can be stored once.
+    Each unique tile is stored in a canonical orientation and every cell of
+    the map records the transform which turns the stored tile into the tile
+    in the image.
+
+    Transform k flips the tile left to right if k >= 4 and then rotates it
+    k % 4 quarter turns anticlockwise. Tiles which aren't square can only be
+    flipped or turned half way round, so only transforms 0, 2, 4 and 6 are
+    used for them.
+
+    The canonical orientation is the variant of the tile whose raw data is
+    smallest, earlier transforms winning ties, so every orientation of a tile
+    has the same canonical tile.
+'''
+import array
+import os
+import struct
+import Image
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+TRANSFORM_MAP_FILE = 'transform_map.bin'
+
+# The transform map is this header followed by a byte per cell, row by row.
+TRANSFORM_MAP_MAGIC = b'TMTF'
+TRANSFORM_MAP_VERSION = 1
+TRANSFORM_MAP_HEADER = struct.Struct('<4sHII')
+
+IDENTITY = 0
+
+PIL_ROTATIONS = [None, Image.ROTATE_90, Image.ROTATE_180, Image.ROTATE_270]
+
+# The cells are canonicalised this many at a time to bound the memory used.
+BATCH_SIZE = 65536
+
+def transforms_for(tile_width, tile_height):
+    if tile_width == tile_height:
+        return list(range(8))
+
+    return [0, 2, 4, 6]
+
+def inverse(transform):
+    '''
+        The transform which undoes transform. Flips followed by a rotation
+        are their own inverse.
+    '''
+    if transform >= 4:
+        return transform
+
+    return (4 - transform) % 4
+
+def transform_image(tile, transform):
+    if transform >= 4:
+        tile = tile.transpose(Image.FLIP_LEFT_RIGHT)
+    if transform % 4:
+        tile = tile.transpose(PIL_ROTATIONS[transform % 4])
+
+    return tile
+
+def transform_pixels(pixels, transform):
+    '''
+        transform_image for a (n, height, width, channels) array of tiles.
+    '''
+    if transform >= 4:
+        pixels = pixels[:, :, ::-1]
+    if transform % 4:
+        pixels = numpy.rot90(pixels, transform % 4, axes=(1, 2))
+
+    return pixels
+
+def canonical_image(tile, tile_bytes):
+    '''
+        Returns the canonical tile and the transform which turns it back
+        into tile. tile_bytes returns the raw data of a tile.
+    '''
+    variants = [(tile_bytes(transform_image(tile, transform)), transform) for transform in transforms_for(*tile.size)]
+    data, transform = min(variants)
+
+    return transform_image(tile, transform), inverse(transform)
+
+def _less_than(rows, other_rows):
+    '''
+        Whether each row of a 2d array is lexicographically smaller than the
+        same row of another.
+    '''
+    different = rows != other_rows
+    first = different.argmax(axis=1)
+    index = numpy.arange(len(rows))
+
+    return different[index, first] & (rows[index, first] < other_rows[index, first])
+
+def canonical_pixels(cells):
+    '''
+        For a (n, height, width, channels) array of tiles returns the
+        canonical tiles, flattened to (n, height * width * channels), and
+        for each tile the transform which was applied to reach its canonical
+        form.
+    '''
+    count, height, width = cells.shape[:3]
+    canonical = numpy.empty((count, cells[0].size), dtype=cells.dtype)
+    applied = numpy.zeros(count, dtype=numpy.uint8)
+
+    for start in range(0, count, BATCH_SIZE):
+        batch = cells[start:start + BATCH_SIZE]
+        best = batch.reshape(len(batch), -1).copy()
+        best_transform = numpy.zeros(len(batch), dtype=numpy.uint8)
+
+        for transform in transforms_for(width, height)[1:]:
+            variant = numpy.ascontiguousarray(transform_pixels(batch, transform)).reshape(len(batch), -1)
+            smaller = _less_than(variant, best)
+            best[smaller] = variant[smaller]
+            best_transform[smaller] = transform
+
+        canonical[start:start + len(batch)] = best
+        applied[start:start + len(batch)] = best_transform
+
+    return canonical, applied
+
+def inverse_transforms(applied):
+    '''
+        inverse for an array of transforms.
+    '''
+    return numpy.where(applied >= 4, applied, (4 - applied) % 4).astype(numpy.uint8)
+
+class TransformMapWriter():
+    '''
+        Writes the transform map a row at a time.
+    '''
+
+    def __init__(self, project_dir, width, height):
+        self.file = open(os.path.join(project_dir, TRANSFORM_MAP_FILE), 'wb')
+        self.file.write(TRANSFORM_MAP_HEADER.pack(TRANSFORM_MAP_MAGIC, TRANSFORM_MAP_VERSION, width, height))
+
+    def write_row(self, row):
+        array.array('B', row).tofile(self.file)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def new_transform_map(width, height):
+    if numpy:
+        return numpy.zeros((height, width), dtype=numpy.uint8)
+
+    return [array.array('B', [IDENTITY]) * width for y in range(height)]
+
+def write_transform_map(project_dir, transform_map):
+    width = len(transform_map[0]) if len(transform_map) > 0 else 0
+    with TransformMapWriter(project_dir, width, len(transform_map)) as writer:
+        if numpy and isinstance(transform_map, numpy.ndarray):
+            numpy.ascontiguousarray(transform_map, dtype=numpy.uint8).tofile(writer.file)
+        else:
+            for row in transform_map:
+                writer.write_row(row)
+
+def has_transform_map(project_dir):
+    return os.path.isfile(os.path.join(project_dir, TRANSFORM_MAP_FILE))
+
+def load_transform_map(project_dir):
+    '''
+        Returns the transform of each cell, indexed [y][x], or None if the
+        project's tiles weren't canonicalised.
+    '''
+    path = os.path.join(project_dir, TRANSFORM_MAP_FILE)
+    if not os.path.isfile(path):
+        return None
+
+    with open(path, 'rb') as transform_file:
+        magic, version, width, height = TRANSFORM_MAP_HEADER.unpack(transform_file.read(TRANSFORM_MAP_HEADER.size))
+        if magic != TRANSFORM_MAP_MAGIC or version != TRANSFORM_MAP_VERSION:
+            return None
+
+        if numpy:
+            return numpy.fromfile(transform_file, dtype=numpy.uint8, count=width * height).reshape(height, width)
+
+        rows = []
+        for y in range(height):
+            row = array.array('B')
+            row.fromfile(transform_file, width)
+            rows.append(row)
+
+        return rows